@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Stand-in for PhantomJS running render-ipc.js, for benchmarking the Python side
+of phantom-snap without a browser.
+
+Reads render requests from stdin, one JSON request or batch per line, and
+writes responses to stdout exactly as render-ipc.js does, including the id
+tagging and ready lines of multiplexed mode and the binary image mode. Its behaviour is controlled by
+environment variables, which PhantomJSRenderer passes through its `env`
+config:
+
+    FAKE_PHANTOM_LATENCY_MS     Time taken by each render (multiplexed pages render in parallel), default 0
+    FAKE_PHANTOM_JITTER_MS      Random extra time added to the latency, default 0
+    FAKE_PHANTOM_PAYLOAD_BYTES  Size of the raw image in each response, default 10240
+    FAKE_PHANTOM_STDERR_LINES   Lines of noise written to stderr for every render, default 0
+    FAKE_PHANTOM_HANG_EVERY     Stop answering, without exiting, on every Nth render, default 0 (never)
+    FAKE_PHANTOM_CRASH_EVERY    Exit abruptly on every Nth render, default 0 (never)
+
+Hang and crash counts are per process, so a restarted process starts again.
+"""
+
+import base64
+import json
+import os
+import random
+import sys
+import time
+
+
+def _setting(name, default=0):
+    return int(os.environ.get(u'FAKE_PHANTOM_' + name, default))
+
+
+LATENCY_MS = _setting(u'LATENCY_MS')
+JITTER_MS = _setting(u'JITTER_MS')
+PAYLOAD_BYTES = _setting(u'PAYLOAD_BYTES', 10240)
+STDERR_LINES = _setting(u'STDERR_LINES')
+HANG_EVERY = _setting(u'HANG_EVERY')
+CRASH_EVERY = _setting(u'CRASH_EVERY')
+
+# How often render-ipc.js asks for more requests while pages are rendering
+POLL_MS = 20
+
+# Random bytes so the payload doesn't compress unrealistically well anywhere along the way
+IMAGE = os.urandom(PAYLOAD_BYTES)
+IMAGE_BASE64 = base64.b64encode(IMAGE).decode(u'ascii')
+
+
+def answer(request, render_time):
+    """Encode the response line, and raw image in binary mode, for one request."""
+
+    response = {
+        u'url': request.get(u'url'),
+        u'status': u'success',
+        u'loadTime': render_time,
+        u'paintTime': 1,
+        u'format': request.get(u'format', u'PNG')
+    }
+
+    if u'id' in request:
+        response[u'id'] = request[u'id']
+
+    image = b''
+
+    if request.get(u'binary'):
+        image = IMAGE
+        response[u'length'] = len(image)
+    else:
+        response[u'base64'] = IMAGE_BASE64
+
+    return json.dumps(response).encode(u'ascii') + b'\n' + image
+
+
+def render_time():
+    return LATENCY_MS + (random.randint(0, JITTER_MS) if JITTER_MS > 0 else 0)
+
+
+def main():
+
+    stdout = sys.stdout.buffer
+    renders = 0
+    in_flight = []  # (finish time, url, response) of each page rendering in multiplexed mode
+
+    for line in iter(sys.stdin.readline, u''):
+        if line.strip() == u'exit':
+            break
+
+        request = json.loads(line)
+
+        if not isinstance(request, list):
+            renders += 1
+            time_taken = render_time()
+            time.sleep(time_taken / 1000.0)
+
+            if CRASH_EVERY > 0 and renders % CRASH_EVERY == 0:
+                os._exit(1)
+
+            if HANG_EVERY > 0 and renders % HANG_EVERY == 0:
+                while True:
+                    time.sleep(60)
+
+            for _ in range(STDERR_LINES):
+                sys.stderr.write(u'CONSOLE: fake console noise for {}\n'.format(request.get(u'url')))
+
+            sys.stderr.flush()
+            stdout.write(answer(request, time_taken))
+            stdout.flush()
+            continue
+
+        for item in request:
+            renders += 1
+
+            if CRASH_EVERY > 0 and renders % CRASH_EVERY == 0:
+                os._exit(1)
+
+            time_taken = render_time()
+            finish = float(u'inf') if HANG_EVERY > 0 and renders % HANG_EVERY == 0 else \
+                time.time() + time_taken / 1000.0
+            in_flight.append((finish, item.get(u'url'), answer(item, time_taken)))
+
+        # Like render-ipc.js, ask for the next line as soon as a page completes, or after POLL_MS while pages render
+        if in_flight:
+            next_finish = min(finish for finish, _, _ in in_flight)
+            time.sleep(max(0.0, min(next_finish - time.time(), POLL_MS / 1000.0)))
+
+        now = time.time()
+        done = [page for page in in_flight if page[0] <= now]
+        in_flight = [page for page in in_flight if page[0] > now]
+
+        for _, url, _ in done:
+            for _ in range(STDERR_LINES):
+                sys.stderr.write(u'CONSOLE: fake console noise for {}\n'.format(url))
+
+        sys.stderr.flush()
+        stdout.write(b''.join(response for _, _, response in done) + b'{"ready": true}\n')
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+Measure the overhead phantom-snap adds to each render, using fake_phantomjs.py
+in place of PhantomJS so the numbers reflect this library rather than the
+browser.
+
+Every combination of renderer mode and payload size is run as one scenario,
+recording throughput, p50/p99 latency, the Python process CPU time per render
+and, with --trace-memory, the peak Python memory allocated. Results are
+written as JSON with --output, and --compare checks them against an earlier
+result file, exiting with status 1 when a scenario regressed by more than
+--tolerance.
+
+    python benchmarks/run.py --payloads 10240 1048576 --output results.json
+    python benchmarks/run.py --compare results.json
+"""
+
+import eventlet
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from phantom_snap.__version__ import __version__
+from phantom_snap.decorators import Lifetime
+from phantom_snap.phantom import PhantomJSRenderer
+from phantom_snap.pool import RendererPool
+
+FAKE_PHANTOMJS = os.path.join(os.path.dirname(os.path.abspath(__file__)), u'fake_phantomjs.py')
+
+
+def phantom(config, concurrency):
+    return PhantomJSRenderer(config)
+
+
+def lifetime(config, concurrency):
+    return Lifetime(PhantomJSRenderer(config))
+
+
+def multiplexed(config, concurrency):
+    return Lifetime(PhantomJSRenderer(dict(config, max_pages=concurrency)))
+
+
+def pool(config, concurrency):
+    return RendererPool(lambda: Lifetime(PhantomJSRenderer(config)), dict(config, pool_size=concurrency))
+
+
+MODES = {
+    u'phantom': phantom,
+    u'lifetime': lifetime,
+    u'multiplexed': multiplexed,
+    u'pool': pool
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list."""
+
+    if not values:
+        return None
+
+    rank = max(int(round(pct / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_scenario(mode, payload_bytes, args):
+    """Run one mode and payload size, returning its result dict."""
+
+    config = {
+        u'executable': sys.executable,
+        u'script': FAKE_PHANTOMJS,
+        u'binary_images': args.binary,
+        u'env': {
+            u'FAKE_PHANTOM_LATENCY_MS': str(args.latency_ms),
+            u'FAKE_PHANTOM_JITTER_MS': str(args.jitter_ms),
+            u'FAKE_PHANTOM_PAYLOAD_BYTES': str(payload_bytes),
+            u'FAKE_PHANTOM_STDERR_LINES': str(args.stderr_lines),
+            u'FAKE_PHANTOM_HANG_EVERY': str(args.hang_every),
+            u'FAKE_PHANTOM_CRASH_EVERY': str(args.crash_every)
+        },
+        u'timeouts': {
+            u'initial_page_load': args.page_load_timeout,
+            u'page_load': args.page_load_timeout,
+            u'render_response': 1
+        }
+    }
+
+    renderer = MODES[mode](config, args.concurrency)
+    latencies = []
+
+    def timed_render(url):
+        start = time.time()
+        response = renderer.render(url)
+        latencies.append(time.time() - start)
+        return response[u'status']
+
+    try:
+        # Start the processes outside of the measurements
+        renderer.warmup()
+
+        if args.trace_memory:
+            tracemalloc.start()
+
+        cpu_start = cpu_seconds()
+        start = time.time()
+
+        urls = (u'http://bench/{}'.format(i) for i in range(args.renders))
+        statuses = list(eventlet.GreenPool(args.concurrency).imap(timed_render, urls))
+
+        elapsed = time.time() - start
+        cpu = cpu_seconds() - cpu_start
+
+        peak_bytes = None
+        if args.trace_memory:
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    finally:
+        renderer.shutdown()
+
+    latencies.sort()
+
+    return {
+        u'mode': mode,
+        u'payload_bytes': payload_bytes,
+        u'binary_images': args.binary,
+        u'concurrency': args.concurrency,
+        u'renders': len(statuses),
+        u'failures': sum(1 for status in statuses if status != u'success'),
+        u'seconds': elapsed,
+        u'throughput_rps': len(statuses) / elapsed if elapsed > 0 else None,
+        u'latency_ms': {
+            u'p50': percentile(latencies, 50) * 1000,
+            u'p99': percentile(latencies, 99) * 1000,
+            u'mean': sum(latencies) / len(latencies) * 1000,
+            u'max': latencies[-1] * 1000
+        },
+        u'cpu_ms_per_render': cpu / len(statuses) * 1000,
+        u'peak_traced_bytes': peak_bytes,
+        u'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def scenario_key(result):
+    return result[u'mode'], result[u'payload_bytes'], result[u'binary_images'], result[u'concurrency']
+
+
+def compare(results, baseline, tolerance):
+    """Print the change from a baseline result file. :return: True if any scenario regressed."""
+
+    previous = dict((scenario_key(result), result) for result in baseline[u'results'])
+    regressed = False
+
+    for result in results:
+        before = previous.get(scenario_key(result))
+
+        if before is None:
+            continue
+
+        throughput = change(result[u'throughput_rps'], before.get(u'throughput_rps'))
+        p99 = change(result[u'latency_ms'][u'p99'], (before.get(u'latency_ms') or {}).get(u'p99'))
+        cpu = change(result[u'cpu_ms_per_render'], before.get(u'cpu_ms_per_render'))
+
+        worse = (throughput is not None and throughput < -tolerance) or \
+                (p99 is not None and p99 > tolerance) or \
+                (cpu is not None and cpu > tolerance)
+        regressed = regressed or worse
+
+        print(u'{:<12} {:>10} throughput {:>7}  p99 {:>7}  cpu/render {:>7}{}'.format(
+            result[u'mode'], result[u'payload_bytes'], format_change(throughput), format_change(p99),
+            format_change(cpu), u'  REGRESSED' if worse else u''))
+
+    return regressed
+
+
+def change(value, baseline):
+    """Fractional change from the baseline, or None when either is missing or the baseline is 0."""
+
+    if value is None or not baseline:
+        return None
+
+    return value / baseline - 1
+
+
+def format_change(fraction):
+    return u'n/a' if fraction is None else u'{:+.1%}'.format(fraction)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=u'Benchmark phantom-snap against a fake PhantomJS.')
+    parser.add_argument(u'--modes', nargs=u'+', choices=sorted(MODES), default=sorted(MODES))
+    parser.add_argument(u'--payloads', nargs=u'+', type=int, default=[10240, 262144, 2097152],
+                        help=u'Image sizes in bytes')
+    parser.add_argument(u'--renders', type=int, default=200, help=u'Renders per scenario')
+    parser.add_argument(u'--concurrency', type=int, default=4)
+    parser.add_argument(u'--binary', action=u'store_true', help=u'Use binary_images')
+    parser.add_argument(u'--latency-ms', type=int, default=0)
+    parser.add_argument(u'--jitter-ms', type=int, default=0)
+    parser.add_argument(u'--stderr-lines', type=int, default=0)
+    parser.add_argument(u'--hang-every', type=int, default=0)
+    parser.add_argument(u'--crash-every', type=int, default=0)
+    parser.add_argument(u'--page-load-timeout', type=int, default=1, help=u'Seconds, bounds the cost of hangs')
+    parser.add_argument(u'--trace-memory', action=u'store_true',
+                        help=u'Record peak Python allocations with tracemalloc, which inflates the CPU figures')
+    parser.add_argument(u'--output', help=u'Write the results to this JSON file')
+    parser.add_argument(u'--compare', help=u'Compare with an earlier JSON result file')
+    parser.add_argument(u'--tolerance', type=float, default=0.1, help=u'Allowed regression, as a fraction')
+    args = parser.parse_args(argv)
+
+    results = []
+
+    for mode in args.modes:
+        for payload_bytes in args.payloads:
+            result = run_scenario(mode, payload_bytes, args)
+            results.append(result)
+
+            print(u'{:<12} {:>10} bytes  {:8.1f} renders/s  p50 {:7.2f} ms  p99 {:7.2f} ms  '
+                  u'cpu {:6.3f} ms/render  failures {}'.format(mode, payload_bytes, result[u'throughput_rps'],
+                                                               result[u'latency_ms'][u'p50'],
+                                                               result[u'latency_ms'][u'p99'],
+                                                               result[u'cpu_ms_per_render'], result[u'failures']))
+
+    output = {
+        u'meta': {
+            u'version': __version__,
+            u'python': platform.python_version(),
+            u'platform': platform.platform(),
+            u'cpu_count': os.cpu_count(),
+            u'timestamp': time.strftime(u'%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            u'args': vars(args)
+        },
+        u'results': results
+    }
+
+    if args.output:
+        with open(args.output, u'w') as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, u'r') as baseline_file:
+            if compare(results, json.load(baseline_file), args.tolerance):
+                return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
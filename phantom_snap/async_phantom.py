@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+
+import asyncio
+import collections
+import copy
+import json
+import logging
+import os
+import shutil
+import traceback
+
+from .renderer import RenderError, split_request, tag_response
+from .protocol import build_request, empty_response, failed_response, decode_response, apply_response, redact, \
+                      frame_length
+from .settings import PHANTOMJS, merge
+
+# Each response carries the whole base64 image on one line, far beyond the 64 KiB asyncio default.
+STREAM_LIMIT = 256 * 1024 * 1024
+
+
+class AsyncPhantomJSRenderer(object):
+    """
+    Render a web page to an image, using either a URL or raw HTML, from
+    an asyncio event loop.
+
+    Speaks the same render-ipc.js protocol as PhantomJSRenderer and takes the
+    same configuration, but drives the PhantomJS process with
+    asyncio.create_subprocess_exec and non-blocking stream readers instead of
+    eventlet, so no monkey-patching is required.
+
+    By default renders on one instance are answered one at a time. As with
+    PhantomJSRenderer, when the `max_pages` config is above 1 concurrent
+    render() calls are multiplexed: each request is tagged with an id and
+    sent as soon as one of the `max_pages` pages is free, and the responses
+    are matched back to the waiting callers by id. A render which times out
+    fails alone, and PhantomJS is only restarted once timed out renders hold
+    all of its pages.
+
+    Requires PhantomJS to be installed on the host: http://phantomjs.org/
+    """
+
+    def __init__(self, config, logger=None):
+
+        self.config = copy.deepcopy(PHANTOMJS)
+        self.config = merge(self.config, config)
+
+        self._proc = None
+        self._stderr_task = None
+        self._stderr_lines = collections.deque()
+
+        # Created on first use so it binds to the loop which runs the renders
+        self._comms_lock = None
+
+        # State of multiplexed renders, only changed from the event loop between awaits
+        self._next_id = 0
+        self._pending = {}  # id -> _PendingRender, for every render not yet answered
+        self._queued = collections.deque()  # Renders waiting for a free page
+        self._sent = set()  # ids sent to PhantomJS and not yet answered
+        self._abandoned = set()  # ids of _sent whose callers timed out
+        self._last_line = []  # ids of the last request line written
+        self._cookie_render = None  # id of a render with cookies, which has the process to itself
+        self._reading = False  # PhantomJS is waiting for a request line
+        self._reader_task = None
+        self._warm = False
+
+        if shutil.which(self.config[u'executable']) is None:
+            raise RenderError(''.join([u"Can't locate PhantomJS executable: ", self.config[u'executable']]))
+
+        if not os.path.isfile(self.config[u'script']):
+            raise RenderError(''.join([u"Can't locate script: ", self.config[u'script']]))
+
+        if logger is not None:
+            self._logger = logger
+        else:
+            self._logger = logging.getLogger(u'AsyncPhantomJSRenderer')
+
+    def get_config(self):
+        return self.config
+
+    async def render(self, url, html=None, img_format=u'PNG', width=1280, height=1024, page_load_timeout=None,
+                     user_agent=None, headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None):
+        """
+        Render a URL target or HTML to an image file.
+        :param url:
+        :param html:
+        :param img_format:
+        :param width:
+        :param height:
+        :param page_load_timeout:
+        :param user_agent:
+        :param headers:
+        :param cookies:
+        :param html_encoding:
+        :return:
+        """
+        request = build_request(url, html, img_format, width, height, user_agent, headers, cookies, html_encoding,
+                                http_proxy)
+
+        if self.config[u'binary_images']:
+            request[u'binary'] = True
+
+        if self._comms_lock is None:
+            self._comms_lock = asyncio.Lock()
+
+        if self._multiplexed():
+            return await self._render_multiplexed(request, url, img_format, page_load_timeout)
+
+        async with self._comms_lock:
+            try:
+                first_render = False
+
+                if self._proc is None:
+                    await self._start_process()
+                    first_render = True
+
+                render_timeout = self.config[u'timeouts'][u'render_response']
+
+                if page_load_timeout is None:
+                    if first_render:
+                        page_load_timeout = self.config[u'timeouts'][u'initial_page_load']
+                    else:
+                        page_load_timeout = self.config[u'timeouts'][u'page_load']
+
+                request[u'timeout'] = page_load_timeout * 1000  # Convert seconds to ms
+                request[u'resourceWait'] = self.config[u'timeouts'][u'resource_wait_ms']
+
+                request_string = json.dumps(request)
+
+                try:
+                    self._logger.debug(u'Sending request: ' + request_string)
+                    phantom_response = await asyncio.wait_for(self._exchange(request_string),
+                                                              page_load_timeout + render_timeout)
+
+                except asyncio.TimeoutError:
+                    self._logger.warning(u'Received no response, terminating PhantomJS.')
+                    await self.shutdown()
+
+                    return failed_response(url, img_format, u'Render request has timed out.')
+
+                except (ValueError, KeyError, asyncio.IncompleteReadError) as e:
+                    # Unparseable, or an image frame cut short, so stdout is out of step with the requests
+                    self._logger.debug(u'Error reading response, terminating PhantomJS.\n' + traceback.format_exc())
+                    await self.shutdown()
+
+                    return failed_response(url, img_format, str(e))
+
+                err_messages = self._check_stderr()
+
+                if err_messages is not None and self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug(err_messages)
+
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug(u'Received response: ' + json.dumps(redact(phantom_response)))
+
+                return apply_response(empty_response(url, img_format), phantom_response, err_messages)
+
+            except (asyncio.CancelledError, Exception):
+                # A cancelled or failed exchange leaves the pipes out of step with the process
+                self._logger.error(u'Unexpected error, terminating PhantomJS.\n' + traceback.format_exc())
+                await self.shutdown()
+                raise
+
+    async def _render_multiplexed(self, request, url, img_format, page_load_timeout):
+        """Queue the request for the next free page in PhantomJS and wait for its response by id."""
+
+        render_timeout = self.config[u'timeouts'][u'render_response']
+
+        try:
+            if self._proc is None:
+                async with self._comms_lock:
+                    if self._proc is None:
+                        await self._start_process()
+
+            if page_load_timeout is None:
+                if self._warm:
+                    page_load_timeout = self.config[u'timeouts'][u'page_load']
+                else:
+                    page_load_timeout = self.config[u'timeouts'][u'initial_page_load']
+
+            request[u'id'] = self._next_id
+            request[u'timeout'] = page_load_timeout * 1000  # Convert seconds to ms
+            request[u'resourceWait'] = self.config[u'timeouts'][u'resource_wait_ms']
+            self._next_id += 1
+
+            pending = _PendingRender(request)
+            self._pending[pending.id] = pending
+            self._queued.append(pending)
+
+            self._send_requests()
+
+        except Exception:
+            self._logger.error(u'Unexpected error, terminating PhantomJS.\n' + traceback.format_exc())
+            await self.shutdown()
+            raise
+
+        try:
+            # The render timeout only starts once the request has actually been sent to PhantomJS
+            await pending.sent
+            result = await asyncio.wait_for(asyncio.shield(pending.result), page_load_timeout + render_timeout)
+
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Its page may still answer, which is ignored, and holds its place in PhantomJS until then
+            self._pending.pop(pending.id, None)
+
+            if pending in self._queued:
+                self._queued.remove(pending)
+
+            if pending.id in self._sent:
+                self._abandoned.add(pending.id)
+
+            if len(self._abandoned) >= self.config[u'max_pages']:
+                # Once timed out pages hold every page no other render can start
+                self._logger.warning(u'Every page in PhantomJS has timed out, terminating it.')
+                await self.shutdown()
+
+            if isinstance(e, asyncio.CancelledError):
+                raise
+
+            self._logger.warning(u'Received no response for {}.'.format(url))
+
+            return failed_response(url, img_format, u'Render request has timed out.')
+
+        if result is None:
+            return failed_response(url, img_format, u'PhantomJS terminated before the render completed.')
+
+        phantom_response, err_messages = result
+
+        return apply_response(empty_response(url, img_format), phantom_response, err_messages)
+
+    def _send_requests(self):
+        """
+        Write the queued requests which fit in the free pages to PhantomJS, if
+        it is waiting for a line, as PhantomJSRenderer._send_requests() does.
+        """
+        if not self._reading or self._proc is None:
+            return
+
+        batch = []
+
+        while self._queued and self._cookie_render is None and \
+                len(batch) + len(self._sent) < self.config[u'max_pages']:
+            has_cookies = u'cookies' in self._queued[0].request
+
+            if has_cookies and (len(batch) > 0 or len(self._sent) > 0):
+                break
+
+            batch.append(self._queued.popleft())
+
+            if has_cookies:
+                self._cookie_render = batch[-1].id
+                break
+
+        if len(batch) == 0 and len(self._sent) == 0:
+            return
+
+        request_string = json.dumps([pending.request for pending in batch])
+
+        if batch:
+            self._logger.debug(u'Sending {} requests'.format(len(batch)))
+
+        # Request lines are small, and PhantomJS reads each one before asking for the next, so no drain is needed
+        self._proc.stdin.write(request_string.encode('utf-8', errors='replace') + b'\n')
+
+        self._reading = False
+        self._last_line = [pending.id for pending in batch]
+
+        for pending in batch:
+            pending.request = None
+            self._sent.add(pending.id)
+            pending.sent.set_result(None)
+
+    async def _read_responses(self, proc):
+        """Hand each multiplexed response from PhantomJS to the render waiting on its id."""
+
+        while True:
+            response_string = await proc.stdout.readline()
+
+            if not response_string:
+                break
+
+            try:
+                phantom_response = decode_response(response_string)
+
+                if not phantom_response.get(u'ready') and self.config[u'binary_images']:
+                    length = frame_length(phantom_response)
+
+                    if length > 0:
+                        phantom_response[u'image'] = memoryview(await proc.stdout.readexactly(length))
+
+            except (ValueError, asyncio.IncompleteReadError):
+                self._logger.warning(u'Error reading response: {}\nTerminating PhantomJS.\n{}'.format(response_string, traceback.format_exc()))
+                break
+
+            if self._proc is not proc:
+                return
+
+            if phantom_response.get(u'ready'):
+                self._reading = True
+                self._send_requests()
+                continue
+
+            err_messages = self._check_stderr()
+
+            if err_messages is not None and self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug(err_messages)
+
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug(u'Received response: ' + json.dumps(redact(phantom_response)))
+
+            request_id = phantom_response.pop(u'id', None)
+
+            if request_id is None:
+                # The whole line was rejected, e.g. it couldn't be parsed
+                answered = self._last_line
+                self._last_line = []
+            else:
+                answered = [request_id]
+
+            for answered_id in answered:
+                self._sent.discard(answered_id)
+                self._abandoned.discard(answered_id)
+
+                if answered_id == self._cookie_render:
+                    self._cookie_render = None
+
+                pending = self._pending.pop(answered_id, None)
+
+                if pending is not None and not pending.result.done():
+                    pending.result.set_result((phantom_response, err_messages))
+
+            self._warm = True
+
+        if self._proc is proc:
+            self._logger.warning(u'PhantomJS exited unexpectedly.')
+            await self.shutdown()
+
+    async def render_many(self, requests, concurrency=1):
+        """
+        Render a stream of requests, yielding each response as soon as it completes.
+
+        Requests are pulled lazily from an iterable or async iterable, with at
+        most `concurrency` renders in flight, and each response is tagged with
+        the 'id' of its request (or its position in the input).
+        :param requests: (Async) iterable of dicts holding the render() keyword arguments, plus an optional 'id'
+        :param concurrency: Max number of renders in flight at once.
+        :return: Async generator of response dicts
+        """
+        if concurrency < 1:
+            raise ValueError(u'concurrency must be at least 1')
+
+        if hasattr(requests, '__aiter__'):
+            source = requests.__aiter__()
+        else:
+            source = _AsyncIterator(requests)
+
+        pending = set()
+        exhausted = False
+        index = 0
+
+        try:
+            while True:
+                while not exhausted and len(pending) < concurrency:
+                    try:
+                        request = await source.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+
+                    pending.add(asyncio.ensure_future(self._render_request(request, index)))
+                    index += 1
+
+                if not pending:
+                    return
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _render_request(self, request, index):
+
+        request_id, kwargs = split_request(request, index)
+
+        try:
+            response = await self.render(**kwargs)
+        except Exception:
+            response = failed_response(kwargs.get(u'url'), kwargs.get(u'img_format', u'PNG'), traceback.format_exc())
+
+        return tag_response(response, request_id, kwargs)
+
+    async def shutdown(self, timeout=None):
+        """
+        Terminate the PhantomJS process, if running.
+        :param timeout: Time in seconds to wait for the process to exit.
+        :return:
+        """
+        proc, self._proc = self._proc, None
+
+        if self._reader_task is not None:
+            if self._reader_task is not asyncio.current_task():
+                self._reader_task.cancel()
+
+            self._reader_task = None
+
+        self._fail_pending()
+
+        if proc is not None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+
+            await asyncio.wait_for(proc.wait(), timeout)
+
+            self._logger.info(u'PhantomJS terminated.')
+
+        if self._stderr_task is not None:
+            self._stderr_task.cancel()
+            self._stderr_task = None
+
+    async def _start_process(self):
+
+        startup_timeout = self.config[u'timeouts'][u'process_startup']
+
+        command = self._construct_command()
+
+        self._logger.info(u"Starting the PhantomJS process: " + u" ".join(command))
+
+        self._proc = await asyncio.wait_for(asyncio.create_subprocess_exec(*command,
+                                                                           stdin=asyncio.subprocess.PIPE,
+                                                                           stdout=asyncio.subprocess.PIPE,
+                                                                           stderr=asyncio.subprocess.PIPE,
+                                                                           env=self.config[u'env'],
+                                                                           limit=STREAM_LIMIT),
+                                            startup_timeout)
+
+        self._stderr_lines.clear()
+        self._stderr_task = asyncio.ensure_future(self._read_stderr(self._proc.stderr))
+        self._warm = False
+
+        if self._multiplexed():
+            # Waiting on its first read, which isn't announced
+            self._reading = True
+            self._reader_task = asyncio.ensure_future(self._read_responses(self._proc))
+
+    async def _exchange(self, request_string):
+        """
+        Write one request line and read back the decoded response, with the raw image in binary mode.
+        :raises ValueError: if the response can't be decoded
+        :raises asyncio.IncompleteReadError: if the stream ends before the whole image was read
+        """
+        self._proc.stdin.write(request_string.encode('utf-8', errors='replace') + b'\n')
+        await self._proc.stdin.drain()
+
+        response_string = await self._proc.stdout.readline()
+
+        try:
+            phantom_response = decode_response(response_string)
+        except ValueError as e:
+            raise ValueError(''.join([str(e), u'\nPhantomJS response: ', response_string.decode('utf-8', errors='replace')]))
+
+        if self.config[u'binary_images']:
+            length = frame_length(phantom_response)
+
+            if length > 0:
+                phantom_response[u'image'] = memoryview(await self._proc.stdout.readexactly(length))
+
+        return phantom_response
+
+    async def _read_stderr(self, stream):
+
+        while True:
+            line = await stream.readline()
+
+            if not line:
+                break
+
+            self._stderr_lines.append(line)
+
+    def _multiplexed(self):
+        return self.config[u'max_pages'] > 1
+
+    def _fail_pending(self):
+        """Release every multiplexed render still waiting on the terminated process."""
+
+        for pending in self._pending.values():
+            if not pending.sent.done():
+                pending.sent.set_result(None)
+
+            if not pending.result.done():
+                pending.result.set_result(None)
+
+        self._pending.clear()
+        self._queued.clear()
+        self._sent.clear()
+        self._abandoned.clear()
+        self._last_line = []
+        self._cookie_render = None
+        self._reading = False
+
+    def _check_stderr(self):
+        """Collect any input from the stderr pipe and return it."""
+
+        err_messages = []
+
+        while self._stderr_lines:
+            err_messages.append(self._stderr_lines.popleft().decode('UTF-8', errors='replace'))
+
+        if len(err_messages) > 0:
+            return u'\n'.join(err_messages)
+        else:
+            return None
+
+    def _construct_command(self):
+        """Build the command array for executing the PhantomJS process."""
+
+        executable = shutil.which(self.config[u'executable'])
+
+        return [executable] + self.config[u'args'] + [self.config[u'script']]
+
+
+class _PendingRender(object):
+    """A multiplexed render request, waiting to be sent to PhantomJS and answered."""
+
+    def __init__(self, request):
+
+        loop = asyncio.get_event_loop()
+
+        self.id = request[u'id']
+        self.request = request
+        self.sent = loop.create_future()
+        self.result = loop.create_future()
+
+
+class _AsyncIterator(object):
+    """Adapts a plain iterable to the async iterator protocol."""
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
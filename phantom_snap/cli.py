@@ -0,0 +1,87 @@
+"""
+Command line interface.
+
+    phantom-snap serve --port 8080 --pool-size 4
+
+serve runs a RenderServer in front of a RendererPool of Lifetime decorated
+PhantomJSRenderer workers, answering the same requests as the serverless
+handler so a LambdaRenderer can point at it.
+"""
+
+import argparse
+import logging
+import sys
+
+
+def serve(parser, args):
+
+    # Imported here, so the command line can report a missing optional dependency
+    try:
+        from .decorators import Lifetime
+        from .metrics import Metrics
+        from .phantom import PhantomJSRenderer
+        from .pool import RendererPool
+        from .server import serve as run_server
+    except ImportError as e:
+        parser.error(u'{}, install it with: pip install phantom-snap[server]'.format(e))
+
+    metrics = Metrics()
+
+    config = {
+        u'executable': args.executable,
+        u'args': args.phantomjs_arg,
+        u'max_pages': args.max_pages,
+        u'binary_images': args.binary_images,
+        u'pool_size': args.pool_size,
+        u'worker_concurrency': args.max_pages,
+        u'max_queue_size': args.max_pending
+    }
+
+    renderer = RendererPool(lambda: Lifetime(PhantomJSRenderer(config, metrics=metrics)), config)
+
+    if not args.no_prewarm:
+        renderer.warmup()
+
+    run_server(renderer, {u'host': args.host,
+                          u'port': args.port,
+                          u'api_key': args.api_key,
+                          u'max_pending': args.max_pending,
+                          u'batch_concurrency': args.pool_size * args.max_pages}, metrics=metrics)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog=u'phantom-snap')
+    parser.add_argument(u'--log-level', default=u'INFO')
+    commands = parser.add_subparsers(dest=u'command')
+
+    serve_parser = commands.add_parser(u'serve', help=u'Serve renders over HTTP, like the serverless handler')
+    serve_parser.add_argument(u'--host', default=u'0.0.0.0')
+    serve_parser.add_argument(u'--port', type=int, default=8080)
+    serve_parser.add_argument(u'--pool-size', type=int, default=2, help=u'Number of PhantomJS processes')
+    serve_parser.add_argument(u'--max-pages', type=int, default=1, help=u'Pages rendered at once by each process')
+    serve_parser.add_argument(u'--max-pending', type=int, default=100,
+                              help=u'Renders admitted at once, beyond which requests get 429')
+    serve_parser.add_argument(u'--executable', default=u'phantomjs')
+    serve_parser.add_argument(u'--phantomjs-arg', action=u'append', default=[],
+                              help=u'Argument passed to PhantomJS, repeatable, e.g. --phantomjs-arg=--load-images=true')
+    serve_parser.add_argument(u'--binary-images', action=u'store_true',
+                              help=u'Receive images from PhantomJS as raw bytes, see binary_images')
+    serve_parser.add_argument(u'--api-key', help=u'Require this x-api-key header')
+    serve_parser.add_argument(u'--no-prewarm', action=u'store_true', help=u"Don't warm up the workers at startup")
+    serve_parser.set_defaults(func=serve)
+
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    logging.basicConfig(stream=sys.stdout, level=args.log_level.upper())
+
+    args.func(commands.choices[args.command], args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
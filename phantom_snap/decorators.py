@@ -1,13 +1,24 @@
 
 import eventlet
 from eventlet.green import threading
+from eventlet.event import Event
+from eventlet.queue import Empty, LightQueue
 
+import base64
+import collections
 import copy
+import hashlib
+import json
 import logging
+import os
+import shutil
+import tempfile
 import time
 
-from .renderer import Renderer
-from .settings import LIFETIME
+from .metrics import Metrics
+from .renderer import Renderer, render_key
+from .result import RenderResult
+from .settings import LIFETIME, CACHE, HEDGE
 
 
 class Lifetime(Renderer):
@@ -21,6 +32,20 @@ class Lifetime(Renderer):
     growth by limiting the amount of time a single Renderer can live, and
     releasing its accumulated resources.
 
+    The renderer can also be recycled on the resources it actually holds:
+    after `max_renders` renders (warmups aren't counted), once the resident
+    memory of its process (read from /proc, for delegates exposing a `pid`)
+    exceeds `max_rss_mb`, or once the `--disk-cache-path` directory exceeds
+    `max_disk_cache_mb`. The memory and disk cache are measured by a monitor
+    green thread as renders complete, at most every `resource_check_sec`.
+
+    Once the renderer is due to be recycled, for any reason, new renders wait
+    while those in flight drain, and the renderer is shutdown by the monitor
+    once none remain, so a busy multiplexed renderer is still recycled.
+
+    Every shutdown is counted on `metrics` as restarts_total, labelled with
+    the config key which triggered it.
+
     For long or continual running of the rendering process, it is highly
     recommended to wrap the Renderer with the Lifetime decorator to prevent
     eventual OOM.
@@ -29,15 +54,28 @@ class Lifetime(Renderer):
     _delegate = None
     _last_render_time = None
     _start_time = None
+    _in_flight = 0
+    _renders = 0
+    _next_resource_check = 0
+    _check_due = False
+    _recycle_reason = None
 
     _running = False
     _thread = None
-    _condition = threading.Condition(threading.RLock())
-    _lock = threading.RLock()
+    _condition = None
 
-    def __init__(self, renderer):
+    def __init__(self, renderer, metrics=None):
 
         self._delegate = renderer
+
+        if metrics is None:
+            metrics = getattr(renderer, 'metrics', None) or Metrics()
+
+        self.metrics = metrics
+
+        # Per instance, so several decorated renderers (e.g. in a RendererPool) don't serialize each other
+        self._condition = threading.Condition(threading.RLock())
+
         self.config = copy.deepcopy(LIFETIME)
         self.config.update(renderer.get_config())
 
@@ -49,7 +87,34 @@ class Lifetime(Renderer):
     def render(self, url, html=None, img_format='PNG', width=1280, height=1024, page_load_timeout=None, user_agent=None,
                headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None):
 
-        with self._lock:
+        self._begin()
+
+        # Render outside of the lock so concurrent renders can reach a multiplexed delegate
+        try:
+            return self._delegate.render(url, html, img_format, width, height, page_load_timeout, user_agent, headers, cookies, html_encoding, http_proxy)
+        finally:
+            self._end()
+
+    @property
+    def ready(self):
+        return self._delegate.ready
+
+    def warmup(self):
+
+        self._begin()
+
+        try:
+            return self._delegate.warmup()
+        finally:
+            self._end(count=False)
+
+    def _begin(self):
+        """Record the start of a render, once any pending recycle is done, starting the lifetime monitor if required."""
+
+        with self._condition:
+            while self._recycle_reason is not None:
+                self._condition.wait()
+
             self._last_render_time = time.time()
 
             if self._start_time is None:
@@ -58,7 +123,112 @@ class Lifetime(Renderer):
             if not self._running:
                 self._startup()
 
-            return self._delegate.render(url, html, img_format, width, height, page_load_timeout, user_agent, headers, cookies, html_encoding, http_proxy)
+            self._in_flight += 1
+
+    def _end(self, count=True):
+
+        with self._condition:
+            self._in_flight -= 1
+            self._last_render_time = time.time()
+
+            if count:
+                self._renders += 1
+
+            max_renders = self.config.get('max_renders')
+
+            if self._recycle_reason is None and max_renders is not None and self._renders >= max_renders:
+                self._recycle_reason = (u'max_renders',
+                                        u'reached {} renders (max_renders {})'.format(self._renders, max_renders))
+
+            if self._has_resource_limits() and self._last_render_time >= self._next_resource_check:
+                self._check_due = True
+
+            if self._in_flight == 0 or self._recycle_reason is not None or self._check_due:
+                # Wake the monitor to check the resources, or recycle the renderer once drained
+                self._condition.notify_all()
+
+    def _has_resource_limits(self):
+        return self.config.get('max_rss_mb') is not None or self.config.get('max_disk_cache_mb') is not None
+
+    def _check_resources(self):
+        """
+        The (config key, description) of the resource budget the renderer has
+        exceeded, or None. Called by the monitor without holding the lock, as
+        measuring the disk cache walks the directory.
+        """
+        max_rss_mb = self.config.get('max_rss_mb')
+
+        if max_rss_mb is not None:
+            rss_mb = _process_rss_mb(getattr(self._delegate, 'pid', None))
+
+            if rss_mb is not None and rss_mb > max_rss_mb:
+                return u'max_rss_mb', u'has a resident memory of {:.1f} MB (max_rss_mb {})'.format(rss_mb, max_rss_mb)
+
+        max_disk_cache_mb = self.config.get('max_disk_cache_mb')
+
+        if max_disk_cache_mb is not None:
+            cache_path = _disk_cache_path(self.config.get('args', []))
+
+            if cache_path is not None:
+                cache_mb = _directory_size_mb(cache_path)
+
+                if cache_mb > max_disk_cache_mb:
+                    return u'max_disk_cache_mb', u'has a disk cache of {:.1f} MB (max_disk_cache_mb {})'.format(
+                        cache_mb, max_disk_cache_mb)
+
+        return None
+
+    def _check_lifetime(self, now):
+        """The (config key, description) of the idle or lifetime limit the renderer has reached, or None. Requires _condition."""
+
+        if self._in_flight == 0 and self._last_render_time is not None and \
+                now >= self._last_render_time + self.config['idle_shutdown_sec']:
+            return u'idle_shutdown_sec', u'is idle (idle_shutdown_sec {})'.format(self.config['idle_shutdown_sec'])
+
+        if self._start_time is not None and now >= self._start_time + self.config['max_lifetime_sec']:
+            return u'max_lifetime_sec', u'reached max lifetime (max_lifetime_sec {})'.format(self.config['max_lifetime_sec'])
+
+        return None
+
+    def _next_check(self, now):
+        """Seconds until the idle or lifetime limit could next be reached, or None to wait for a render. Requires _condition."""
+
+        targets = []
+
+        if self._in_flight == 0 and self._last_render_time is not None:
+            targets.append(self._last_render_time + self.config['idle_shutdown_sec'])
+
+        if self._start_time is not None:
+            targets.append(self._start_time + self.config['max_lifetime_sec'])
+
+        if len(targets) == 0:
+            return None
+
+        return max(0, min(targets) - now)
+
+    def _recycle(self, reason):
+        """Shutdown the delegate for the pending trigger, then admit renders again. Called by the monitor once drained."""
+
+        trigger, description = reason
+
+        self._logger.info(u"Shutting down renderer which {}.".format(description))
+        self.metrics.increment(u'restarts_total', labels={u'trigger': trigger})
+
+        try:
+            self._delegate.shutdown()
+
+            if trigger == u'max_disk_cache_mb' and self.config.get('clear_disk_cache'):
+                _clear_directory(_disk_cache_path(self.config.get('args', [])))
+        finally:
+            with self._condition:
+                self._recycle_reason = None
+                self._renders = 0
+                self._next_resource_check = 0
+                self._check_due = False
+                self._last_render_time = None
+                self._start_time = None
+                self._running = False
+                self._condition.notify_all()
 
     def _startup(self):
 
@@ -67,12 +237,12 @@ class Lifetime(Renderer):
 
     def shutdown(self, timeout=None):
 
-        self._running = False
-
         if self._condition is not None:
-            # Wake the monitor thread
+            # Wake the monitor thread, and any renders waiting on a recycle
             with self._condition:
-                self._condition.notify()
+                self._running = False
+                self._recycle_reason = None
+                self._condition.notify_all()
 
         if self._thread is not None:
             try:
@@ -84,46 +254,749 @@ class Lifetime(Renderer):
 
     def _lifetime_monitor(self):
 
-        while self._running:
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+
+                check_resources = self._check_due and self._recycle_reason is None
+                self._check_due = False
+
+                if check_resources:
+                    self._next_resource_check = time.time() + self.config.get('resource_check_sec', 0)
+
+            resource_reason = self._check_resources() if check_resources else None
+
+            with self._condition:
+                if not self._running:
+                    return
+
+                if self._recycle_reason is None:
+                    self._recycle_reason = resource_reason or self._check_lifetime(time.time())
+
+                if self._recycle_reason is None:
+                    if not self._check_due:
+                        self._condition.wait(self._next_check(time.time()))
+                    continue
+
+                if self._in_flight > 0:
+                    # Never shutdown underneath a render, new renders wait until these have drained
+                    self._condition.wait()
+                    continue
+
+                reason = self._recycle_reason
+
+            self._recycle(reason)
+            return
+
+
+def _process_rss_mb(pid):
+    """Resident memory of a process in MB, read from /proc/<pid>/status, or None if unavailable."""
+
+    if pid is None:
+        return None
+
+    try:
+        with open(u'/proc/{}/status'.format(pid), 'r') as status:
+            for line in status:
+                if line.startswith(u'VmRSS:'):
+                    return int(line.split()[1]) / 1024.0  # Reported in kB
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    return None
+
+
+def _disk_cache_path(args):
+    """The --disk-cache-path given in the PhantomJS command line arguments, or None."""
+
+    for i, arg in enumerate(args):
+        if arg.startswith(u'--disk-cache-path='):
+            return arg.split(u'=', 1)[1]
+        if arg == u'--disk-cache-path' and i + 1 < len(args):
+            return args[i + 1]
+
+    return None
+
+
+def _directory_size_mb(path):
+
+    total = 0
+
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+
+    return total / (1024.0 * 1024.0)
+
+
+def _clear_directory(path):
+    """Delete the contents of a directory, leaving the directory itself."""
+
+    if path is None or not os.path.isdir(path):
+        return
+
+    for name in os.listdir(path):
+        child = os.path.join(path, name)
+
+        if os.path.isdir(child) and not os.path.islink(child):
+            shutil.rmtree(child, ignore_errors=True)
+        else:
+            try:
+                os.remove(child)
+            except OSError:
+                pass
+
+
+class CachingRenderer(Renderer):
+    """
+    Wraps a Renderer instance and serves repeated renders from a cache.
+
+    Responses are keyed on a digest of the render() arguments which determine
+    the image (URL or HTML digest, size, format, user agent, headers, cookies
+    and proxy) and kept in an in-memory LRU, bounded by `cache_max_bytes`,
+    for up to `cache_ttl_sec`. When `cache_dir` is set the responses are also
+    written to disk, with each image stored once under the digest of its
+    content, so the cache survives restarts and is shared by processes using
+    the same directory.
+
+    The disk tier is pruned by prune_disk() on the first write and after
+    every tenth of `cache_disk_max_bytes` written since: expired responses
+    are removed, then the oldest responses while the tier is over budget,
+    then the images no response refers to.
+
+    Responses with a 'fail' status are only cached when `cache_failures` is
+    set.
+    """
+
+    # Rough allowance for the fields of a response other than the image
+    _ENTRY_OVERHEAD = 512
+
+    # Images younger than this are never pruned as unused, their response may still be being written
+    _IMAGE_GRACE_SEC = 60
+
+    def __init__(self, renderer):
+
+        self._delegate = renderer
+
+        self.config = copy.deepcopy(CACHE)
+        self.config.update(renderer.get_config())
+
+        self._entries = collections.OrderedDict()  # key -> (expires, size, response), least recently used first
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+        self._disk_written = None  # Bytes written to disk since the last prune, None before the first
+        self._prune_lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+        self._logger = logging.getLogger(u'CachingDecorator')
+
+    def get_config(self):
+        return self.config
+
+    @property
+    def stats(self):
+        """Counters for the cache, as a dict."""
+
+        with self._lock:
+            return {u'hits': self.hits,
+                    u'disk_hits': self.disk_hits,
+                    u'misses': self.misses,
+                    u'evictions': self.evictions,
+                    u'disk_evictions': self.disk_evictions,
+                    u'entries': len(self._entries),
+                    u'bytes': self._bytes}
+
+    def render(self, url, html=None, img_format='PNG', width=1280, height=1024, page_load_timeout=None, user_agent=None,
+               headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None):
+
+        key = render_key(url, html, img_format, width, height, user_agent, headers, cookies, html_encoding, http_proxy)
+
+        response = self._get(key)
+
+        if response is not None:
+            return response
+
+        response = self._delegate.render(url, html, img_format, width, height, page_load_timeout, user_agent, headers, cookies, html_encoding, http_proxy)
+
+        if response is not None and (response.get(u'status') != u'fail' or self.config['cache_failures']):
+            self._put(key, response)
+
+        return response
+
+    def shutdown(self, timeout=None):
+        self._delegate.shutdown(timeout)
+
+    @property
+    def ready(self):
+        return self._delegate.ready
+
+    def warmup(self):
+        return self._delegate.warmup()
+
+    def clear(self):
+        """Drop every response held in memory. The disk tier is left untouched."""
+
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _get(self, key):
+        """A copy of the cached response for the key, or None on a miss."""
+
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                expires, size, response = entry
+
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return response.copy()
+
+                self._discard(key)
+
+        expires, response = self._read_disk(key, now)
+
+        with self._lock:
+            if response is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.disk_hits += 1
+            self._store(key, response, expires)
+
+            return response.copy()
+
+    def _put(self, key, response):
+
+        expires = time.time() + self.config['cache_ttl_sec']
+        response = response.copy()
+
+        with self._lock:
+            self._store(key, response, expires)
+
+        if self.config['cache_dir'] is not None:
+            try:
+                written = self._write_disk(key, response, expires)
+            except (IOError, OSError):
+                self._logger.warning(u'Unable to write response to the disk cache.', exc_info=True)
+                return
+
+            with self._lock:
+                if self._disk_written is not None:
+                    self._disk_written += written
+
+                due = self._disk_written is None or self._disk_written >= self.config['cache_disk_max_bytes'] / 10
+
+            if due and self._prune_lock.acquire(False):
+                try:
+                    self.prune_disk()
+                except (IOError, OSError):
+                    self._logger.warning(u'Unable to prune the disk cache.', exc_info=True)
+                finally:
+                    self._prune_lock.release()
+
+    def prune_disk(self):
+        """
+        Remove the expired responses from the disk tier, then the oldest
+        responses while it is over `cache_disk_max_bytes`, and then the images
+        no response refers to.
+        :return: int, bytes removed
+        """
+        if self.config['cache_dir'] is None:
+            return 0
+
+        now = time.time()
+
+        with self._lock:
+            self._disk_written = 0
+
+        records = []  # (expires, path, size, image digest)
+
+        for path, size in self._disk_files(u'responses'):
+            try:
+                with open(path, 'rb') as record_file:
+                    record = json.loads(record_file.read().decode('utf-8'))
+
+                records.append((record[u'expires'], path, size, record[u'image']))
+
+            except (IOError, OSError):
+                continue  # Removed by another process
+            except (ValueError, KeyError, TypeError):
+                records.append((0, path, size, None))
+
+        records.sort(key=lambda record: record[0])
+
+        images = dict((os.path.basename(path), size) for path, size in self._disk_files(u'images'))
 
-            now = time.time()
-            sleep_delta = None
+        expired = [record for record in records if record[0] <= now]
+        live = records[len(expired):]
 
+        references = collections.Counter(record[3] for record in live if record[3] is not None)
+        total = sum(record[2] for record in live) + sum(images.get(digest, 0) for digest in references)
+
+        removed = expired
+
+        while live and total > self.config['cache_disk_max_bytes']:
+            record = live.pop(0)
+            removed.append(record)
+            total -= record[2]
+
+            if record[3] is not None:
+                references[record[3]] -= 1
+
+                if references[record[3]] == 0:
+                    del references[record[3]]
+                    total -= images.get(record[3], 0)
+
+        freed = 0
+
+        for _, path, size, _ in removed:
+            if self._remove(path):
+                freed += size
+
+        for digest, size in images.items():
+            path = self._disk_path(u'images', digest)
+
+            if digest not in references and self._age(path, now) > self._IMAGE_GRACE_SEC and self._remove(path):
+                freed += size
+
+        with self._lock:
+            self.disk_evictions += len(removed)
+
+        if removed:
+            self._logger.debug(u'Pruned {} responses, {} bytes, from the disk cache.'.format(len(removed), freed))
+
+        return freed
+
+    def _store(self, key, response, expires):
+        """Add the response to the in-memory LRU, evicting the oldest entries over budget. Requires _lock."""
+
+        size = self._response_size(response)
+
+        if size > self.config['cache_max_bytes']:
+            return
+
+        self._discard(key)
+        self._entries[key] = (expires, size, response)
+        self._bytes += size
+
+        while self._bytes > self.config['cache_max_bytes']:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def _discard(self, key):
+        """Requires _lock."""
+
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    @classmethod
+    def _response_size(cls, response):
+        """Approximate size of a response, from the image it already holds rather than by converting it."""
+
+        image = response.get(u'image')
+
+        if image is not None:
+            return cls._ENTRY_OVERHEAD + len(image)
+
+        return cls._ENTRY_OVERHEAD + len(response.get(u'base64') or u'')
+
+    def _disk_path(self, kind, digest):
+        return os.path.join(self.config['cache_dir'], kind, digest[:2], digest)
+
+    def _disk_files(self, kind):
+        """(path, size) of each file of the kind on disk, skipping those still being written."""
+
+        for directory, _, filenames in os.walk(os.path.join(self.config['cache_dir'], kind)):
+            for filename in filenames:
+                if filename.startswith(u'tmp'):
+                    continue
+
+                path = os.path.join(directory, filename)
+
+                try:
+                    yield path, os.path.getsize(path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _age(path, now):
+
+        try:
+            return now - os.path.getmtime(path)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _remove(path):
+        """True if the file was removed, False if it was already gone."""
+
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def _write_disk(self, key, response, expires):
+        """
+        Write the response record, and its image unless already stored.
+        :return: int, bytes written
+        """
+        # Everything but the image, which is stored separately
+        fields = dict((name, response[name]) for name in response if name not in (u'base64', u'image'))
+
+        record = {u'expires': expires, u'image': None, u'encoding': None, u'response': fields}
+
+        if response.get(u'image') is not None:
+            image_bytes = response[u'image']
+            record[u'encoding'] = u'binary'
+        elif response.get(u'base64') is not None:
+            image_bytes = base64.b64decode(response[u'base64'])
+            record[u'encoding'] = u'base64'
+        else:
+            image_bytes = None
+
+        record[u'response'][u'base64'] = None
+        written = 0
+
+        if image_bytes is not None:
+            digest = hashlib.sha256(image_bytes).hexdigest()
+            record[u'image'] = digest
+
+            image_path = self._disk_path(u'images', digest)
+
+            if not os.path.exists(image_path):
+                self._write_atomic(image_path, image_bytes)
+                written += len(image_bytes)
+
+        data = json.dumps(record).encode('utf-8')
+        self._write_atomic(self._disk_path(u'responses', key), data)
+
+        return written + len(data)
+
+    def _read_disk(self, key, now):
+        """(expires, response) from the disk tier, or (None, None) if absent or expired."""
+
+        if self.config['cache_dir'] is None:
+            return None, None
+
+        record_path = self._disk_path(u'responses', key)
+
+        try:
+            with open(record_path, 'rb') as record_file:
+                record = json.loads(record_file.read().decode('utf-8'))
+
+            if record[u'expires'] <= now:
+                os.remove(record_path)
+                return None, None
+
+            response = RenderResult.from_dict(record[u'response'])
+
+            if record[u'image'] is not None:
+                with open(self._disk_path(u'images', record[u'image']), 'rb') as image_file:
+                    image_bytes = image_file.read()
+
+                if record[u'encoding'] == u'binary':
+                    response[u'image'] = memoryview(image_bytes)
+                else:
+                    response[u'base64'] = base64.b64encode(image_bytes).decode('ascii')
+
+            return record[u'expires'], response
+
+        except (IOError, OSError, ValueError, KeyError):
+            return None, None
+
+    @staticmethod
+    def _write_atomic(path, data):
+
+        directory = os.path.dirname(path)
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(data)
+
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+
+class CoalescingRenderer(Renderer):
+    """
+    Wraps a Renderer instance so identical renders which arrive while one is
+    already in flight are not repeated.
+
+    The first caller performs the render, and every caller with the same
+    arguments (see renderer.render_key) waiting at the same time receives a
+    copy of its response, or the exception it raised. Once the render completes
+    the next identical request starts a new render, so this does no caching.
+    """
+
+    def __init__(self, renderer):
+
+        self._delegate = renderer
+        self._in_flight = {}  # key -> Event, sent (response, exception) when the render completes
+        self._lock = threading.RLock()
+
+        self.renders = 0
+        self.coalesced = 0
+
+    def get_config(self):
+        return self._delegate.get_config()
+
+    @property
+    def stats(self):
+        """Counters for the decorator, as a dict."""
+
+        with self._lock:
+            return {u'renders': self.renders,
+                    u'coalesced': self.coalesced,
+                    u'in_flight': len(self._in_flight)}
+
+    def render(self, url, html=None, img_format='PNG', width=1280, height=1024, page_load_timeout=None, user_agent=None,
+               headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None):
+
+        key = render_key(url, html, img_format, width, height, user_agent, headers, cookies, html_encoding, http_proxy)
+
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._in_flight[key] = Event()
+                self.renders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            response, error = call.wait()
+
+            if error is not None:
+                raise error
+
+            return response.copy() if response is not None else None
+
+        response, error = None, None
+
+        try:
+            response = self._delegate.render(url, html, img_format, width, height, page_load_timeout, user_agent, headers, cookies, html_encoding, http_proxy)
+            return response
+
+        except Exception as e:
+            error = e
+            raise
+
+        finally:
             with self._lock:
-                if self._last_render_time is not None:
-
-                    idle_target = self.config['idle_shutdown_sec'] + self._last_render_time
-
-                    if now >= idle_target:
-                        self._logger.info(u"Shutting down idle renderer.")
-
-                        self._last_render_time = None
-                        self._start_time = None
-                        self._delegate.shutdown()
-                        self._running = False
-                        break
-                    else:
-                        sleep_delta = idle_target - now
-
-                if self._start_time is not None:
-
-                    expired_target = self.config['max_lifetime_sec'] + self._start_time
-
-                    if now >= expired_target:
-                        self._logger.info(u"Shutting down renderer which reached max lifetime.")
-
-                        self._last_render_time = None
-                        self._start_time = None
-                        self._delegate.shutdown()
-                        self._running = False
-                        break
-                    else:
-                        if sleep_delta is not None:
-                            sleep_delta = min(sleep_delta, expired_target - now)
-                        else:
-                            sleep_delta = expired_target - now
-
-            if sleep_delta is not None:
-                with self._condition:
-                    if self._running:
-                        self._condition.wait(sleep_delta)
\ No newline at end of file
+                del self._in_flight[key]
+
+            call.send((response, error))
+
+    def shutdown(self, timeout=None):
+        self._delegate.shutdown(timeout)
+
+    @property
+    def ready(self):
+        return self._delegate.ready
+
+    def warmup(self):
+        return self._delegate.warmup()
+
+
+class HedgingRenderer(Renderer):
+    """
+    Wraps a Renderer instance and cuts tail latency by hedging slow renders.
+
+    When a render hasn't answered within the `hedge_percentile` of recent
+    successful render latencies (and at least `hedge_min_delay_sec`), a
+    duplicate render is sent to `hedge_renderer`. The first successful
+    response wins. The loser is left to finish and its response ignored, as
+    abandoning a PhantomJS render midway would cost its process a restart.
+
+    The hedge renderer must be a separate instance, e.g. a second
+    LambdaRenderer or RendererPool, as a hedge sent to the renderer it hedges
+    just waits behind the slow render. Without one, renders are passed
+    through unhedged.
+
+    Hedges are paid for from a budget which gains `hedge_max_rate` per render,
+    up to `hedge_burst`, so at most that fraction of renders add load.
+    Renders run on a pool of `hedge_max_workers` green threads, alongside the
+    green threads of the renderers they call, so a LambdaRenderer is only
+    hedged on time when eventlet has monkey patched the socket module.
+    """
+
+    def __init__(self, renderer, hedge_renderer=None, metrics=None):
+
+        self._delegate = renderer
+
+        if hedge_renderer is renderer:
+            hedge_renderer = None
+
+        self._hedge_delegate = hedge_renderer
+
+        if metrics is None:
+            metrics = getattr(renderer, 'metrics', None) or Metrics()
+
+        self.metrics = metrics
+
+        self.config = copy.deepcopy(HEDGE)
+        self.config.update(renderer.get_config())
+
+        if hedge_renderer is None:
+            logging.getLogger(u'HedgingDecorator').warning(u'No separate hedge_renderer, renders are not hedged.')
+
+        self._latencies = collections.deque(maxlen=self.config['hedge_window'])
+        self._budget = float(self.config['hedge_burst'])
+        self._lock = threading.RLock()
+        self._pool = eventlet.GreenPool(self.config['hedge_max_workers'])
+
+        self.renders = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def get_config(self):
+        return self.config
+
+    @property
+    def stats(self):
+        """Counters for the decorator, as a dict."""
+
+        with self._lock:
+            return {u'renders': self.renders,
+                    u'hedged': self.hedged,
+                    u'hedge_wins': self.hedge_wins,
+                    u'hedge_delay': self.hedge_delay()}
+
+    def hedge_delay(self):
+        """
+        Seconds a render may take before it is hedged.
+        :return: float, or None until `hedge_min_samples` latencies have been seen
+        """
+        latencies = sorted(self._latencies)
+
+        if len(latencies) < max(self.config['hedge_min_samples'], 1):
+            return None
+
+        rank = max(int(round(self.config['hedge_percentile'] / 100.0 * len(latencies) + 0.5)) - 1, 0)
+
+        return max(latencies[min(rank, len(latencies) - 1)], self.config['hedge_min_delay_sec'])
+
+    def render(self, url, html=None, img_format='PNG', width=1280, height=1024, page_load_timeout=None, user_agent=None,
+               headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None):
+
+        args = (url, html, img_format, width, height, page_load_timeout, user_agent, headers, cookies, html_encoding,
+                http_proxy)
+
+        with self._lock:
+            self.renders += 1
+            self._budget = min(self._budget + self.config['hedge_max_rate'], self.config['hedge_burst'])
+
+        delay = self.hedge_delay()
+
+        # (hedge, response, exception) of each attempt as it completes
+        results = LightQueue()
+        self._pool.spawn_n(self._attempt, self._delegate, args, False, results)
+        running = 1
+
+        # Hedge at most once, and not once the first render has failed
+        can_hedge = delay is not None and self._hedge_delegate is not None
+        failure = None
+
+        while running > 0:
+            try:
+                hedge, response, error = results.get(timeout=delay if can_hedge else None)
+            except Empty:
+                can_hedge = False
+
+                if self._spend_budget():
+                    self._pool.spawn_n(self._attempt, self._hedge_delegate, args, True, results)
+                    running += 1
+
+                continue
+
+            running -= 1
+            can_hedge = False
+
+            if error is None and response is not None and response.get(u'status') != u'fail':
+                if hedge:
+                    with self._lock:
+                        self.hedge_wins += 1
+
+                    self.metrics.increment(u'hedge_wins_total')
+
+                return response
+
+            if failure is None:
+                failure = (response, error)
+
+        response, error = failure
+
+        if error is not None:
+            raise error
+
+        return response
+
+    def shutdown(self, timeout=None):
+        self._delegate.shutdown(timeout)
+
+        if self._hedge_delegate is not None:
+            self._hedge_delegate.shutdown(timeout)
+
+    @property
+    def ready(self):
+        return self._delegate.ready
+
+    def warmup(self):
+        return self._delegate.warmup()
+
+    def _spend_budget(self):
+        """Take one hedge from the budget. :return: True if there was one to take."""
+
+        with self._lock:
+            if self._budget < 1:
+                self.metrics.increment(u'hedges_skipped_total')
+                return False
+
+            self._budget -= 1
+            self.hedged += 1
+
+        self.metrics.increment(u'hedges_total')
+        return True
+
+    def _attempt(self, renderer, args, hedge, results):
+        """Render on a green thread, putting the outcome on results and recording the latency of a success."""
+
+        start_time = time.time()
+
+        try:
+            response = renderer.render(*args)
+        except Exception as e:
+            results.put((hedge, None, e))
+            return
+
+        if response is not None and response.get(u'status') != u'fail':
+            self._latencies.append(time.time() - start_time)
+
+        results.put((hedge, response, None))
@@ -1,25 +1,47 @@
+import eventlet
+from eventlet import patcher, tpool
+from eventlet.queue import Queue
+
 import os, base64
+import collections
+import copy
+import hashlib
+import io
+import logging
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .result import RenderResult
+from .settings import IMAGE_WRITER, DERIVATIVES, CHANGE_DETECTION, merge
 
 
 def save_image(filename, render_response):
     """
     Saves the rendered image to a file.
-    
+
     :param filename: The full path and filename (without extension)
     :param render_response: The response object from the renderer
-    :return: True if the file was written, False otherwise
+    :return: True if the file was written, False otherwise, including for renders marked unchanged
     """
-    if render_response is not None and \
-       u'base64' in render_response and \
-       render_response[u'base64'] is not None:
+    if render_response is None or render_response.get(u'unchanged'):
+        return False
 
-        image_base64 = render_response[u'base64']
-        image_bytes = base64.decodebytes(image_base64.encode('utf-8', errors='replace'))
+    image_bytes = _image_bytes(render_response)
 
-        image_format = render_response[u'format']
+    if image_bytes is not None:
 
-        file_path = u'{file}.{format}'.format(file=filename,
-                                              format=image_format.lower())
+        file_path = _image_path(filename, render_response)
 
         directory, filename = os.path.split(file_path)
 
@@ -32,3 +54,577 @@ def save_image(filename, render_response):
         return True
 
     return False
+
+
+class ImageWriter(object):
+    """
+    Saves rendered images in the background, so renders aren't held up by
+    disk I/O.
+
+    write() puts a response on a bounded queue, blocking only while the queue
+    is full, and `writer_threads` workers decode and write the images on
+    eventlet's OS thread pool. Files are written to a temporary name and
+    renamed into place, so a reader never sees a partial image.
+
+    With `dedupe` set to 'hardlink' or 'symlink', each distinct image is
+    stored once under `store_dir`, named by its SHA-256 and sharded into
+    subdirectories by the first two bytes of the hash, and every filename
+    written is a link to the stored image. Hardlinks fall back to a copy when
+    `store_dir` is on another filesystem.
+
+    Writes are left for the OS to flush unless `fsync_batch` is set, in which
+    case the written files and their directories are synced in batches of
+    that many files, and whatever remains is synced by flush() and close().
+    """
+
+    def __init__(self, config=None, logger=None):
+
+        self.config = copy.deepcopy(IMAGE_WRITER)
+
+        if config is not None:
+            self.config = merge(self.config, config)
+
+        if self.config[u'dedupe'] not in (None, u'hardlink', u'symlink'):
+            raise ValueError(u"dedupe must be None, 'hardlink' or 'symlink'")
+
+        if self.config[u'dedupe'] is not None and self.config[u'store_dir'] is None:
+            raise ValueError(u'store_dir is required to dedupe images')
+
+        if logger is not None:
+            self._logger = logger
+        else:
+            self._logger = logging.getLogger(u'ImageWriter')
+
+        self.files = 0
+        self.deduplicated = 0
+        self.bytes_written = 0
+        self.errors = 0
+
+        self._unsynced = []
+        self._queue = Queue(self.config[u'max_queue_size'])
+        self._workers = [eventlet.spawn(self._worker) for _ in range(self.config[u'writer_threads'])]
+        self._closed = False
+
+    @property
+    def queue_depth(self):
+        """Number of images waiting to be written."""
+        return self._queue.qsize()
+
+    @property
+    def stats(self):
+        return {
+            u'queue_depth': self.queue_depth,
+            u'files': self.files,
+            u'deduplicated': self.deduplicated,
+            u'dedupe_ratio': float(self.deduplicated) / self.files if self.files else 0.0,
+            u'bytes_written': self.bytes_written,
+            u'errors': self.errors
+        }
+
+    def write(self, filename, render_response):
+        """
+        Queue the image of a response to be saved, like save_image().
+        :param filename: The full path and filename (without extension)
+        :param render_response: The response object from the renderer
+        :return: True if the image was queued, False if the response has no image or is marked unchanged
+        """
+        if self._closed:
+            raise ValueError(u'ImageWriter is closed')
+
+        if render_response is None or render_response.get(u'unchanged') or not _has_image(render_response):
+            return False
+
+        self._queue.put((filename, render_response))
+        return True
+
+    def flush(self):
+        """Wait for every queued image to be written, and synced if fsync_batch is set."""
+
+        self._queue.join()
+
+        if self._unsynced:
+            self._sync()
+
+    def close(self):
+        """Write the remaining images and stop the workers."""
+
+        if self._closed:
+            return
+
+        self.flush()
+        self._closed = True
+
+        for _ in self._workers:
+            self._queue.put(None)
+
+        for worker in self._workers:
+            worker.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _worker(self):
+
+        while True:
+            item = self._queue.get()
+
+            try:
+                if item is None:
+                    return
+
+                filename, render_response = item
+
+                try:
+                    paths, written, deduplicated = tpool.execute(self._save, filename, render_response)
+                except Exception:
+                    self.errors += 1
+                    self._logger.exception(u'Unable to write image for {}.'.format(filename))
+                    continue
+
+                self.files += 1
+                self.bytes_written += written
+                self.deduplicated += int(deduplicated)
+
+                if self.config[u'fsync_batch'] > 0:
+                    self._unsynced.extend(paths)
+
+                    if len(self._unsynced) >= self.config[u'fsync_batch']:
+                        self._sync()
+            finally:
+                self._queue.task_done()
+
+    def _save(self, filename, render_response):
+        """
+        Decode and write one image. Runs on an OS thread.
+        :return: (paths written, bytes written, True if the image was already stored)
+        """
+        image = _image_bytes(render_response)
+        path = _image_path(filename, render_response)
+
+        os.makedirs(os.path.dirname(path) or u'.', exist_ok=True)
+
+        if self.config[u'dedupe'] is None:
+            _write_atomic(path, image)
+            return [path], len(image), False
+
+        digest = hashlib.sha256(image).hexdigest()
+        extension = os.path.splitext(path)[1]
+        stored = os.path.join(self.config[u'store_dir'], digest[:2], digest[2:4], digest + extension)
+
+        paths = [path]
+        written = 0
+        deduplicated = os.path.exists(stored)
+
+        if not deduplicated:
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            deduplicated = not _store_once(stored, image)
+
+            if not deduplicated:
+                paths.append(stored)
+                written = len(image)
+
+        if not self._link(stored, path):
+            _write_atomic(path, image)
+            written += len(image)
+
+        return paths, written, deduplicated
+
+    def _link(self, stored, path):
+        """Replace path with a link to the stored image. :return: False if the link could not be made."""
+
+        temp_path = _temp_path(path)
+
+        try:
+            if self.config[u'dedupe'] == u'symlink':
+                os.symlink(os.path.relpath(stored, os.path.dirname(path) or u'.'), temp_path)
+            else:
+                os.link(stored, temp_path)
+
+        except OSError:
+            # e.g. store_dir is on a different filesystem, or the file has too many links
+            return False
+
+        os.replace(temp_path, path)
+        return True
+
+    def _sync(self):
+
+        paths, self._unsynced = self._unsynced, []
+
+        try:
+            tpool.execute(_fsync_paths, paths)
+        except OSError:
+            self.errors += 1
+            self._logger.exception(u'Unable to sync written images.')
+
+
+class DerivativePipeline(object):
+    """
+    Produces the configured derivatives of rendered images, such as
+    thumbnails and smaller WebP or JPEG versions, in a pool of worker
+    processes so the resizing and encoding uses every core and never holds
+    up the renderers.
+
+    Each image is decoded once per response, however many derivatives are
+    configured. Every derivative fits within its `width` and `height`, keeping
+    the aspect ratio and never enlarging, and is encoded to its `format` at
+    its `quality`. By default the encoded derivatives are returned in the
+    response, otherwise they are written next to a given filename.
+
+    Requires Pillow: pip install phantom-snap[derivatives]
+    """
+
+    def __init__(self, config=None, logger=None):
+
+        if Image is None:
+            raise ImportError(u'DerivativePipeline requires Pillow: pip install phantom-snap[derivatives]')
+
+        self.config = copy.deepcopy(DERIVATIVES)
+
+        if config is not None:
+            self.config = merge(self.config, config)
+
+        self._specs = []
+
+        for derivative in self.config[u'derivatives']:
+            if u'name' not in derivative:
+                raise ValueError(u'Every derivative requires a name')
+
+            spec = {u'width': None, u'height': None, u'format': u'JPEG', u'quality': 85}
+            spec.update(derivative)
+            spec[u'format'] = spec[u'format'].upper()
+            self._specs.append(spec)
+
+        if logger is not None:
+            self._logger = logger
+        else:
+            self._logger = logging.getLogger(u'DerivativePipeline')
+
+        # Spawned rather than forked, as forking copies the state of the eventlet hub
+        self._executor = ProcessPoolExecutor(max_workers=self.config[u'processes'],
+                                             mp_context=multiprocessing.get_context(u'spawn'))
+
+    def submit(self, render_response, filename=None):
+        """
+        Start producing the derivatives of a response's image.
+        :param render_response: The response object from the renderer
+        :param filename: The full path and filename (without extension) to write the derivatives next to, which
+                         are then named <filename>.<name>.<format>. When None they are returned instead.
+        :return: concurrent.futures.Future of the derivatives dict, or None if the response has no image
+        """
+        if render_response is None or not _has_image(render_response):
+            return None
+
+        return self._executor.submit(_make_derivatives, bytes(_image_bytes(render_response)), self._specs, filename)
+
+    def process(self, render_response, filename=None):
+        """
+        Produce the derivatives of a response and add them to it under 'derivatives', a dict of
+        derivative name to its 'format', 'width', 'height', 'size' and either the 'image' bytes or
+        the 'path' written.
+        :param render_response: The response object from the renderer
+        :param filename: See submit()
+        :return: render_response
+        """
+        future = self.submit(render_response, filename)
+
+        if future is not None:
+            render_response[u'derivatives'] = _wait(future)
+
+        return render_response
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+class ChangeDetector(object):
+    """
+    Marks renders which look the same as the last image stored for their URL,
+    so they can be skipped by save_image(), ImageWriter and other consumers.
+
+    check() computes a perceptual hash of the rendered image, either a
+    difference hash ('dhash') or a DCT based hash ('phash') of a small
+    grayscale version, and compares it with the hash remembered for the URL.
+    When the Hamming distance between them is within `threshold` the response
+    is marked 'unchanged'. Otherwise it is marked as changed and its hash
+    replaces the remembered one, so a page which drifts slowly is still
+    stored once it has drifted far enough.
+
+    The hashes are remembered in memory for up to `max_urls` URLs, or in any
+    dict-like `index` given, e.g. a shelve to keep them across restarts.
+
+    Requires Pillow and NumPy: pip install phantom-snap[change_detection]
+    """
+
+    def __init__(self, config=None, index=None, logger=None):
+
+        if Image is None or numpy is None:
+            raise ImportError(u'ChangeDetector requires Pillow and NumPy: pip install phantom-snap[change_detection]')
+
+        self.config = copy.deepcopy(CHANGE_DETECTION)
+
+        if config is not None:
+            self.config = merge(self.config, config)
+
+        if self.config[u'hash'] not in (u'dhash', u'phash'):
+            raise ValueError(u"hash must be 'dhash' or 'phash'")
+
+        self._lru = index is None
+        self._index = collections.OrderedDict() if index is None else index
+
+        if logger is not None:
+            self._logger = logger
+        else:
+            self._logger = logging.getLogger(u'ChangeDetector')
+
+        self.checked = 0
+        self.unchanged = 0
+
+    @property
+    def stats(self):
+        return {
+            u'checked': self.checked,
+            u'unchanged': self.unchanged,
+            u'urls': len(self._index)
+        }
+
+    def hash(self, render_response):
+        """
+        The perceptual hash of a response's image.
+        :param render_response: The response object from the renderer
+        :return: int, or None if the response has no image
+        """
+        if render_response is None or not _has_image(render_response):
+            return None
+
+        # Pillow releases the GIL while decoding and resizing, so hash on an OS thread
+        return tpool.execute(_perceptual_hash, _image_bytes(render_response), self.config[u'hash'],
+                             self.config[u'hash_size'])
+
+    def check(self, render_response, key=None):
+        """
+        Mark a response 'unchanged' (True or False) by comparing it with the last image stored for its URL,
+        and record its hash as 'perceptual_hash'. Responses without an image are returned unmarked.
+        :param render_response: The response object from the renderer
+        :param key: Index key for the response, defaults to its URL
+        :return: render_response
+        """
+        try:
+            image_hash = self.hash(render_response)
+        except (IOError, OSError, ValueError):
+            self._logger.warning(u'Unable to hash the image of {}.'.format(render_response.get(u'url')), exc_info=True)
+            return render_response
+
+        if image_hash is None:
+            return render_response
+
+        if key is None:
+            key = render_response[u'url']
+
+        previous = self._index.get(key)
+        unchanged = previous is not None and bin(previous ^ image_hash).count(u'1') <= self.config[u'threshold']
+
+        if not unchanged:
+            self._index[key] = image_hash
+
+        if self._lru:
+            self._index.move_to_end(key)
+
+            while len(self._index) > self.config[u'max_urls']:
+                self._index.popitem(last=False)
+
+        self.checked += 1
+        self.unchanged += int(unchanged)
+
+        render_response[u'perceptual_hash'] = u'{:0{}x}'.format(image_hash, (self.config[u'hash_size'] ** 2 + 3) // 4)
+        render_response[u'unchanged'] = unchanged
+
+        return render_response
+
+    def forget(self, key):
+        """Drop the hash remembered for a URL (or key), so its next render counts as changed."""
+        self._index.pop(key, None)
+
+
+def _perceptual_hash(image, method, hash_size):
+    """Hash an encoded image to an int of hash_size * hash_size bits."""
+
+    grayscale = Image.open(io.BytesIO(image)).convert(u'L')
+
+    if method == u'dhash':
+        # One extra column, so each bit compares a pixel with its right hand neighbour
+        pixels = numpy.asarray(grayscale.resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=numpy.int16)
+        bits = pixels[:, 1:] > pixels[:, :-1]
+
+    else:
+        size = hash_size * 4
+        pixels = numpy.asarray(grayscale.resize((size, size), Image.LANCZOS), dtype=numpy.float64)
+
+        # Two dimensional DCT-II as a pair of matrix products, keeping the lowest frequencies
+        k = numpy.arange(size)
+        dct = numpy.cos(numpy.pi * (2 * k[numpy.newaxis, :] + 1) * k[:, numpy.newaxis] / (2.0 * size))
+        low = dct.dot(pixels).dot(dct.T)[:hash_size, :hash_size]
+
+        bits = low > numpy.median(low)
+
+    return int.from_bytes(numpy.packbits(bits.flatten()).tobytes(), 'big') >> ((-bits.size) % 8)
+
+
+def _make_derivatives(image, specs, filename):
+    """Decode an image once and encode each derivative of it. Runs in a worker process."""
+
+    source = Image.open(io.BytesIO(image))
+    source.load()
+
+    derivatives = {}
+
+    for spec in specs:
+        derivative = source.copy()
+
+        if spec[u'width'] is not None or spec[u'height'] is not None:
+            derivative.thumbnail((spec[u'width'] or source.width, spec[u'height'] or source.height), Image.LANCZOS)
+
+        if spec[u'format'] == u'JPEG' and derivative.mode not in (u'RGB', u'L'):
+            derivative = derivative.convert(u'RGB')
+
+        buffer = io.BytesIO()
+        derivative.save(buffer, format=spec[u'format'], quality=spec[u'quality'])
+        data = buffer.getvalue()
+
+        result = {u'format': spec[u'format'], u'width': derivative.width, u'height': derivative.height,
+                  u'size': len(data)}
+
+        if filename is None:
+            result[u'image'] = data
+        else:
+            path = u'{}.{}.{}'.format(filename, spec[u'name'], spec[u'format'].lower())
+            os.makedirs(os.path.dirname(path) or u'.', exist_ok=True)
+            _write_atomic(path, data)
+            result[u'path'] = path
+
+        derivatives[spec[u'name']] = result
+
+    return derivatives
+
+
+def _wait(future):
+    """Wait for a future without blocking other green threads."""
+
+    if patcher.is_monkey_patched(u'thread'):
+        return future.result()
+
+    # The future's lock is a real one, so wait for it on an OS thread
+    return tpool.execute(future.result)
+
+
+def _has_image(render_response):
+
+    if isinstance(render_response, RenderResult):
+        return render_response.has_image
+
+    return render_response.get(u'image') is not None or render_response.get(u'base64') is not None
+
+
+def _image_bytes(render_response):
+    """The raw image of a response, or None."""
+
+    if isinstance(render_response, RenderResult):
+        # Decodes any base64 image once, without a round trip through an encoded copy
+        return render_response.image
+
+    if render_response.get(u'image') is not None:
+        return render_response[u'image']
+
+    if render_response.get(u'base64') is not None:
+        image_base64 = render_response[u'base64']
+        return base64.decodebytes(image_base64.encode('utf-8', errors='replace'))
+
+    return None
+
+
+def _image_path(filename, render_response):
+
+    image_format = render_response[u'format']
+
+    return u'{file}.{format}'.format(file=filename, format=image_format.lower())
+
+
+def _temp_path(path):
+    return u'{}.{}.tmp'.format(path, uuid.uuid4().hex)
+
+
+def _write_atomic(path, data):
+
+    temp_path = _temp_path(path)
+
+    # Created like open() would, so the image gets the usual umask based permissions
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _store_once(path, data):
+    """
+    Atomically create a file unless it already exists, so concurrent writers of the same image store it once.
+    :return: True if this call created the file
+    """
+    temp_path = _temp_path(path)
+
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(data)
+
+    try:
+        os.link(temp_path, path)
+        return True
+    except FileExistsError:
+        return False
+    except OSError:
+        # The filesystem doesn't support hardlinks
+        os.replace(temp_path, path)
+        return True
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _fsync_paths(paths):
+    """fsync each file, then each directory holding them so the renames are durable too."""
+
+    directories = set()
+
+    for path in paths:
+        # A symlink is synced through its directory, which holds it
+        if not os.path.islink(path):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        directories.add(os.path.dirname(path) or u'.')
+
+    for directory in directories:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -1,26 +1,131 @@
-from .renderer import Renderer
+from .renderer import Renderer, split_request, tag_response
+from .protocol import failed_response
+from .lambda_schema import RESULT_HEADER, BINARY_MEDIA_TYPE
+from .result import RenderResult
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException, \
                                 ConnectionError, \
                                 Timeout, \
                                 TooManyRedirects
 import base64
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import copy
+import gzip
+import json
 import logging
+import threading
+from .metrics import Metrics
 from .settings import LAMBDA, merge
 import traceback
 import time
 
+# Status codes meaning the endpoint is overloaded or throttling, rather than the render failing
+OVERLOAD_STATUS_CODES = (429, 502, 503, 504)
+
+# Of those, the status codes asking the client to come back later, so the request is retried
+RETRY_STATUS_CODES = (429, 503)
+
+# Why a request signalled that the endpoint is overloaded
+THROTTLED = u'throttled'  # A retry status code, retried with backoff
+TIMED_OUT = u'timed_out'  # Retried only before the request's deadline
+OVERLOADED = u'overloaded'  # Another overload status code or a connection error, not retried
+
+
+class AdaptiveLimit(object):
+    """
+    Concurrency limit which adapts to the endpoint, AIMD style.
+
+    Every request completed in time adds `increase` spread over the current
+    limit, so the limit grows by about `increase` per round trip. A
+    throttled, overloaded or timed out request, or one slower than
+    `latency_target_sec`, multiplies the limit by `decrease_factor`. Requests
+    which were sent before the last decrease are ignored when they report
+    trouble, so a burst of failures from one overloaded moment only backs
+    off once.
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+        self._lock = threading.Lock()
+        self._limit = float(config['initial_concurrency'])
+        self._last_decrease = 0
+
+    @property
+    def value(self):
+        """The current limit, as a whole number of requests."""
+        return max(int(self._limit), self.config['min_concurrency'])
+
+    def success(self, start_time, latency):
+        """
+        Record a completed request.
+        :param start_time: time.time() the request was sent
+        :param latency: Seconds taken
+        """
+        target = self.config['latency_target_sec']
+
+        if target is not None and latency > target:
+            self.overload(start_time)
+            return
+
+        with self._lock:
+            self._limit = min(self._limit + float(self.config['increase']) / max(self._limit, 1),
+                              self.config['max_concurrency'])
+
+    def overload(self, start_time):
+        """
+        Record a throttled or failed request.
+        :param start_time: time.time() the request was sent
+        """
+        with self._lock:
+            if start_time < self._last_decrease:
+                return
+
+            self._limit = max(self._limit * self.config['decrease_factor'], self.config['min_concurrency'])
+            self._last_decrease = time.time()
+
+
 class LambdaRenderer(Renderer):
     """Offloads the rendering process to a PhantomJSRenderer
     running inside of AWS Lambda
+
+    Requests are sent over a keep-alive connection pool owned by the
+    renderer, sized by `pool_connections` and `pool_maxsize`, so renders
+    don't pay a new TCP and TLS handshake each time. Compressed responses are
+    accepted, and with `compress_requests` large request bodies are sent
+    gzipped. With `binary_responses` the endpoint is asked to return the raw
+    image, which is returned under 'image' as in PhantomJSRenderer's
+    binary_images mode. Either response shape is accepted.
+
+    render_many() keeps many requests in flight at once, on a thread pool
+    (green threads when eventlet has monkey patched threading). The number in
+    flight follows `limit`, an AdaptiveLimit shared by all calls, and each
+    request can carry a 'deadline'. render_batches() packs requests into
+    batches for the handler's render_batch endpoint.
+
+    Request latency, response and image sizes, timeouts and failures are
+    recorded on `metrics`.
     """
 
-    def __init__(self, config, logger=None):
+    def __init__(self, config, logger=None, metrics=None):
 
         self.config = copy.deepcopy(LAMBDA)
         self.config = merge(self.config, config)
 
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        adapter = HTTPAdapter(pool_connections=self.config['pool_connections'],
+                              pool_maxsize=self.config['pool_maxsize'],
+                              max_retries=self.config['max_retries'])
+
+        self._session = requests.Session()
+        self._session.headers['accept-encoding'] = 'gzip, deflate'
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+        self.limit = AdaptiveLimit(self.config['fan_out'])
+
         if logger is not None:
             self._logger = logger
         else:
@@ -90,8 +195,21 @@ class LambdaRenderer(Renderer):
                 self.config['api_key'] is not None:
             h_dict['x-api-key'] = self.config['api_key']
 
+        if self.config['binary_responses']:
+            h_dict['accept'] = '{}, application/json'.format(BINARY_MEDIA_TYPE)
+
         return h_dict
 
+    def _prep_body(self, json_dict, request_headers):
+        """Encodes the request body, compressing it if configured"""
+        body = json.dumps(json_dict).encode('utf-8')
+
+        if self.config['compress_requests'] and len(body) >= self.config['compress_min_bytes']:
+            body = gzip.compress(body, compresslevel=6)
+            request_headers['content-encoding'] = 'gzip'
+
+        return body
+
     def _prep_timeout(self):
         """Preps the request timeout to lambda"""
         return self.config['timeouts']['request_timeout']
@@ -113,6 +231,248 @@ class LambdaRenderer(Renderer):
         :param html_encoding:
         :return dict:
         """
+        return self._render(self._prep_timeout(), url, html=html, img_format=img_format, width=width,
+                            height=height, page_load_timeout=page_load_timeout, user_agent=user_agent,
+                            headers=headers, cookies=cookies, html_encoding=html_encoding,
+                            http_proxy=http_proxy)[0]
+
+    def render_many(self, requests, concurrency=None):
+        """
+        Render a stream of requests, yielding each response as soon as it completes.
+
+        The number of requests in flight is the adaptive `limit`, capped by
+        `concurrency`. A request may hold a 'deadline', the time.time() by
+        which its response is needed, otherwise `fan_out.deadline_sec` after
+        it is taken from `requests` when configured. A request whose deadline
+        passes fails without being sent, and its request timeout is cut to
+        the time remaining.
+        :param requests: Iterable of dicts holding the render() keyword arguments, plus optional 'id' and 'deadline'
+        :param concurrency: Max number of requests in flight, defaults to fan_out.max_concurrency
+        :return: Generator of response dicts, each tagged with the 'id' of its request
+        """
+        return self._fan_out(self._request_items(requests), self._render_request, concurrency)
+
+    def render_batches(self, requests, concurrency=None):
+        """
+        Render a stream of requests, packed into batches sent to the
+        handler's render_batch endpoint, yielding each response as its batch
+        completes.
+
+        Batches hold up to `max_batch_size` requests and `max_batch_bytes` of
+        encoded requests, so each Lambda invocation is paid for once per
+        batch rather than once per URL. Batches are sent like the requests of
+        render_many(), and a batch's deadline is the earliest of its requests'.
+        :param requests: Iterable of dicts holding the render() keyword arguments, plus optional 'id' and 'deadline'
+        :param concurrency: Max number of batches in flight, defaults to fan_out.max_concurrency
+        :return: Generator of response dicts, each tagged with the 'id' of its request
+        """
+        for responses in self._fan_out(self._pack(self._request_items(requests)), self._render_batch, concurrency):
+            for response in responses:
+                yield response
+
+    def _request_items(self, requests):
+        """Generate (request id, render() kwargs, deadline) for each request, as it is taken"""
+        deadline_sec = self.config['fan_out']['deadline_sec']
+
+        for index, request in enumerate(requests):
+            request_id, kwargs = split_request(request, index)
+
+            deadline = kwargs.pop(u'deadline', None)
+            if deadline is None and deadline_sec is not None:
+                deadline = time.time() + deadline_sec
+
+            yield request_id, kwargs, deadline
+
+    def _pack(self, items):
+        """Group request items into batches within max_batch_size and max_batch_bytes"""
+        batch = []
+        batch_bytes = 0
+
+        for request_id, kwargs, deadline in items:
+            json_dict = self._prep_json(**self._json_kwargs(kwargs))
+            size = len(json.dumps(json_dict))
+
+            if batch and (len(batch) >= self.config['max_batch_size'] or
+                          batch_bytes + size > self.config['max_batch_bytes']):
+                yield batch
+                batch = []
+                batch_bytes = 0
+
+            batch.append((request_id, kwargs, deadline, json_dict))
+            batch_bytes += size
+
+        if batch:
+            yield batch
+
+    def _fan_out(self, items, call, concurrency):
+        """Run call(item) for every item on the thread pool, with up to the adaptive limit in flight"""
+        if concurrency is None:
+            concurrency = self.config['fan_out']['max_concurrency']
+
+        if concurrency < 1:
+            raise ValueError(u'concurrency must be at least 1')
+
+        pending = set()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                while len(pending) < min(self.limit.value, concurrency):
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+
+                    pending.add(executor.submit(call, item))
+
+                if not pending:
+                    return
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield future.result()
+
+    def _send(self, send, deadline):
+        """
+        Call send(timeout), retrying throttled attempts, and timed out attempts of a request with a deadline,
+        while the deadline allows. Any overload lowers the concurrency limit.
+        :param send: Function of the request timeout returning (result, why the endpoint was overloaded or None)
+        :param deadline: time.time() the result is needed by, or None
+        :return: The result, or None when the deadline passed before it could be sent
+        """
+        fan_out = self.config['fan_out']
+        attempt = 0
+
+        while True:
+            timeout = self._prep_timeout()
+
+            if deadline is not None:
+                remaining = deadline - time.time()
+
+                if remaining <= 0:
+                    self.metrics.increment(u'deadlines_exceeded_total')
+                    return None
+
+                timeout = min(timeout, remaining)
+
+            start_time = time.time()
+            result, overload = send(timeout)
+
+            if overload is None:
+                self.limit.success(start_time, time.time() - start_time)
+                return result
+
+            self.limit.overload(start_time)
+
+            if overload == THROTTLED:
+                self.metrics.increment(u'throttled_total')
+            elif overload != TIMED_OUT or deadline is None:
+                return result
+
+            if attempt >= fan_out['throttle_retries']:
+                return result
+
+            backoff = fan_out['retry_backoff_sec'] * 2 ** attempt
+            if deadline is not None and time.time() + backoff >= deadline:
+                return result
+
+            attempt += 1
+            time.sleep(backoff)
+
+    def _render_request(self, item):
+        """Render one request of render_many()"""
+        request_id, kwargs, deadline = item
+
+        def send(timeout):
+            try:
+                return self._render(timeout, **kwargs)
+            except Exception:
+                return failed_response(kwargs.get(u'url'), kwargs.get(u'img_format', u'PNG'),
+                                       traceback.format_exc()), None
+
+        response = self._send(send, deadline)
+
+        if response is None:
+            response = failed_response(kwargs.get(u'url'), kwargs.get(u'img_format', u'PNG'),
+                                       u'Deadline exceeded before the request was sent.')
+
+        return tag_response(response, request_id, kwargs)
+
+    def _render_batch(self, batch):
+        """Render one batch of render_batches(), returning the tagged responses in request order"""
+        deadlines = [deadline for _, _, deadline, _ in batch if deadline is not None]
+
+        def send(timeout):
+            try:
+                return self._post_batch(timeout, [json_dict for _, _, _, json_dict in batch])
+            except Exception:
+                return [traceback.format_exc()] * len(batch), None
+
+        responses = self._send(send, min(deadlines) if deadlines else None)
+
+        if responses is None:
+            responses = [u'Deadline exceeded before the request was sent.'] * len(batch)
+
+        tagged = []
+
+        for (request_id, kwargs, _, _), response in zip(batch, responses):
+            # Requests which failed as a whole have the error in place of a response
+            if response is None or not isinstance(response, RenderResult):
+                response = failed_response(kwargs.get(u'url'), kwargs.get(u'img_format', u'PNG'), response)
+
+            tagged.append(tag_response(response, request_id, kwargs))
+
+        return tagged
+
+    def _post_batch(self, timeout, json_dicts):
+        """
+        Send one render_batch request.
+        :param timeout: Request timeout in seconds
+        :return: ([RenderResult, or the error when it has none, for each request],
+                  why the endpoint was overloaded, or None)
+        """
+        batch_url = self.config['batch_url'] or self.config['url'].rstrip('/') + '/batch'
+        json_dict = {'requests': [dict(request, id=index) for index, request in enumerate(json_dicts)]}
+
+        result = None
+        try:
+            result = self._post(batch_url, json_dict, timeout)
+            json_result = result.json()
+
+            if not isinstance(json_result, dict):
+                raise ValueError(u'The batch response must be a JSON object')
+        except (ValueError, ConnectionError, Timeout,
+                TooManyRedirects, RequestException) as e:
+            overload = self._request_failed(e, result)
+            return [traceback.format_exc()] * len(json_dicts), overload
+
+        if result.status_code != 200:
+            self._logger.warning("Received unexpected {} status code from lambda".format(result.status_code))
+            self.metrics.increment(u'request_errors_total', labels={u'reason': u'status_{}'.format(result.status_code)})
+            error = json_result.get('ex', json_result.get('message')) if isinstance(json_result, dict) else None
+            return [error] * len(json_dicts), self._overload(result.status_code)
+
+        responses = [u'No result for the request in the batch response.'] * len(json_dicts)
+
+        for item in json_result.get('results', []):
+            if not isinstance(item, dict):
+                continue
+
+            index = item.pop('id', None)
+
+            if isinstance(index, int) and 0 <= index < len(responses):
+                responses[index] = self._received(RenderResult.from_dict(item))
+
+        return responses, None
+
+    def _render(self, timeout, url, html=None, img_format='PNG', width=1280, height=1024,
+                page_load_timeout=None, user_agent=None, headers=None, cookies=None, html_encoding=u'utf-8',
+                http_proxy=None):
+        """
+        Send one render request.
+        :param timeout: Request timeout in seconds
+        :return: (response dict, why the endpoint was overloaded, or None)
+        """
         # prep request
         json_dict = self._prep_json(url=url,
                                     html=html,
@@ -125,57 +485,112 @@ class LambdaRenderer(Renderer):
                                     cookies=cookies,
                                     html_encoding=html_encoding,
                                     http_proxy=http_proxy)
-        request_headers = self._prep_headers()
-        timeout = self._prep_timeout()
 
         # send it
+        result = None
         try:
-            self._logger.info("Sending lambda request {} {} {} {}".format(url, json_dict, request_headers, timeout))
-            start_time = time.time()
-            result = requests.post(url=self.config['url'],
-                                   json=json_dict,
-                                   headers=request_headers,
-                                   allow_redirects=True,
-                                   timeout=timeout)
-            self._logger.info("Request took {}s".format(time.time() - start_time))
-
-            # valid response should be json
-            json_result = result.json()
-            json_copy = copy.deepcopy(json_result)
-            if 'base64' in json_copy and json_copy['base64'] is not None:
-                json_copy['base64'] = '<omitted>'
-            self._logger.debug("Received data from lambda {}".format(json_copy))
+            result = self._post(self.config['url'], json_dict, timeout)
+
+            # valid response should be json, or a binary response
+            json_result = self._decode_result(result)
+            self._logger.debug("Received data from lambda {}".format(json_result.redacted()))
         except (ValueError, ConnectionError, Timeout,
                 TooManyRedirects, RequestException) as e:
-            self._logger.error("Exception while calling lambda {}".format(traceback.format_exc()))
-            return {
-                u'url': url,
-                u'status': u'fail',
-                u'load_time': None,
-                u'paint_time': None,
-                u'base64': None,
-                u'format': img_format,
-                u'error': traceback.format_exc(),
-            }
+            overload = self._request_failed(e, result)
+            return failed_response(url, img_format, traceback.format_exc()), overload
 
         # handle error within lambda function
         if result.status_code != 200:
             self._logger.warning("Received unexpected {} status code from lambda".format(result.status_code))
-            response = {
-                u'url': url,
-                u'status': u'fail',
-                u'load_time': None,
-                u'paint_time': None,
-                u'base64': None,
-                u'format': img_format,
-                u'error': None
-            }
+            self.metrics.increment(u'request_errors_total', labels={u'reason': u'status_{}'.format(result.status_code)})
+            response = failed_response(url, img_format, None)
 
             if 'message' in json_result:
                 response['error'] = json_result['ex'] if 'ex' in json_result else json_result['message']
-            return response
+            return response, self._overload(result.status_code)
+
+        return self._received(json_result), None
+
+    def _post(self, url, json_dict, timeout):
+        """POST the request to lambda, returning the requests Response"""
+        request_headers = self._prep_headers()
+        body = self._prep_body(json_dict, request_headers)
+
+        self._logger.info("Sending lambda request {} {} {} {}".format(url, json_dict, request_headers, timeout))
+        start_time = time.time()
+        result = self._session.post(url=url,
+                                    data=body,
+                                    headers=request_headers,
+                                    allow_redirects=True,
+                                    timeout=timeout)
+        elapsed = time.time() - start_time
+        self._logger.info("Request took {}s".format(elapsed))
+        self.metrics.observe(u'request_seconds', elapsed)
+        self.metrics.observe(u'response_bytes', len(result.content))
+
+        return result
+
+    def _decode_result(self, result):
+        """
+        The RenderResult of a render response of either shape: the result as
+        JSON, or the raw image with the rest of the result in a header.
+        """
+        metadata = result.headers.get(RESULT_HEADER)
+
+        if metadata is None:
+            return RenderResult.from_dict(result.json())
+
+        json_result = RenderResult.from_dict(json.loads(metadata))
+        json_result['base64'] = None
+        json_result['image'] = result.content
+
+        return json_result
+
+    def _request_failed(self, e, result):
+        """Log and count a request which raised. :return: Why it signals the endpoint is overloaded, or None"""
+        self._logger.error("Exception while calling lambda {}".format(traceback.format_exc()))
+
+        if isinstance(e, Timeout):
+            self.metrics.increment(u'timeouts_total')
+
+        self.metrics.increment(u'request_errors_total', labels={u'reason': type(e).__name__})
+
+        if isinstance(e, Timeout):
+            return TIMED_OUT
+
+        if isinstance(e, ConnectionError):
+            return OVERLOADED
+
+        # A gateway error page which isn't json is still overload
+        return self._overload(result.status_code) if result is not None else None
+
+    @staticmethod
+    def _overload(status_code):
+        """Why the status code signals the endpoint is overloaded, or None"""
+        if status_code in RETRY_STATUS_CODES:
+            return THROTTLED
+
+        return OVERLOADED if status_code in OVERLOAD_STATUS_CODES else None
+
+    def _received(self, json_result):
+        """Count a render received from lambda"""
+        if json_result.get('base64') is not None:
+            self.metrics.observe(u'image_bytes', len(json_result['base64']))
+        elif json_result.get('image') is not None:
+            self.metrics.observe(u'image_bytes', len(json_result['image']))
+
+        self.metrics.increment(u'renders_total', labels={u'status': json_result.get('status')})
 
         return json_result
 
+    @staticmethod
+    def _json_kwargs(kwargs):
+        """render() kwargs completed with their defaults, as taken by _prep_json()"""
+        json_kwargs = {'html': None, 'img_format': 'PNG', 'width': 1280, 'height': 1024, 'page_load_timeout': None,
+                       'user_agent': None, 'headers': None, 'cookies': None, 'html_encoding': u'utf-8',
+                       'http_proxy': None}
+        json_kwargs.update(kwargs)
+        return json_kwargs
+
     def shutdown(self, timeout=None):
-        pass
+        self._session.close()
@@ -1,3 +1,21 @@
+import base64
+import copy
+
+# Binary responses carry the raw image as the body, and the rest of the result as JSON in this header
+RESULT_HEADER = "X-Render-Result"
+
+# Accept header value asking the render function for a binary response
+BINARY_MEDIA_TYPE = "application/octet-stream"
+
+# Content-Type of a binary response for each image format
+CONTENT_TYPES = {
+    "PDF": "application/pdf",
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "BMP": "image/bmp",
+    "PPM": "image/x-portable-pixmap",
+}
+
 SCHEMA = {
     "1.0": {
         "render": {
@@ -69,4 +87,51 @@ SCHEMA = {
             "additionalProperties": False
         }
     }
-}
\ No newline at end of file
+}
+
+# A batch of render requests, each with an optional id which is echoed on its result
+_BATCH_ITEM = copy.deepcopy(SCHEMA["1.0"]["render"])
+_BATCH_ITEM["properties"]["id"] = {
+    "type": ["string", "number"]
+}
+
+SCHEMA["1.0"]["render_batch"] = {
+    "properties": {
+        "requests": {
+            "type": "array",
+            "minItems": 1,
+            "maxItems": 10,
+            "items": _BATCH_ITEM
+        }
+    },
+    "required": [
+        "requests"
+    ],
+    "additionalProperties": False
+}
+
+
+def render_kwargs(request_data):
+    """
+    The render() keyword arguments of a validated render request, with defaults.
+    :param request_data: dict
+    :return: dict
+    """
+    html = request_data.get("html", None)
+
+    if html is not None:
+        html = base64.b64decode(html)
+
+    return {
+        "url": request_data["url"],
+        "html": html,
+        "img_format": request_data.get("img_format", "PNG"),
+        "width": request_data.get("width", 1280),
+        "height": request_data.get("height", 1024),
+        "page_load_timeout": request_data.get("page_load_timeout", None),
+        "user_agent": request_data.get("user_agent", None),
+        "http_proxy": request_data.get("http_proxy", None),
+        "headers": request_data.get("headers", None),
+        "cookies": request_data.get("cookies", None),
+        "html_encoding": request_data.get("html_encoding", "utf-8"),
+    }
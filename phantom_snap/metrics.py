@@ -0,0 +1,236 @@
+import bisect
+import logging
+import threading
+
+# Histogram bucket upper bounds, durations in seconds
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Histogram bucket upper bounds, sizes in bytes
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+
+class Histogram(object):
+    """Counts observations into fixed buckets, in the style of a Prometheus histogram."""
+
+    def __init__(self, buckets):
+
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last count is the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """List of (upper bound, count of observations <= bound), ending with the +Inf bucket."""
+
+        total = 0
+        result = []
+
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+
+class Metrics(object):
+    """
+    Collects timing histograms, counters and gauges from the renderers.
+
+    Histogram names ending in `_bytes` use SIZE_BUCKETS, everything else
+    TIME_BUCKETS. Counter names end in `_total`. Gauges hold the last value
+    set, such as a queue depth. Every observation is also passed to the
+    registered callbacks as callback(kind, name, value, labels), with kind
+    'histogram', 'counter' or 'gauge', so the numbers can be forwarded to
+    statsd or similar. prometheus() renders the Prometheus text format.
+
+    One Metrics instance can be shared by several renderers, for example all
+    of the workers in a RendererPool, to aggregate their numbers.
+    """
+
+    def __init__(self, callback=None, prefix=u'phantom_snap'):
+
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}  # (name, labels) -> value
+        self._callbacks = []
+
+        if callback is not None:
+            self._callbacks.append(callback)
+
+        self._logger = logging.getLogger(u'Metrics')
+
+    def add_callback(self, callback):
+        """
+        Register a function called with (kind, name, value, labels) for every observation.
+        :param callback:
+        :return:
+        """
+        self._callbacks.append(callback)
+
+    def observe(self, name, value, labels=None):
+        """
+        Record a value in the named histogram.
+        :param name: Metric name without the prefix, e.g. 'stdin_write_seconds'
+        :param value:
+        :param labels: Optional dict of label names to values
+        :return:
+        """
+        key = (name, _label_key(labels))
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+
+            if histogram is None:
+                histogram = Histogram(SIZE_BUCKETS if name.endswith(u'_bytes') else TIME_BUCKETS)
+                self._histograms[key] = histogram
+
+            histogram.observe(value)
+
+        self._notify(u'histogram', name, value, labels)
+
+    def increment(self, name, amount=1, labels=None):
+        """
+        Add to the named counter.
+        :param name: Metric name without the prefix, e.g. 'timeouts_total'
+        :param amount:
+        :param labels: Optional dict of label names to values
+        :return:
+        """
+        key = (name, _label_key(labels))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+        self._notify(u'counter', name, amount, labels)
+
+    def set(self, name, value, labels=None):
+        """
+        Set the named gauge.
+        :param name: Metric name without the prefix, e.g. 'queue_depth'
+        :param value:
+        :param labels: Optional dict of label names to values
+        :return:
+        """
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+        self._notify(u'gauge', name, value, labels)
+
+    def counter(self, name, labels=None):
+        """Current value of a counter, 0 if it has never been incremented."""
+
+        with self._lock:
+            return self._counters.get((name, _label_key(labels)), 0)
+
+    def gauge(self, name, labels=None):
+        """Current value of a gauge, None if it has never been set."""
+
+        with self._lock:
+            return self._gauges.get((name, _label_key(labels)))
+
+    def histogram(self, name, labels=None):
+        """The named Histogram, or None if nothing has been observed."""
+
+        with self._lock:
+            return self._histograms.get((name, _label_key(labels)))
+
+    def prometheus(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+        :return: str
+        """
+        lines = []
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+
+            last_name = None
+
+            for (name, labels), value in counters:
+                full_name = self._full_name(name)
+
+                if name != last_name:
+                    lines.append(u'# TYPE {} counter'.format(full_name))
+                    last_name = name
+
+                lines.append(u'{}{} {}'.format(full_name, _format_labels(labels), _format_value(value)))
+
+            last_name = None
+
+            for (name, labels), value in gauges:
+                full_name = self._full_name(name)
+
+                if name != last_name:
+                    lines.append(u'# TYPE {} gauge'.format(full_name))
+                    last_name = name
+
+                lines.append(u'{}{} {}'.format(full_name, _format_labels(labels), _format_value(value)))
+
+            last_name = None
+
+            for (name, labels), histogram in histograms:
+                full_name = self._full_name(name)
+
+                if name != last_name:
+                    lines.append(u'# TYPE {} histogram'.format(full_name))
+                    last_name = name
+
+                for bound, count in histogram.cumulative():
+                    le = u'+Inf' if bound == float('inf') else _format_value(bound)
+                    lines.append(u'{}_bucket{} {}'.format(full_name, _format_labels(labels + ((u'le', le),)), count))
+
+                lines.append(u'{}_sum{} {}'.format(full_name, _format_labels(labels), _format_value(histogram.sum)))
+                lines.append(u'{}_count{} {}'.format(full_name, _format_labels(labels), histogram.count))
+
+        return u'\n'.join(lines) + u'\n'
+
+    def _full_name(self, name):
+
+        if self.prefix:
+            return u'{}_{}'.format(self.prefix, name)
+
+        return name
+
+    def _notify(self, kind, name, value, labels):
+
+        for callback in self._callbacks:
+            try:
+                callback(kind, name, value, labels)
+            except Exception:
+                # A broken exporter must never fail a render
+                self._logger.exception(u'Error in metrics callback.')
+
+
+def _label_key(labels):
+
+    if not labels:
+        return ()
+
+    return tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels):
+
+    if not labels:
+        return u''
+
+    return u'{' + u','.join(u'{}="{}"'.format(k, _escape(v)) for k, v in labels) + u'}'
+
+
+def _escape(value):
+    return value.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+
+def _format_value(value):
+    return repr(value)
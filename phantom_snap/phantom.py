@@ -5,13 +5,19 @@ from eventlet.green import subprocess
 from eventlet.green import threading
 from eventlet.timeout import Timeout
 from eventlet.queue import Queue, Empty
+from eventlet.event import Event
 
+import collections
 import copy
+from html import escape as html_escape
 import json
 import os
-import base64
+import time
 import traceback
+from .metrics import Metrics
 from .renderer import Renderer, RenderError
+from .protocol import build_request, empty_response, failed_response, decode_response, apply_response, redact, \
+                      frame_length, read_image
 import logging
 
 from signal import *
@@ -22,19 +28,48 @@ class PhantomJSRenderer(Renderer):
     """
     Render a web page to an image, using either a URL or raw HTML.
 
+    By default the PhantomJS process renders one page at a time. When the
+    `max_pages` config is above 1, concurrent render() calls are multiplexed:
+    each request is tagged with an id, up to `max_pages` of them render in
+    PhantomJS at once, and the responses are matched back to the waiting
+    callers by id as they arrive. A queued request is sent as soon as a page
+    frees up, and a render which times out fails alone while the other pages
+    carry on. PhantomJS is only restarted once timed out renders hold all of
+    its pages.
+
+    Timings of each phase of a render (lock or queue wait, process spawn,
+    stdin write, time to response, JSON decode) and the image size are
+    recorded as histograms on `metrics`, along with counters for renders,
+    timeouts, process starts and kills. shutdown() asks PhantomJS to exit,
+    so only a process which had to be killed, e.g. after a timeout, counts
+    as a kill.
+
     Requires PhantomJS to be installed on the host: http://phantomjs.org/
     """
 
-    def __init__(self, config, logger=None, register_shutdown=False):
+    def __init__(self, config, logger=None, register_shutdown=False, prewarm=False, metrics=None):
 
         self.config = copy.deepcopy(PHANTOMJS)
         self.config = merge(self.config, config)
 
+        self.metrics = metrics if metrics is not None else Metrics()
+
         self._proc = None
         self._stderr_reader = None
         self._comms_lock = threading.RLock()
         self._shutdown_lock = threading.RLock()
 
+        # State of multiplexed renders, guarded by _comms_lock
+        self._next_id = 0
+        self._pending = {}  # id -> _PendingRender, for every render not yet answered
+        self._queued = collections.deque()  # Renders waiting for a free page
+        self._sent = set()  # ids sent to PhantomJS and not yet answered
+        self._abandoned = set()  # ids of _sent whose callers timed out
+        self._last_line = []  # ids of the last request line written
+        self._cookie_render = None  # id of a render with cookies, which has the process to itself
+        self._reading = False  # PhantomJS is waiting for a request line
+        self._warm = False
+
         if not self._which(self.config[u'executable']):
             raise RenderError(''.join([u"Can't locate PhantomJS executable: ", self.config[u'executable']]))
 
@@ -50,9 +85,46 @@ class PhantomJSRenderer(Renderer):
             for sig in (SIGABRT, SIGINT, SIGTERM):
                 signal(sig, self._on_signal)
 
+        if prewarm:
+            self.warmup()
+
     def get_config(self):
         return self.config
 
+    @property
+    def pid(self):
+        """Process id of the running PhantomJS process, or None."""
+        proc = getattr(self, '_proc', None)
+        return proc.pid if proc is not None else None
+
+    @property
+    def ready(self):
+        """True once PhantomJS is running and has answered a render, so renders use the `page_load` timeout."""
+        proc = getattr(self, '_proc', None)
+        return proc is not None and proc.poll() is None and self._warm
+
+    def warmup(self):
+        """
+        Start PhantomJS if required and run the configured warmup renders, so
+        the slow first render after startup isn't paid by a real request.
+        :return: True if every warmup render succeeded
+        """
+        warmup = self.config[u'warmup']
+
+        pages = [(u'about:blank', self._warmup_html())] + [(url, None) for url in warmup[u'urls']]
+        succeeded = True
+
+        for url, html in pages:
+            response = self.render(url, html=html)
+
+            if response[u'status'] == u'fail':
+                self._logger.warning(u'Warmup render of {} failed: {}'.format(url, response[u'error']))
+                succeeded = False
+
+        self._logger.info(u'PhantomJS warmed up with {} renders.'.format(len(pages)))
+
+        return succeeded
+
     def render(self, url, html=None, img_format=u'PNG', width=1280, height=1024, page_load_timeout=None, user_agent=None,
                headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None):
         """
@@ -69,49 +141,40 @@ class PhantomJSRenderer(Renderer):
         :param html_encoding:
         :return:
         """
-        request = {u'url': url, u'width': width, u'height': height, u'format': img_format}
+        request = build_request(url, html, img_format, width, height, user_agent, headers, cookies, html_encoding,
+                                http_proxy)
 
-        if html is not None:
-            if isinstance(html, str):
-                html = html.encode(html_encoding, errors='replace')
+        if self.config[u'binary_images']:
+            request[u'binary'] = True
 
-            b64 = base64.b64encode(html).decode('utf-8')
-            request[u'html64'] = b64
+        start_time = time.time()
 
-        if user_agent is not None:
-            request[u'userAgent'] = user_agent
+        if self._multiplexed():
+            response = self._render_multiplexed(request, url, img_format, page_load_timeout)
+        else:
+            response = self._render_single(request, url, img_format, page_load_timeout, start_time)
 
-        if http_proxy is not None:
-            request[u'httpProxy'] = http_proxy
+        self.metrics.observe(u'render_seconds', time.time() - start_time)
+        self.metrics.increment(u'renders_total', labels={u'status': response[u'status']})
 
-        if headers is not None:
-            request[u'headers'] = headers
+        return response
 
-        if cookies is not None:
-            request[u'cookies'] = cookies
+    def _render_single(self, request, url, img_format, page_load_timeout, start_time):
+        """Send one request to PhantomJS and wait for its response, holding the process for the whole render."""
 
         with self._comms_lock:
+            self.metrics.observe(u'lock_wait_seconds', time.time() - start_time)
+
             try:
                 first_render = False
 
-                if not hasattr(self, '_proc') or self._proc is None:
-                    startup_timeout = self.config[u'timeouts'][u'process_startup']
-
-                    command = self._construct_command()
-
-                    self._logger.info(u"Starting the PhantomJS process: " + u" ".join(command))
-
-                    with Timeout(startup_timeout):
-                        self._proc = subprocess.Popen(command,
-                                                      bufsize=4096,
-                                                      shell=False,
-                                                      stdin=subprocess.PIPE,
-                                                      stdout=subprocess.PIPE,
-                                                      stderr=subprocess.PIPE,
-                                                      env=self.config[u'env'])
-
-                        self._stderr_reader = PipeReader(self._proc.stderr)
+                if getattr(self, '_proc', None) is not None and self._proc.poll() is not None:
+                    # Exited between renders, e.g. killed while a Lambda container was frozen
+                    self._logger.warning(u'PhantomJS exited with code {}, restarting it.'.format(self._proc.returncode))
+                    self._terminate()
 
+                if not hasattr(self, '_proc') or self._proc is None:
+                    self._start_process()
                     first_render = True
 
                 render_timeout = self.config[u'timeouts'][u'render_response']
@@ -131,94 +194,385 @@ class PhantomJSRenderer(Renderer):
                     with Timeout(page_load_timeout + render_timeout):
 
                         self._logger.debug(u'Sending request: ' + request_string)
+                        write_start = time.time()
                         self._proc.stdin.write(request_string.encode('utf-8', errors='replace') + b'\n')
                         self._proc.stdin.flush()
+                        sent_time = time.time()
+                        self.metrics.observe(u'stdin_write_seconds', sent_time - write_start)
 
                         response_string = self._proc.stdout.readline()
+                        phantom_response = self._decode(response_string)
+                        self._read_image(self._proc.stdout, phantom_response)
+                        self.metrics.observe(u'response_seconds', time.time() - sent_time)
 
                 except Timeout:
-                    response_string = None
                     self._logger.warning(u'Received no response, terminating PhantomJS.')
-                    self.shutdown()
+                    self.metrics.increment(u'timeouts_total')
+                    self._terminate()
+
+                    return failed_response(url, img_format, u'Render request has timed out.')
+
+                except (ValueError, KeyError) as e:
+                    # Unparseable, or an image frame cut short, so stdout is out of step with the requests
+                    self._logger.debug(u'Error reading response: {}\nTerminating PhantomJS.\n{}'.format(response_string, traceback.format_exc()))
+                    self._terminate()
+
+                    return failed_response(url, img_format, ''.join([str(e), u'\nPhantomJS response: ',
+                                                                     response_string.decode('utf-8', errors='replace')]))
 
                 err_messages = self._check_stderr()
 
                 if err_messages is not None and self._logger.isEnabledFor(logging.DEBUG):
                     self._logger.debug(err_messages)
 
-                response = {u'url': url,
-                            u'status': None,
-                            u'load_time': None,
-                            u'paint_time': None,
-                            u'base64': None,
-                            u'format': img_format,
-                            u'error': None}
-
-                if response_string is None:
-                    response[u'status'] = u'fail'
-                    response[u'error'] = u'Render request has timed out.'
-                else:
-                    try:
-                        phantom_response = json.loads(response_string.decode('utf-8', errors='replace'))
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug(u'Received response: ' + json.dumps(redact(phantom_response)))
 
-                        if self._logger.isEnabledFor(logging.DEBUG):
-                            msg = {}
-                            msg.update(phantom_response)
-                            msg[u'base64'] = u'<omitted>'
-                            self._logger.debug(u'Received response: ' + json.dumps(msg))
+                response = apply_response(empty_response(url, img_format), phantom_response, err_messages)
+                self._warm = True
 
-                        if u'status' in phantom_response:
-                            response[u'status'] = phantom_response[u'status']
-                        else:
-                            response[u'status'] = u'fail'
+                return response
 
-                        if u'loadTime' in phantom_response:
-                            response[u'load_time'] = phantom_response[u'loadTime']
+            except (Timeout, Exception):
+                self._logger.error(u'Unexpected error, terminating PhantomJS.\n' + traceback.format_exc())
+                self._terminate()
+                raise
 
-                        if u'paintTime' in phantom_response:
-                            response[u'paint_time'] = phantom_response[u'paintTime']
+    def _render_multiplexed(self, request, url, img_format, page_load_timeout):
+        """Queue the request for the next batch sent to PhantomJS and wait for its response by id."""
 
-                        if u'base64' in phantom_response:
-                            response[u'base64'] = phantom_response[u'base64']
+        render_timeout = self.config[u'timeouts'][u'render_response']
+        queued_time = time.time()
 
-                        if u'error' in phantom_response:
-                            response[u'error'] = json.dumps(phantom_response[u'error'])
-                        elif err_messages is not None:
-                            response[u'error'] = err_messages
+        with self._comms_lock:
+            try:
+                if not hasattr(self, '_proc') or self._proc is None:
+                    self._start_process()
 
-                    except (ValueError, KeyError) as e:
-                        self._logger.debug(u'Error parsing response: {}\nTerminating PhantomJS.\n{}'.format(response_string, traceback.format_exc()))
+                if page_load_timeout is None:
+                    if self._warm:
+                        page_load_timeout = self.config[u'timeouts'][u'page_load']
+                    else:
+                        page_load_timeout = self.config[u'timeouts'][u'initial_page_load']
 
-                        self.shutdown()
+                request[u'id'] = self._next_id
+                request[u'timeout'] = page_load_timeout * 1000  # Convert seconds to ms
+                request[u'resourceWait'] = self.config[u'timeouts'][u'resource_wait_ms']
+                self._next_id += 1
 
-                        response[u'status'] = u'fail'
-                        response[u'error'] = ''.join([str(e), u'\nPhantomJS response: ', response_string])
+                pending = _PendingRender(request)
+                self._pending[pending.id] = pending
+                self._queued.append(pending)
 
-                return response
+                self._send_requests()
 
             except (Timeout, Exception):
                 self._logger.error(u'Unexpected error, terminating PhantomJS.\n' + traceback.format_exc())
-                self.shutdown()
+                self._terminate()
                 raise
 
-    def shutdown(self, timeout=None):
+        # The render timeout only starts once the request has actually been sent to PhantomJS
+        pending.sent.wait()
+        self.metrics.observe(u'queue_wait_seconds', (pending.sent_time or time.time()) - queued_time)
+
+        try:
+            with Timeout(page_load_timeout + render_timeout):
+                result = pending.result.wait()
+
+        except Timeout:
+            with self._comms_lock:
+                # Its page may still answer, which is ignored, and holds its place in PhantomJS until then
+                self._pending.pop(pending.id, None)
+
+                if pending.id in self._sent:
+                    self._abandoned.add(pending.id)
+
+                # Once timed out pages hold every page no other render can start
+                hung = len(self._abandoned) >= self.config[u'max_pages']
+
+            self._logger.warning(u'Received no response for {}.'.format(url))
+            self.metrics.increment(u'timeouts_total')
+
+            if hung:
+                self._logger.warning(u'Every page in PhantomJS has timed out, terminating it.')
+                self._terminate()
+
+            return failed_response(url, img_format, u'Render request has timed out.')
+
+        if result is None:
+            return failed_response(url, img_format, u'PhantomJS terminated before the render completed.')
+
+        phantom_response, err_messages = result
+        self.metrics.observe(u'response_seconds', time.time() - pending.sent_time)
+
+        return apply_response(empty_response(url, img_format), phantom_response, err_messages)
+
+    def _send_requests(self):
         """
+        Write the queued requests which fit in the free pages to PhantomJS, if
+        it is waiting for a line. Requires _comms_lock.
+
+        PhantomJS asks for a line whenever a page completes, and regularly
+        while pages render, and must be answered, so an empty line is sent
+        when nothing fits. While nothing renders it waits on the read, and
+        the next queued render is written straight away.
+
+        Cookies are shared by the whole PhantomJS process, so a request with
+        cookies is only sent while nothing else renders, and nothing is sent
+        alongside it.
+        """
+        if not self._reading or getattr(self, '_proc', None) is None:
+            return
+
+        batch = []
+
+        while self._queued and self._cookie_render is None and \
+                len(batch) + len(self._sent) < self.config[u'max_pages']:
+            has_cookies = u'cookies' in self._queued[0].request
+
+            if has_cookies and (len(batch) > 0 or len(self._sent) > 0):
+                break
+
+            batch.append(self._queued.popleft())
+
+            if has_cookies:
+                self._cookie_render = batch[-1].id
+                break
+
+        if len(batch) == 0 and len(self._sent) == 0:
+            return
+
+        try:
+            request_string = json.dumps([pending.request for pending in batch])
+
+            if batch:
+                self._logger.debug(u'Sending {} requests'.format(len(batch)))
+
+            write_start = time.time()
+            self._proc.stdin.write(request_string.encode('utf-8', errors='replace') + b'\n')
+            self._proc.stdin.flush()
+            sent_time = time.time()
+
+            if batch:
+                self.metrics.observe(u'stdin_write_seconds', sent_time - write_start)
+
+        except Exception:
+            self._logger.error(u'Unable to send requests, terminating PhantomJS.\n' + traceback.format_exc())
+            self._terminate()
+            return
+
+        self._reading = False
+        self._last_line = [pending.id for pending in batch]
+
+        for pending in batch:
+            pending.request = None
+            pending.sent_time = sent_time
+            self._sent.add(pending.id)
+            pending.sent.send()
 
+    def _read_responses(self, proc):
+        """Hand each multiplexed response from PhantomJS to the render waiting on its id."""
+
+        for response_string in iter(proc.stdout.readline, b''):
+
+            try:
+                phantom_response = self._decode(response_string)
+
+                if not phantom_response.get(u'ready'):
+                    self._read_image(proc.stdout, phantom_response)
+
+            except ValueError:
+                self._logger.warning(u'Error reading response: {}\nTerminating PhantomJS.\n{}'.format(response_string, traceback.format_exc()))
+                break
+
+            with self._comms_lock:
+                if getattr(self, '_proc', None) is not proc:
+                    return
+
+                if phantom_response.get(u'ready'):
+                    self._reading = True
+                    self._send_requests()
+                    continue
+
+                err_messages = self._check_stderr()
+
+                if err_messages is not None and self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug(err_messages)
+
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug(u'Received response: ' + json.dumps(redact(phantom_response)))
+
+                request_id = phantom_response.pop(u'id', None)
+
+                if request_id is None:
+                    # The whole line was rejected, e.g. it couldn't be parsed
+                    answered = self._last_line
+                    self._last_line = []
+                else:
+                    answered = [request_id]
+
+                for answered_id in answered:
+                    self._sent.discard(answered_id)
+                    self._abandoned.discard(answered_id)
+
+                    if answered_id == self._cookie_render:
+                        self._cookie_render = None
+
+                    pending = self._pending.pop(answered_id, None)
+
+                    if pending is not None:
+                        pending.result.send((phantom_response, err_messages))
+
+                self._warm = True
+
+        with self._comms_lock:
+            if getattr(self, '_proc', None) is proc:
+                self._logger.warning(u'PhantomJS exited unexpectedly.')
+                self._terminate()
+
+    def shutdown(self, timeout=None):
+        """
+        Stop PhantomJS, asking it to exit and killing it if it hasn't within
+        `timeout` seconds.
+        :param timeout: Seconds, by default the `process_exit` timeout
         :return:
         """
+        if timeout is None:
+            timeout = self.config[u'timeouts'][u'process_exit']
+
+        self._terminate(timeout)
+
+    def _terminate(self, exit_timeout=0):
+        """
+        Stop PhantomJS, killing it unless it exits within exit_timeout seconds
+        of being asked to. Only a process which had to be killed is counted on
+        process_kills_total.
+        """
         with self._shutdown_lock:
             if hasattr(self, '_proc') and self._proc is not None:
-                try:
-                    self._proc.kill()
-                    self._proc.wait()
-                finally:
-                    del self._proc
+                # Detached first, so the response reader knows the exit was expected
+                proc = self._proc
+                del self._proc
 
+                if exit_timeout > 0 and proc.poll() is None:
+                    try:
+                        proc.stdin.write(b'exit\n')
+                        proc.stdin.flush()
+                        proc.wait(timeout=exit_timeout)
+                    except (IOError, OSError, subprocess.TimeoutExpired):
+                        pass
+
+                if proc.poll() is None:
+                    proc.kill()
+                    self.metrics.increment(u'process_kills_total')
+
+                proc.wait()
                 self._logger.info(u'PhantomJS terminated.')
 
         if self._stderr_reader is not None:
             self._stderr_reader.shutdown()
 
+        if self._multiplexed():
+            with self._comms_lock:
+                self._fail_pending()
+
+    def _start_process(self):
+        """Start the PhantomJS process. Requires _comms_lock."""
+
+        startup_timeout = self.config[u'timeouts'][u'process_startup']
+
+        command = self._construct_command()
+
+        self._logger.info(u"Starting the PhantomJS process: " + u" ".join(command))
+
+        spawn_start = time.time()
+
+        with Timeout(startup_timeout):
+            self._proc = subprocess.Popen(command,
+                                          bufsize=4096,
+                                          shell=False,
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE,
+                                          env=self.config[u'env'])
+
+            self._stderr_reader = PipeReader(self._proc.stderr)
+
+        self.metrics.observe(u'spawn_seconds', time.time() - spawn_start)
+        self.metrics.increment(u'process_starts_total')
+
+        self._warm = False
+
+        if self._multiplexed():
+            # Waiting on its first read, which isn't announced
+            self._reading = True
+            eventlet.spawn_n(self._read_responses, self._proc)
+
+    def _warmup_html(self):
+        """The page rendered by warmup(), priming the configured stylesheets and fonts."""
+
+        warmup = self.config[u'warmup']
+
+        if warmup[u'html'] is not None:
+            return warmup[u'html']
+
+        links = u''.join(u'<link rel="stylesheet" href="{}">'.format(html_escape(href))
+                         for href in warmup[u'stylesheets'])
+
+        samples = u''.join(u'<p style="font-family: \'{}\'">The quick brown fox jumps over the lazy dog</p>'.format(
+            html_escape(font)) for font in warmup[u'fonts'])
+
+        return u'<html><head>{}</head><body><p>Warmup</p>{}</body></html>'.format(links, samples)
+
+    def _decode(self, response_string):
+        """Decode a response line, recording the decode time and the size of a base64 image."""
+
+        decode_start = time.time()
+        phantom_response = decode_response(response_string)
+        self.metrics.observe(u'decode_seconds', time.time() - decode_start)
+
+        if phantom_response.get(u'base64') is not None:
+            self.metrics.observe(u'image_bytes', len(phantom_response[u'base64']))
+
+        return phantom_response
+
+    def _read_image(self, stream, phantom_response):
+        """
+        Read the raw image which follows a binary mode response line, if any, into the response.
+        :raises ValueError: if the stream ends before the whole image was read
+        """
+        if not self.config[u'binary_images']:
+            return
+
+        length = frame_length(phantom_response)
+
+        if length == 0:
+            return
+
+        phantom_response[u'image'] = read_image(stream, length, self.config[u'read_chunk_size'])
+        self.metrics.observe(u'image_bytes', length)
+
+    def _multiplexed(self):
+        return self.config[u'max_pages'] > 1
+
+    def _fail_pending(self):
+        """Release every multiplexed render still waiting on the terminated process. Requires _comms_lock."""
+
+        for pending in self._pending.values():
+            if not pending.sent.ready():
+                pending.sent.send()
+
+            if not pending.result.ready():
+                pending.result.send(None)
+
+        self._pending.clear()
+        self._queued.clear()
+        self._sent.clear()
+        self._abandoned.clear()
+        self._last_line = []
+        self._cookie_render = None
+        self._reading = False
+
     def _check_stderr(self):
         """Collect any input from the stderr pipe and return it."""
 
@@ -236,7 +590,7 @@ class PhantomJSRenderer(Renderer):
 
     def _on_signal(self, sig, frame):
         """"""
-        self.shutdown()
+        self._terminate()
         os._exit(0)
 
     def _construct_command(self):
@@ -267,6 +621,18 @@ class PhantomJSRenderer(Renderer):
         return None
 
 
+class _PendingRender(object):
+    """A multiplexed render request, waiting to be sent to PhantomJS and answered."""
+
+    def __init__(self, request):
+
+        self.id = request[u'id']
+        self.request = request
+        self.sent_time = None
+        self.sent = Event()
+        self.result = Event()
+
+
 class PipeReader:
 
     def __init__(self, pipe):
@@ -0,0 +1,153 @@
+import eventlet
+from eventlet.green import threading
+
+import copy
+import logging
+import time
+
+from .renderer import Renderer, RenderError
+from .settings import POOL, merge
+
+
+class RendererPool(Renderer):
+    """
+    Dispatches render requests across a fixed set of worker Renderers so a
+    single renderer object can keep several PhantomJS processes busy at once.
+
+    A PhantomJSRenderer only handles one page at a time. The pool owns
+    `pool_size` workers, built by calling `factory`, and sends every render to
+    the least busy worker which still has spare capacity. When all of the
+    workers are busy the caller waits in a bounded queue, and once that queue
+    is full (or `queue_timeout` expires) the render is rejected with a
+    RenderError.
+
+    The factory makes it simple to decorate each worker, for example:
+
+        RendererPool(lambda: Lifetime(PhantomJSRenderer(config)), config)
+    """
+
+    def __init__(self, factory, config=None, logger=None):
+
+        self.config = copy.deepcopy(POOL)
+
+        if config is not None:
+            self.config = merge(self.config, config)
+
+        if self.config[u'pool_size'] < 1:
+            raise RenderError(u'RendererPool requires a pool_size of at least 1.')
+
+        if logger is not None:
+            self._logger = logger
+        else:
+            self._logger = logging.getLogger(u'RendererPool')
+
+        self._workers = [factory() for _ in range(self.config[u'pool_size'])]
+        self._busy = [0] * len(self._workers)
+        self._waiting = 0
+        self._condition = threading.Condition(threading.Lock())
+
+    @property
+    def size(self):
+        """Number of worker renderers in the pool."""
+        return len(self._workers)
+
+    @property
+    def queue_depth(self):
+        """Number of renders currently waiting for a free worker."""
+        return self._waiting
+
+    @property
+    def in_flight(self):
+        """Number of renders currently dispatched to workers."""
+        return sum(self._busy)
+
+    @property
+    def workers(self):
+        return list(self._workers)
+
+    @property
+    def ready(self):
+        """True once every worker is warmed up."""
+        return all(worker.ready for worker in self._workers)
+
+    def get_config(self):
+        return self.config
+
+    def warmup(self):
+        """
+        Warm up every worker concurrently.
+        :return: True if every worker warmed up successfully
+        """
+        results = list(eventlet.GreenPool(len(self._workers)).imap(lambda worker: worker.warmup(), self._workers))
+
+        return all(results)
+
+    def render(self, url, html=None, img_format='PNG', width=1280, height=1024, page_load_timeout=None, user_agent=None,
+               headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None):
+
+        index = self._acquire()
+
+        try:
+            return self._workers[index].render(url, html, img_format, width, height, page_load_timeout, user_agent,
+                                               headers, cookies, html_encoding, http_proxy)
+        finally:
+            self._release(index)
+
+    def shutdown(self, timeout=None):
+
+        for worker in self._workers:
+            try:
+                worker.shutdown(timeout)
+            except Exception:
+                self._logger.exception(u'Error shutting down pool worker.')
+
+    def _acquire(self):
+        """Reserve a slot on the least busy worker, waiting in the queue if required."""
+
+        capacity = self.config[u'worker_concurrency']
+        queue_timeout = self.config[u'queue_timeout']
+
+        with self._condition:
+            index = self._least_busy(capacity)
+
+            if index is None:
+                if self._waiting >= self.config[u'max_queue_size']:
+                    raise RenderError(u'Render queue is full, {} requests are already waiting.'.format(self._waiting))
+
+                deadline = None
+                if queue_timeout is not None:
+                    deadline = time.time() + queue_timeout
+
+                self._waiting += 1
+                try:
+                    while index is None:
+                        remaining = None
+                        if deadline is not None:
+                            remaining = deadline - time.time()
+                            if remaining <= 0:
+                                raise RenderError(u'Timed out waiting for a free renderer.')
+
+                        self._condition.wait(remaining)
+                        index = self._least_busy(capacity)
+                finally:
+                    self._waiting -= 1
+
+            self._busy[index] += 1
+            return index
+
+    def _release(self, index):
+
+        with self._condition:
+            self._busy[index] -= 1
+            self._condition.notify()
+
+    def _least_busy(self, capacity):
+        """Index of the least busy worker with spare capacity, or None when all are full."""
+
+        index = None
+
+        for i, busy in enumerate(self._busy):
+            if busy < capacity and (index is None or busy < self._busy[index]):
+                index = i
+
+        return index
@@ -0,0 +1,146 @@
+import base64
+import json
+
+from .result import RenderResult
+
+
+def build_request(url, html=None, img_format=u'PNG', width=1280, height=1024, user_agent=None, headers=None,
+                  cookies=None, html_encoding=u'utf-8', http_proxy=None):
+    """
+    Build the JSON request understood by render-ipc.js. The timeout fields are
+    left for the renderer to fill in.
+    :return: dict
+    """
+    request = {u'url': url, u'width': width, u'height': height, u'format': img_format}
+
+    if html is not None:
+        if isinstance(html, str):
+            html = html.encode(html_encoding, errors='replace')
+
+        b64 = base64.b64encode(html).decode('utf-8')
+        request[u'html64'] = b64
+
+    if user_agent is not None:
+        request[u'userAgent'] = user_agent
+
+    if http_proxy is not None:
+        request[u'httpProxy'] = http_proxy
+
+    if headers is not None:
+        request[u'headers'] = headers
+
+    if cookies is not None:
+        request[u'cookies'] = cookies
+
+    return request
+
+
+def empty_response(url, img_format):
+    """The RenderResult returned to callers, before any results are filled in."""
+
+    return RenderResult(url=url, format=img_format)
+
+
+def failed_response(url, img_format, error):
+    """A RenderResult for a render which could not be completed."""
+
+    response = empty_response(url, img_format)
+    response[u'status'] = u'fail'
+    response[u'error'] = error
+    return response
+
+
+def decode_response(response_string):
+    """
+    Decode a response line written by render-ipc.js.
+    :param response_string: bytes
+    :return: dict
+    :raises ValueError: if the line is not a JSON object
+    """
+    response = json.loads(response_string.decode('utf-8', errors='replace'))
+
+    if not isinstance(response, dict):
+        raise ValueError(u'Expected a JSON object from PhantomJS.')
+
+    return response
+
+
+def apply_response(response, phantom_response, err_messages=None):
+    """
+    Copy the fields of a decoded render-ipc.js response onto the caller's response dict.
+    :param response: RenderResult from empty_response()
+    :param phantom_response: dict from decode_response()
+    :param err_messages: Text collected from stderr, used when PhantomJS reports no error itself
+    :return: response
+    """
+    if u'status' in phantom_response:
+        response[u'status'] = phantom_response[u'status']
+    else:
+        response[u'status'] = u'fail'
+
+    if u'loadTime' in phantom_response:
+        response[u'load_time'] = phantom_response[u'loadTime']
+
+    if u'paintTime' in phantom_response:
+        response[u'paint_time'] = phantom_response[u'paintTime']
+
+    if u'base64' in phantom_response:
+        response[u'base64'] = phantom_response[u'base64']
+
+    if u'image' in phantom_response:
+        response[u'image'] = phantom_response[u'image']
+
+    if u'error' in phantom_response:
+        response[u'error'] = json.dumps(phantom_response[u'error'])
+    elif err_messages is not None:
+        response[u'error'] = err_messages
+
+    return response
+
+
+def frame_length(phantom_response):
+    """
+    Byte length of the raw image which follows a binary mode response line.
+    :param phantom_response: dict from decode_response()
+    :return: int, 0 when no image follows
+    """
+    try:
+        return int(phantom_response.get(u'length') or 0)
+    except (ValueError, TypeError, AttributeError):
+        return 0
+
+
+def read_image(stream, length, chunk_size):
+    """
+    Read a binary mode image body into a single preallocated buffer.
+    :param stream: Buffered binary stream supporting readinto()
+    :param length: Exact number of bytes to read
+    :param chunk_size: Max number of bytes read per call
+    :return: memoryview over the image bytes
+    :raises ValueError: if the stream ends early
+    """
+    image = memoryview(bytearray(length))
+    position = 0
+
+    while position < length:
+        read = stream.readinto(image[position:position + chunk_size])
+
+        if not read:
+            raise ValueError(u'Stream ended after {} of {} image bytes.'.format(position, length))
+
+        position += read
+
+    return image
+
+
+def redact(phantom_response):
+    """Shallow copy of a response with the image omitted, for logging."""
+
+    msg = {}
+    msg.update(phantom_response)
+    msg[u'base64'] = u'<omitted>'
+
+    if u'image' in msg:
+        msg[u'image'] = u'<omitted>'
+
+    return msg
@@ -24,6 +24,7 @@
  *   "format": String, [optional]
  *   "timeout": Long [optional]
  *   "resourceWait": Integer [optional]
+ *   "binary": Boolean [optional]
  * }\n
  *
  * Output will be JSON:
@@ -36,11 +37,46 @@
  *   "format": String
  * }\n
 
+ * When the request sets "binary", the image is not base 64 encoded into the
+ * JSON. The output line carries "length" instead of "base64", and is followed
+ * directly by exactly that many bytes of the raw image:
+ * {
+ *   ...
+ *   "length": Integer byte length of the image which follows
+ * }\n<image bytes>
+ *
+ * Output JSON is always escaped to ASCII, so the raw image bytes can share
+ * stdout with it.
+ *
  * In the event of an error, the output will be JSON:
  * {
  *   "error": String
  * }\n
  *
+ * Multiplexed requests:
+ *
+ * A line may instead hold a JSON array of requests, each with an "id":
+ * [{"id": Integer, "url": String, ...}, ...]\n
+ *
+ * Every request in the array starts rendering at once, alongside any pages
+ * still rendering from earlier arrays, and one output line is written per
+ * request as soon as its page completes, in any order, with the "id" of its
+ * request copied into the output (including errors).
+ *
+ * Reading stdin blocks the PhantomJS event loop, so once the first array has
+ * been received every read is announced with a line of its own:
+ * {"ready": true}\n
+ * The caller must answer it straight away with one line: an array of the
+ * requests to start, which may be empty. The process asks again as soon as
+ * a page completes, and every POLL_MS while pages are rendering, so new
+ * requests are started as pages free up rather than once a whole array is
+ * done. While no page is rendering it blocks on the read until there is
+ * more work.
+ *
+ * Cookies are shared by the whole process, so they are only reset by an
+ * array which arrives while no page is rendering, and all cookies of that
+ * array are applied to every page in it.
+ *
  * To exit the process send:
  * exit\n
  */
@@ -76,7 +112,66 @@ b64ToUtf8 = function(s){
 	return decodeURIComponent(escape(atob(s)));
 };
 
-renderHtml = function (request) {
+toAscii = function (s) {
+    return s.replace(/[\u007f-\uffff]/g, function (c) {
+        return '\\u' + ('0000' + c.charCodeAt(0).toString(16)).slice(-4);
+    });
+};
+
+var binaryStdout = false;
+
+// Milliseconds between reads for new requests while pages are rendering
+var POLL_MS = 20;
+
+var multiplexed = false;  // Set once a request array is received
+var inFlight = 0;  // Pages of multiplexed requests still rendering
+var readTimer = null;
+var readDelay = null;
+
+writeResponse = function (request, response, image) {
+    if (request !== null && request.hasOwnProperty('id')) {
+        response.id = request.id;
+    }
+    system.stdout.writeLine(toAscii(JSON.stringify(response)));
+
+    if (image) {
+        if (!binaryStdout) {
+            // One char per byte, the JSON lines are ASCII so are unaffected
+            system.stdout.setEncoding('ISO-8859-1');
+            binaryStdout = true;
+        }
+        system.stdout.write(image);
+        system.stdout.flush();
+    }
+};
+
+resetCookies = function (requests) {
+    phantom.clearCookies();
+
+    for (var r = 0; r < requests.length; r++) {
+        if (requests[r].hasOwnProperty('cookies')) {
+            for (var i = 0; i < requests[r].cookies.length; i++) {
+                phantom.addCookie(requests[r].cookies[i]);
+            }
+        }
+    }
+};
+
+renderHtml = function (request, callback) {
+
+    var format = 'PNG';
+
+    if (request.hasOwnProperty('format')) {
+        if(request.format === 'PNG' || request.format === 'JPEG') {
+            format = request.format;
+        }
+        else {
+            callback({
+                error: 'Request JSON specifies unsupported output format.'
+            });
+            return;
+        }
+    }
 
     var page = webpage.create();
 
@@ -117,29 +212,6 @@ renderHtml = function (request) {
         page.setProxy(request.httpProxy);
     }
 
-    phantom.clearCookies();
-
-    if (request.hasOwnProperty('cookies')) {
-        for (var i = 0; i < request.cookies.length; i++) {
-            phantom.addCookie(request.cookies[i]);
-        }
-    }
-
-    var format = 'PNG';
-
-    if (request.hasOwnProperty('format')) {
-        if(request.format === 'PNG' || request.format === 'JPEG') {
-            format = request.format;
-        }
-        else {
-            var error = {
-                error: 'Request JSON specifies unsupported output format.'
-            };
-            system.stdout.writeLine(JSON.stringify(error));
-            readInput();
-        }
-    }
-
     var timeout = 1000 * 180;
     var resourceWait  = 300;
 
@@ -158,6 +230,7 @@ renderHtml = function (request) {
     page.settings.resourceTimeout  = timeout;
 
     var rendered = false;
+    var image = null;
     var time = Date.now();
 
     page.onConfirm = page.onPrompt = function noOp() {};
@@ -193,7 +266,13 @@ renderHtml = function (request) {
                 var base64 = page.renderBase64(format);
 
                 if(base64) {
-                    response.base64 = base64;
+                    if(request.binary) {
+                        image = atob(base64);
+                        response.length = image.length;
+                    }
+                    else {
+                        response.base64 = base64;
+                    }
                     response.paintTime = Date.now() - time;
                 }
                 else {
@@ -203,8 +282,7 @@ renderHtml = function (request) {
 
             page.close();
 
-            system.stdout.writeLine(JSON.stringify(response));
-            readInput();
+            callback(response, image);
         }
     };
 
@@ -247,38 +325,102 @@ renderHtml = function (request) {
     }, timeout);
 };
 
+renderRequest = function (request, callback) {
+    if(request !== null && request.hasOwnProperty('url')) {
+        renderHtml(request, callback);
+    }
+    else {
+        callback({
+            error: 'Request JSON requires "url" field.'
+        });
+    }
+};
+
+renderRequests = function (requests) {
+
+    if (inFlight === 0) {
+        resetCookies(requests);
+    }
+
+    requests.forEach(function (request) {
+        inFlight += 1;
+
+        var done = function (response, image) {
+            writeResponse(request, response, image);
+            inFlight -= 1;
+
+            // A page is free, ask for the next request straight away
+            scheduleRead(0);
+        };
+
+        try {
+            renderRequest(request, done);
+        }
+        catch(err) {
+            done({error: err});
+        }
+    });
+};
+
+scheduleRead = function (delay) {
+    if (readTimer !== null) {
+        if (readDelay <= delay) {
+            return;
+        }
+        clearTimeout(readTimer);
+    }
+
+    readDelay = delay;
+    readTimer = setTimeout(function () {
+        readTimer = null;
+        readInput();
+    }, delay);
+};
+
+readNext = function () {
+    // Poll while pages render, the read returns at once. Otherwise block on it until there is work.
+    scheduleRead(multiplexed && inFlight > 0 ? POLL_MS : 0);
+};
+
 function readInput() {
-    setTimeout(function(){
-        var input = system.stdin.readLine();
+    if (multiplexed) {
+        system.stdout.writeLine('{"ready":true}');
+    }
 
-        if(input !== "exit") {
+    var input = system.stdin.readLine();
 
-            try {
-                var request = JSON.parse(input);
+    if(input !== "exit") {
 
-                if(request.hasOwnProperty('url')) {
-                    renderHtml(request);
-                }
-                else {
-                    var error = {
-                        error: 'Request JSON requires "url" field.'
-                    };
-                    system.stdout.writeLine(JSON.stringify(error));
-                    readInput();
-                }
+        try {
+            var request = JSON.parse(input);
+
+            if(request instanceof Array) {
+                multiplexed = true;
+                renderRequests(request);
+                readNext();
             }
-            catch(err) {
-                var error = {
-                    error: err
-                };
-                system.stdout.writeLine(JSON.stringify(error));
-                readInput();
+            else {
+                if(request !== null) {
+                    resetCookies([request]);
+                }
+
+                renderRequest(request, function (response, image) {
+                    writeResponse(null, response, image);
+                    readNext();
+                });
             }
         }
-        else {
-            phantom.exit();
+        catch(err) {
+            var error = {
+                error: err
+            };
+            system.stdout.writeLine(toAscii(JSON.stringify(error)));
+            readNext();
         }
-    }, 0);
+    }
+    else {
+        phantom.exit();
+    }
 };
 
-readInput();
+scheduleRead(0);
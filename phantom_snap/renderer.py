@@ -1,5 +1,12 @@
-
 import abc
+import hashlib
+import json
+import traceback
+
+import eventlet
+from eventlet.queue import LightQueue
+
+from .protocol import failed_response
 
 
 class Renderer(object):
@@ -25,6 +32,123 @@ class Renderer(object):
         """
         raise NotImplementedError('Users must implement shutdown() to use this base class')
 
+    @property
+    def ready(self):
+        """ True when the renderer is warmed up and ready for fast renders.
+        :return: bool
+        """
+        return True
+
+    def warmup(self):
+        """ Prepare the renderer so the first real render isn't slowed by startup costs.
+        :return: True if the warmup succeeded
+        """
+        return True
+
+    def render_many(self, requests, concurrency=1):
+        """ Render a stream of requests, yielding each response as soon as it completes.
+        :param requests: Iterable of dicts holding the render() keyword arguments, plus an optional 'id'
+        :param concurrency: Max number of renders in flight at once.
+        :return: Generator of response dicts, each tagged with the 'id' of its request
+        """
+        return render_many(self.render, requests, concurrency)
+
+
+def render_many(render, requests, concurrency=1):
+    """
+    Call `render` for every request dict, with at most `concurrency` calls in
+    flight on green threads, and yield the responses in completion order.
+
+    The requests are pulled from the iterable lazily, only when a render slot
+    frees up, so unbounded inputs are never held in memory. Every response is
+    a shallow copy tagged with the request's 'id', or the request's position
+    in the input when it has none. A render which raises produces a 'fail'
+    response rather than ending the stream.
+    """
+    if concurrency < 1:
+        raise ValueError(u'concurrency must be at least 1')
+
+    requests = iter(requests)
+    results = LightQueue()
+    in_flight = 0
+    index = 0
+
+    while True:
+        while in_flight < concurrency:
+            try:
+                request = next(requests)
+            except StopIteration:
+                break
+
+            eventlet.spawn_n(_render_request, render, request, index, results)
+            index += 1
+            in_flight += 1
+
+        if in_flight == 0:
+            return
+
+        response = results.get()
+        in_flight -= 1
+
+        yield response
+
+
+def render_key(url, html=None, img_format='PNG', width=1280, height=1024, user_agent=None, headers=None, cookies=None,
+               html_encoding=u'utf-8', http_proxy=None):
+    """
+    Canonical digest of the render() arguments which determine the resulting
+    image. Raw HTML contributes its own digest, and timeouts are ignored.
+    :return: str hex digest
+    """
+    html_digest = None
+
+    if html is not None:
+        if isinstance(html, str):
+            html = html.encode(html_encoding, errors='replace')
+
+        html_digest = hashlib.sha256(html).hexdigest()
+
+    canonical = json.dumps([url, html_digest, img_format, width, height, user_agent, headers, cookies, http_proxy],
+                           sort_keys=True, separators=(',', ':'), default=str)
+
+    return hashlib.sha256(canonical.encode('utf-8', errors='replace')).hexdigest()
+
+
+def split_request(request, index):
+    """
+    Separate the caller's correlation id from the render() keyword arguments.
+    :param request: dict of render() keyword arguments, plus an optional 'id'
+    :param index: Position of the request in its input, used when it has no 'id'
+    :return: (id, kwargs)
+    """
+    kwargs = dict(request)
+    request_id = kwargs.pop(u'id', index)
+    return request_id, kwargs
+
+
+def tag_response(response, request_id, kwargs):
+    """Shallow copy of a render() response tagged with the request id."""
+
+    if response is None:
+        response = failed_response(kwargs.get(u'url'), kwargs.get(u'img_format', u'PNG'), u'Renderer returned no response.')
+    else:
+        response = response.copy()
+
+    response[u'id'] = request_id
+    return response
+
+
+def _render_request(render, request, index, results):
+
+    request_id, kwargs = split_request(request, index)
+
+    try:
+        response = render(**kwargs)
+    except Exception:
+        response = failed_response(kwargs.get(u'url'), kwargs.get(u'img_format', u'PNG'), traceback.format_exc())
+
+    results.put(tag_response(response, request_id, kwargs))
+
 
 class RenderError(Exception):
     """Exception raised for errors during rendering.
@@ -36,4 +160,4 @@ class RenderError(Exception):
         self.msg = msg
 
     def __str__(self):
-        return repr(self.msg)
\ No newline at end of file
+        return repr(self.msg)
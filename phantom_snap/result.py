@@ -0,0 +1,122 @@
+import base64
+import copy
+
+# The keys every response has, in the order they are listed
+FIELDS = (u'url', u'status', u'load_time', u'paint_time', u'base64', u'format', u'error')
+
+
+class RenderResult(dict):
+    """
+    The response to a render. It is a dict, so it can be type checked, JSON
+    encoded and compared as the plain response dict always was.
+
+    `image` gives the raw image bytes as a memoryview: the 'image' bytes of a
+    binary mode render, or else the 'base64' text decoded on first access.
+    The decoded bytes are cached for as long as the 'base64' value they came
+    from is unchanged, so the decode cost is paid at most once.
+
+    copy() returns a RenderResult sharing the image buffers rather than
+    copying them, and redacted() gives a small dict for logging without
+    touching the image at all.
+    """
+
+    __slots__ = (u'_image', u'_source')
+
+    def __init__(self, url=None, status=None, load_time=None, paint_time=None, base64=None, format=None,
+                 error=None):
+
+        dict.__init__(self, zip(FIELDS, (url, status, load_time, paint_time, base64, format, error)))
+
+        self._image = None  # The decoded 'base64' text
+        self._source = None  # The 'base64' text _image was decoded from
+
+    @classmethod
+    def from_dict(cls, response):
+        """
+        Build a RenderResult from a response dict, e.g. one decoded from JSON.
+        :param response: dict
+        :return: RenderResult
+        :raises ValueError: When response is not a dict
+        """
+        if not isinstance(response, dict):
+            raise ValueError(u'A render response must be a JSON object, not {}'.format(type(response).__name__))
+
+        result = cls()
+        result.clear()
+        result.update(response)
+
+        return result
+
+    @property
+    def image(self):
+        """The raw image as a memoryview, or None when the render has no image."""
+
+        image = self.get(u'image')
+
+        if image is not None:
+            return memoryview(image)
+
+        text = self.get(u'base64')
+
+        if not isinstance(text, str):
+            return None
+
+        if self._source is not text:
+            self._image = base64.b64decode(text)
+            self._source = text
+
+        return memoryview(self._image)
+
+    @property
+    def has_image(self):
+        """True when the render has an image, checked without decoding it."""
+        return self.get(u'image') is not None or isinstance(self.get(u'base64'), str)
+
+    def copy(self):
+        """Shallow copy, sharing the image buffers."""
+
+        result = RenderResult.from_dict(self)
+        result._image = self._image
+        result._source = self._source
+
+        return result
+
+    def to_dict(self):
+        """The response as a plain dict."""
+        return dict(self)
+
+    def redacted(self):
+        """A dict of the response with the image omitted, for logging."""
+
+        msg = dict(self)
+
+        for key in (u'base64', u'image'):
+            if msg.get(key) is not None:
+                msg[key] = u'<omitted>'
+
+        return msg
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+
+        result = self.copy()
+
+        for key, value in self.items():
+            if key not in (u'base64', u'image'):
+                result[key] = copy.deepcopy(value, memo)
+
+        return result
+
+    def __reduce__(self):
+
+        response = dict(self)
+
+        if response.get(u'image') is not None:
+            response[u'image'] = bytes(response[u'image'])
+
+        return RenderResult.from_dict, (response,)
+
+    def __repr__(self):
+        return u'RenderResult({!r})'.format(self.redacted())
@@ -0,0 +1,572 @@
+import eventlet
+from eventlet.event import Event
+from eventlet.green import threading
+
+import collections
+import copy
+import heapq
+import itertools
+import logging
+import time
+
+from urllib.parse import urlsplit
+
+from .metrics import Metrics
+from .protocol import failed_response
+from .renderer import Renderer, RenderError
+from .settings import SCHEDULER, merge
+
+# Number of throttled hosts tracked before idle ones are pruned
+_PRUNE_SIZE = 1024
+
+# Second level labels under which country code domains are registered, e.g. example.co.uk
+_SECOND_LEVEL = frozenset([u'ac', u'co', u'com', u'edu', u'gov', u'net', u'org', u'ne', u'or'])
+
+# States of a _Job
+_QUEUED = 0
+_DISPATCHED = 1
+_EXPIRED = 2
+
+
+class _Job(object):
+    """A render waiting in the scheduler, woken with True to render or False when it expired."""
+
+    __slots__ = ('tenant', 'host', 'priority', 'deadline', 'queued_time', 'event', 'state')
+
+    def __init__(self, tenant, host, priority, deadline, queued_time):
+        self.tenant = tenant
+        self.host = host
+        self.priority = priority
+        self.deadline = deadline
+        self.queued_time = queued_time
+        self.event = Event()
+        self.state = _QUEUED
+
+    @property
+    def sort_key(self):
+        """Highest priority first, then earliest deadline, with no deadline last."""
+        return -self.priority, self.deadline if self.deadline is not None else float('inf')
+
+
+class _Tenant(object):
+    """The waiting jobs and deficit round-robin state of one tenant."""
+
+    __slots__ = ('name', 'weight', 'max_concurrency', 'queue', 'deficit', 'waiting', 'in_flight', 'dispatched',
+                 'active')
+
+    def __init__(self, name, weight, max_concurrency):
+        self.name = name
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.queue = []  # Heap of (sort key, sequence, _Job)
+        self.deficit = 0.0
+        self.waiting = 0
+        self.in_flight = 0
+        self.dispatched = 0
+        self.active = False
+
+    @property
+    def saturated(self):
+        return self.max_concurrency is not None and self.in_flight >= self.max_concurrency
+
+
+class _Host(object):
+    """Politeness state of one registered domain, and the jobs held back until it may be rendered again."""
+
+    __slots__ = ('name', 'max_concurrency', 'min_interval_sec', 'in_flight', 'next_time', 'parked', 'timer')
+
+    def __init__(self, name, max_concurrency, min_interval_sec):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.min_interval_sec = min_interval_sec
+        self.in_flight = 0
+        self.next_time = 0  # time.time() before which the next render may not start
+        self.parked = []  # (sort key, sequence, _Job) entries taken from their tenant queues
+        self.timer = None  # Green thread which wakes the parked jobs once next_time is reached
+
+    @property
+    def saturated(self):
+        return self.max_concurrency is not None and self.in_flight >= self.max_concurrency
+
+    def idle(self, now):
+        return self.in_flight == 0 and not self.parked and self.next_time <= now
+
+
+class RenderScheduler(Renderer):
+    """
+    Wraps a Renderer and decides which render runs next, so urgent work
+    isn't stuck behind a backlog.
+
+    render() accepts a `priority`, higher numbers first, and an absolute
+    `deadline` as a time.time() value. At most `max_concurrency` renders are
+    dispatched to the renderer at once (by default the capacity of a
+    RendererPool or multiplexed PhantomJSRenderer), and the rest wait here.
+    The highest priority waiting render is dispatched first, then the one
+    with the earliest deadline, then the oldest.
+
+    Renders may also carry a `tenant`, so teams sharing a renderer each get
+    their share of it. Every tenant has its own queue, ordered as above, and
+    the queues are served by deficit round-robin: on its turn a tenant earns
+    `weight` * `quantum` renders, so a tenant of weight 2 is dispatched twice
+    as often as one of weight 1 while both have renders waiting, however
+    many each has queued. A tenant with a `max_concurrency` is skipped while
+    that many of its renders are in flight. Weights and limits are set per
+    tenant in `tenants`, and otherwise default to `default_weight` and
+    `default_max_concurrency`.
+
+    Renders are also polite to the sites they load. At most
+    `host_max_concurrency` renders of one registered domain run at once, and
+    each starts at least `host_min_interval_sec` after the previous one, with
+    overrides per domain in `hosts`. A render whose domain is throttled is
+    set aside until the domain may be rendered again, and the renders of
+    other domains are dispatched in the meantime, so a burst of URLs from
+    one site doesn't leave the renderer idle.
+
+    All of these limits are kept in memory by this RenderScheduler, so they
+    apply per instance, i.e. per process. N processes, each with its own
+    scheduler, can together run N times `host_max_concurrency` renders of a
+    domain and start them N times as often as `host_min_interval_sec`
+    allows. Divide the limits by the number of processes, or route all the
+    renders of a fleet through one scheduler, e.g. served by a RenderServer.
+
+    A render whose deadline has passed fails fast with a 'fail' response,
+    whether it arrives expired or expires while waiting, rather than
+    spending a page load on a result nobody is waiting for. With
+    `trim_page_load` the page load timeout of a dispatched render is also
+    cut to the time left before its deadline.
+    """
+
+    def __init__(self, renderer, config=None, logger=None, metrics=None):
+
+        self._delegate = renderer
+
+        self.config = copy.deepcopy(SCHEDULER)
+
+        if config is not None:
+            self.config = merge(self.config, config)
+
+        if metrics is None:
+            metrics = getattr(renderer, 'metrics', None) or Metrics()
+
+        self.metrics = metrics
+
+        if logger is not None:
+            self._logger = logger
+        else:
+            self._logger = logging.getLogger(u'RenderScheduler')
+
+        self._capacity = self.config[u'max_concurrency'] or _capacity(renderer.get_config())
+
+        if self._capacity < 1:
+            raise RenderError(u'RenderScheduler requires a max_concurrency of at least 1.')
+
+        # Deficit round-robin never dispatches for a tenant which earns nothing on its turn
+        if not self.config[u'quantum'] > 0:
+            raise RenderError(u'RenderScheduler requires a quantum greater than 0.')
+
+        for name, tenant_config in self.config[u'tenants'].items():
+            _check_weight(name, tenant_config.get(u'weight', self.config[u'default_weight']))
+
+        _check_weight(u'default_weight', self.config[u'default_weight'])
+
+        self._tenants = {}  # Name -> _Tenant
+        self._active = collections.deque()  # Tenants with renders waiting, in round-robin order
+        self._visiting = None  # The tenant whose turn it is, after it earned its quantum
+        self._hosts = {}  # Registered domain -> _Host, only for domains with limits
+        self._prune_size = _PRUNE_SIZE
+        self._sequence = itertools.count()
+        self._waiting = 0
+        self._in_flight = 0
+        self._lock = threading.RLock()
+
+        self.dispatched = 0
+        self.expired = 0
+
+    def get_config(self):
+        return self._delegate.get_config()
+
+    @property
+    def queue_depth(self):
+        """Number of renders waiting to be dispatched."""
+        return self._waiting
+
+    @property
+    def in_flight(self):
+        """Number of renders dispatched to the renderer."""
+        return self._in_flight
+
+    @property
+    def stats(self):
+        """Counters for the scheduler, as a dict."""
+
+        with self._lock:
+            return {u'queue_depth': self._waiting,
+                    u'in_flight': self._in_flight,
+                    u'dispatched': self.dispatched,
+                    u'expired': self.expired}
+
+    @property
+    def tenants(self):
+        """Counters for each tenant seen so far, as a dict of dicts."""
+
+        with self._lock:
+            return dict((tenant.name, {u'queue_depth': tenant.waiting,
+                                       u'in_flight': tenant.in_flight,
+                                       u'dispatched': tenant.dispatched,
+                                       u'weight': tenant.weight})
+                        for tenant in self._tenants.values())
+
+    @property
+    def hosts(self):
+        """Renders in flight and held back for each throttled domain, as a dict of dicts."""
+
+        with self._lock:
+            return dict((host.name, {u'in_flight': host.in_flight, u'parked': len(host.parked)})
+                        for host in self._hosts.values())
+
+    @property
+    def ready(self):
+        return self._delegate.ready
+
+    def warmup(self):
+        return self._delegate.warmup()
+
+    def shutdown(self, timeout=None):
+        self._delegate.shutdown(timeout)
+
+    def render(self, url, html=None, img_format='PNG', width=1280, height=1024, page_load_timeout=None, user_agent=None,
+               headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None, priority=0, deadline=None,
+               tenant=None):
+        """
+        Render once this request is the most urgent waiting, see render() of the renderer.
+        :param priority: Higher priorities are dispatched first
+        :param deadline: time.time() after which the render is no longer wanted, None waits indefinitely
+        :param tenant: Name of the tenant sharing the renderer, None is the `default_tenant`
+        :return dict:
+        """
+        queued_time = time.time()
+
+        if deadline is not None and deadline <= queued_time:
+            return self._expired(url, img_format, u'arrival')
+
+        domain = _registered_domain(url)
+
+        with self._lock:
+            job = _Job(self._tenant(tenant), self._host(domain), priority, deadline, queued_time)
+
+            max_queue_size = self.config[u'max_queue_size']
+
+            if max_queue_size is not None and self._waiting >= max_queue_size:
+                raise RenderError(u'Render queue is full, {} requests are already waiting.'.format(self._waiting))
+
+            self._enqueue(job)
+            self._dispatch()
+
+        timeout = max(deadline - time.time(), 0) if deadline is not None else None
+        dispatched = job.event.wait(timeout)
+
+        if dispatched is None:
+            # Timed out waiting, unless it was dispatched at the same moment
+            with self._lock:
+                if job.state == _QUEUED:
+                    job.state = _EXPIRED
+                    self._unqueue(job)
+
+                dispatched = job.state == _DISPATCHED
+
+        if not dispatched:
+            return self._expired(url, img_format, u'queued')
+
+        tenant = job.tenant
+        self.metrics.observe(u'scheduler_wait_seconds', time.time() - queued_time, labels={u'tenant': tenant.name})
+
+        try:
+            page_load_timeout = self._page_load_timeout(page_load_timeout, deadline)
+
+            return self._delegate.render(url, html, img_format, width, height, page_load_timeout, user_agent,
+                                         headers, cookies, html_encoding, http_proxy)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                tenant.in_flight -= 1
+
+                if job.host is not None:
+                    job.host.in_flight -= 1
+                    self._unpark(job.host)
+
+                self._dispatch()
+
+            self.metrics.increment(u'tenant_renders_total', labels={u'tenant': tenant.name})
+
+    def _tenant(self, name):
+        """The _Tenant of a name, created from `tenants` on first use. Requires _lock."""
+
+        if name is None:
+            name = self.config[u'default_tenant']
+
+        tenant = self._tenants.get(name)
+
+        if tenant is None:
+            tenant_config = self.config[u'tenants'].get(name, {})
+            tenant = _Tenant(name, tenant_config.get(u'weight', self.config[u'default_weight']),
+                             tenant_config.get(u'max_concurrency', self.config[u'default_max_concurrency']))
+            self._tenants[name] = tenant
+
+        return tenant
+
+    def _host(self, domain):
+        """
+        The _Host of a registered domain, or None when no limits apply to it.
+        Idle hosts are pruned as the number tracked grows. Requires _lock.
+        """
+        host = self._hosts.get(domain)
+
+        if host is not None or domain is None:
+            return host
+
+        host_config = self.config[u'hosts'].get(domain, {})
+        max_concurrency = host_config.get(u'max_concurrency', self.config[u'host_max_concurrency'])
+        min_interval_sec = host_config.get(u'min_interval_sec', self.config[u'host_min_interval_sec'])
+
+        if max_concurrency is None and not min_interval_sec:
+            return None
+
+        if len(self._hosts) >= self._prune_size:
+            now = time.time()
+
+            for name in [name for name, idle_host in self._hosts.items() if idle_host.idle(now)]:
+                del self._hosts[name]
+
+            self._prune_size = max(_PRUNE_SIZE, 2 * len(self._hosts))
+
+        host = _Host(domain, max_concurrency, min_interval_sec)
+        self._hosts[domain] = host
+
+        return host
+
+    def _activate(self, tenant):
+        """Add a tenant with renders waiting to the round-robin. Requires _lock."""
+
+        if not tenant.active:
+            tenant.active = True
+            tenant.deficit = 0.0
+            self._active.append(tenant)
+
+    def _enqueue(self, job):
+        """Add a job to the waiting renders of its tenant. Requires _lock."""
+
+        tenant = job.tenant
+        heapq.heappush(tenant.queue, (job.sort_key, next(self._sequence), job))
+        self._activate(tenant)
+
+        self._waiting += 1
+        tenant.waiting += 1
+        self._set_depth(tenant)
+
+    def _unqueue(self, job):
+        """Count a job as no longer waiting, it was dispatched or expired. Requires _lock."""
+
+        self._waiting -= 1
+        job.tenant.waiting -= 1
+        self._set_depth(job.tenant)
+
+    def _set_depth(self, tenant):
+        self.metrics.set(u'tenant_queue_depth', tenant.waiting, labels={u'tenant': tenant.name})
+
+    def _peek(self, tenant):
+        """
+        The most urgent waiting job of a tenant, or None. Jobs which expired
+        while waiting are dropped here, and woken if that hasn't happened yet.
+        Jobs whose host is throttled are parked on the host. Requires _lock.
+        """
+        now = time.time()
+
+        while tenant.queue:
+            entry = tenant.queue[0]
+            job = entry[2]
+
+            if job.state != _QUEUED:
+                heapq.heappop(tenant.queue)
+                continue
+
+            if job.deadline is not None and job.deadline <= now:
+                heapq.heappop(tenant.queue)
+                job.state = _EXPIRED
+                self._unqueue(job)
+                job.event.send(False)
+                continue
+
+            host = job.host
+
+            if host is not None and (host.saturated or host.next_time > now):
+                heapq.heappop(tenant.queue)
+                host.parked.append(entry)
+                self.metrics.increment(u'host_deferrals_total')
+
+                # A host waiting out its interval, rather than a render, needs waking up
+                if not host.saturated and host.timer is None:
+                    host.timer = eventlet.spawn_after(host.next_time - now, self._wake, host)
+
+                continue
+
+            return job
+
+        return None
+
+    def _unpark(self, host):
+        """Return the parked jobs of a host to their tenant queues. Requires _lock."""
+
+        for entry in host.parked:
+            job = entry[2]
+
+            if job.state == _QUEUED:
+                heapq.heappush(job.tenant.queue, entry)
+                self._activate(job.tenant)
+
+        host.parked = []
+
+    def _wake(self, host):
+        """Dispatch the parked jobs of a host, once its min_interval_sec has passed."""
+
+        with self._lock:
+            host.timer = None
+            self._unpark(host)
+            self._dispatch()
+
+    def _next_job(self):
+        """
+        Remove and return the next job by deficit round-robin over the
+        tenants, or None when no tenant can be dispatched. Requires _lock.
+        """
+        saturated = 0
+
+        while self._active:
+            tenant = self._active[0]
+            job = self._peek(tenant)
+
+            if job is None:
+                # Nothing waiting, the tenant starts afresh when its next render arrives
+                self._active.popleft()
+                tenant.active = False
+                tenant.deficit = 0.0
+                self._visiting = None
+                continue
+
+            if tenant.saturated:
+                # Skipped, keeping its deficit for when a render of its own completes
+                saturated += 1
+
+                if saturated >= len(self._active):
+                    return None
+
+                self._active.rotate(-1)
+                self._visiting = None
+                continue
+
+            saturated = 0
+
+            if self._visiting is not tenant:
+                self._visiting = tenant
+                tenant.deficit += tenant.weight * self.config[u'quantum']
+
+            if tenant.deficit < 1:
+                # A weight below 1 earns a render over several turns
+                self._active.rotate(-1)
+                self._visiting = None
+                continue
+
+            heapq.heappop(tenant.queue)
+            tenant.deficit -= 1
+
+            if tenant.deficit < 1:
+                self._active.rotate(-1)
+                self._visiting = None
+
+            self._unqueue(job)
+            return job
+
+        return None
+
+    def _dispatch(self):
+        """Dispatch waiting jobs while the renderer has capacity. Requires _lock."""
+
+        while self._in_flight < self._capacity:
+            job = self._next_job()
+
+            if job is None:
+                return
+
+            if job.host is not None:
+                job.host.in_flight += 1
+                job.host.next_time = time.time() + job.host.min_interval_sec
+
+            job.state = _DISPATCHED
+            self._in_flight += 1
+            job.tenant.in_flight += 1
+            job.tenant.dispatched += 1
+            self.dispatched += 1
+            job.event.send(True)
+
+    def _page_load_timeout(self, page_load_timeout, deadline):
+        """The page load timeout of a dispatched render, cut to the time left before its deadline."""
+
+        if deadline is None or not self.config[u'trim_page_load']:
+            return page_load_timeout
+
+        remaining = max(int(deadline - time.time()), 1)
+
+        if page_load_timeout is None:
+            page_load_timeout = self.get_config().get(u'timeouts', {}).get(u'page_load')
+
+        if page_load_timeout is None or remaining < page_load_timeout:
+            return remaining
+
+        return page_load_timeout
+
+    def _expired(self, url, img_format, stage):
+
+        with self._lock:
+            self.expired += 1
+
+        self.metrics.increment(u'deadlines_exceeded_total', labels={u'stage': stage})
+
+        return failed_response(url, img_format, u'Deadline exceeded before the render started.')
+
+
+def _check_weight(name, weight):
+
+    if not weight > 0:
+        raise RenderError(u'Tenant {} requires a weight greater than 0, not {}.'.format(name, weight))
+
+
+def _registered_domain(url):
+    """
+    The registered domain of a URL, e.g. 'example.com' for
+    'http://www.example.com/', from its last two labels, or three under a
+    country code second level such as 'co.uk'. IP addresses are returned whole.
+    """
+    try:
+        hostname = urlsplit(url).hostname
+    except ValueError:
+        return None
+
+    if not hostname:
+        return None
+
+    labels = hostname.rstrip(u'.').split(u'.')
+
+    if labels[-1].isdigit() or u':' in hostname:
+        return hostname
+
+    count = 3 if len(labels[-1]) == 2 and labels[-2] in _SECOND_LEVEL else 2
+
+    return u'.'.join(labels[-count:])
+
+
+def _capacity(config):
+    """Renders a renderer takes at once, from its config: a RendererPool's workers, or PhantomJS's max_pages."""
+
+    if u'pool_size' in config:
+        return config[u'pool_size'] * config.get(u'worker_concurrency', 1)
+
+    return config.get(u'max_pages', 1)
@@ -0,0 +1,286 @@
+import eventlet
+from eventlet import wsgi
+from eventlet.green import threading
+
+import base64
+import copy
+import gzip
+import hmac
+import json
+import logging
+import math
+import time
+import traceback
+
+from jsonschema.exceptions import ValidationError
+from jsonschema.validators import validator_for
+
+from .lambda_schema import SCHEMA, RESULT_HEADER, BINARY_MEDIA_TYPE, CONTENT_TYPES, render_kwargs
+from .metrics import Metrics
+from .renderer import RenderError
+from .settings import SERVER, merge
+
+STATUS_LINES = {
+    200: '200 OK',
+    400: '400 Bad Request',
+    403: '403 Forbidden',
+    404: '404 Not Found',
+    405: '405 Method Not Allowed',
+    429: '429 Too Many Requests',
+    500: '500 Internal Server Error',
+    503: '503 Service Unavailable'
+}
+
+
+class RenderServer(object):
+    """
+    WSGI application serving renders over HTTP with the same contract as the
+    serverless handler, so a LambdaRenderer can use it in place of the Lambda
+    endpoint.
+
+        POST /render        One render request, see lambda_schema
+        POST /render/batch  A render_batch request
+        GET  /health        Readiness and admission state, as JSON
+        GET  /metrics       `metrics` in the Prometheus text format
+
+    Renders are admitted while fewer than `max_pending` are already admitted
+    (a batch counts each of its requests). Beyond that requests are rejected
+    with 429 and a Retry-After estimated from the recent render time, rather
+    than queued without bound. A batch larger than `max_pending` could never
+    be admitted, and is rejected with 400. Requests and responses are gzipped, and
+    binary responses returned, as by the handler.
+    """
+
+    def __init__(self, renderer, config=None, logger=None, metrics=None):
+
+        self.config = copy.deepcopy(SERVER)
+
+        if config is not None:
+            self.config = merge(self.config, config)
+
+        self._renderer = renderer
+
+        if metrics is None:
+            metrics = getattr(renderer, 'metrics', None) or Metrics()
+
+        self.metrics = metrics
+
+        if logger is not None:
+            self._logger = logger
+        else:
+            self._logger = logging.getLogger(u'RenderServer')
+
+        self._validators = {}
+
+        for schema_key, schema in SCHEMA[self.config[u'schema_version']].items():
+            validator_class = validator_for(schema)
+            validator_class.check_schema(schema)
+            self._validators[schema_key] = validator_class(schema)
+
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self):
+        """Number of renders admitted and not yet answered."""
+        return self._pending
+
+    def __call__(self, environ, start_response):
+
+        start_time = time.time()
+        path = environ.get('PATH_INFO', '')
+
+        try:
+            status, headers, body = self._route(environ.get('REQUEST_METHOD', 'GET'), path, environ)
+        except Exception:
+            self._logger.error(u'Uncaught exception {}'.format(traceback.format_exc()))
+            status, headers, body = self._json(environ, 500, {u'message': u'Uncaught Exception',
+                                                              u'ex': traceback.format_exc()})
+
+        labels = {u'path': path if path in ('/render', '/render/batch', '/health', '/metrics') else u'other',
+                  u'code': str(status)}
+        self.metrics.increment(u'http_requests_total', labels=labels)
+        self.metrics.observe(u'http_request_seconds', time.time() - start_time, labels={u'path': labels[u'path']})
+
+        headers.append(('Content-Length', str(len(body))))
+        start_response(STATUS_LINES[status], headers)
+
+        return [body]
+
+    def _route(self, method, path, environ):
+
+        if path == '/health':
+            return self._json(environ, 200, {u'status': u'ok',
+                                             u'ready': self._renderer.ready,
+                                             u'pending': self._pending,
+                                             u'max_pending': self.config[u'max_pending']})
+
+        if path == '/metrics':
+            return 200, [('Content-Type', 'text/plain; version=0.0.4')], self.metrics.prometheus().encode('utf-8')
+
+        if path not in ('/render', '/render/batch'):
+            return self._json(environ, 404, {u'message': u'Not Found'})
+
+        if method != 'POST':
+            return self._json(environ, 405, {u'message': u'Method Not Allowed'})
+
+        api_key = self.config[u'api_key']
+        if api_key is not None and not hmac.compare_digest(environ.get('HTTP_X_API_KEY', '').encode('utf-8'),
+                                                           api_key.encode('utf-8')):
+            return self._json(environ, 403, {u'message': u'Forbidden'})
+
+        try:
+            request_data = json.loads(self._request_body(environ).decode('utf-8'))
+        except (ValueError, IOError, OSError):
+            return self._json(environ, 400, {u'message': u'Invalid Request Body', u'ex': traceback.format_exc()})
+
+        schema_key = u'render' if path == '/render' else u'render_batch'
+
+        try:
+            self._validators[schema_key].validate(request_data)
+        except ValidationError:
+            self._logger.warning(u'Failed schema validation {}'.format(traceback.format_exc()))
+            return self._json(environ, 400, {u'message': u'Failed Schema Validation', u'ex': traceback.format_exc()})
+
+        count = 1 if schema_key == u'render' else len(request_data[u'requests'])
+
+        if count > self.config[u'max_pending']:
+            # Could never be admitted, so retrying won't help
+            return self._json(environ, 400, {u'message': u'Batch of {} requests exceeds max_pending {}'.format(
+                count, self.config[u'max_pending'])})
+
+        if not self._admit(count):
+            return self._rejected(environ)
+
+        try:
+            if schema_key == u'render':
+                return self._render(environ, request_data)
+            else:
+                return self._render_batch(environ, request_data)
+        except RenderError:
+            # The renderer's own queue is full, e.g. a RendererPool's max_queue_size
+            return self._rejected(environ)
+        finally:
+            with self._lock:
+                self._pending -= count
+
+    def _render(self, environ, request_data):
+
+        self._logger.info(u'Received request for %s', request_data.get(u'url'))
+
+        start_time = time.time()
+        page = self._renderer.render(**render_kwargs(request_data))
+        self.metrics.observe(u'server_render_seconds', time.time() - start_time)
+
+        self._logger.info(u'Render response %r', page)
+
+        if page[u'status'] == u'fail':
+            return self._json(environ, 500, _result_dict(page))
+
+        if BINARY_MEDIA_TYPE in environ.get('HTTP_ACCEPT', '') and page.has_image:
+            metadata = dict((key, page[key]) for key in page if key not in (u'base64', u'image'))
+
+            return 200, [('Content-Type', CONTENT_TYPES.get(page[u'format'], BINARY_MEDIA_TYPE)),
+                         (RESULT_HEADER, json.dumps(metadata))], bytes(page.image)
+
+        return self._json(environ, 200, _result_dict(page))
+
+    def _render_batch(self, environ, request_data):
+
+        items = request_data[u'requests']
+        self._logger.info(u'Received batch of %s requests', len(items))
+
+        start_time = time.time()
+        requests = [dict(render_kwargs(item), id=index) for index, item in enumerate(items)]
+        pages = [None] * len(items)
+
+        for page in self._renderer.render_many(requests, concurrency=self.config[u'batch_concurrency']):
+            pages[page[u'id']] = page
+
+        self.metrics.observe(u'server_render_seconds', (time.time() - start_time) / len(items))
+
+        results = []
+
+        for item, page in zip(items, pages):
+            result = _result_dict(page)
+            result[u'id'] = item.get(u'id', page[u'id'])
+            results.append(result)
+
+        # The status of each render is on its result
+        return self._json(environ, 200, {u'results': results})
+
+    def _admit(self, count):
+        """Reserve room for count renders. :return: False when the server is saturated"""
+
+        with self._lock:
+            if self._pending + count > self.config[u'max_pending']:
+                return False
+
+            self._pending += count
+            return True
+
+    def _rejected(self, environ):
+
+        self.metrics.increment(u'rejected_total')
+
+        # Time for the renders ahead to drain, from the recent render time
+        histogram = self.metrics.histogram(u'server_render_seconds')
+        mean = histogram.sum / histogram.count if histogram is not None and histogram.count else 1.0
+        retry_after = max(1, int(math.ceil(mean * self._pending / self.config[u'batch_concurrency'])))
+
+        status, headers, body = self._json(environ, 429, {u'message': u'Too Many Requests'})
+        headers.append(('Retry-After', str(retry_after)))
+
+        return status, headers, body
+
+    def _request_body(self, environ):
+        """The request body, gunzipped as required"""
+
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length) if length > 0 else b''
+
+        if environ.get('HTTP_CONTENT_ENCODING', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+
+        return body
+
+    def _json(self, environ, status, payload):
+        """A JSON response, gzipped when the client accepts it"""
+
+        body = json.dumps(payload).encode('utf-8')
+        headers = [('Content-Type', 'application/json')]
+
+        if 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '') and len(body) >= self.config[u'compress_min_bytes']:
+            body = gzip.compress(body, compresslevel=6)
+            headers.append(('Content-Encoding', 'gzip'))
+
+        return status, headers, body
+
+
+def _result_dict(page):
+    """The JSON response of a render, with the image of a binary_images render encoded as base64."""
+
+    result = page.to_dict()
+    image = result.pop(u'image', None)
+
+    if image is not None and result.get(u'base64') is None:
+        result[u'base64'] = base64.b64encode(image).decode('ascii')
+
+    return result
+
+
+def serve(renderer, config=None, logger=None, metrics=None):
+    """
+    Serve renders over HTTP until interrupted, then shutdown the renderer.
+    :param renderer: Renderer, e.g. a RendererPool of PhantomJSRenderer workers
+    :param config: SERVER settings
+    """
+    app = RenderServer(renderer, config, logger, metrics)
+    sock = eventlet.listen((app.config[u'host'], app.config[u'port']))
+
+    app._logger.info(u'Serving renders on {}:{}'.format(app.config[u'host'], app.config[u'port']))
+
+    try:
+        wsgi.server(sock, app, log=app._logger, log_output=app.config[u'access_log'])
+    finally:
+        renderer.shutdown()
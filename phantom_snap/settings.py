@@ -8,27 +8,143 @@ PHANTOMJS = {
     'args': [],
     'env': {},
     'script': os.path.join(os.path.dirname(__file__), 'render-ipc.js'),
+    'max_pages': 1,  # Max pages rendered concurrently by one PhantomJS process, above 1 multiplexes requests
+    'binary_images': False,  # Send images over the pipe as raw bytes, returned under 'image', instead of base64
+    'read_chunk_size': 65536,  # Bytes read per call when receiving a binary image
     'timeouts': {
         'initial_page_load': 15,  # 15 Seconds, PhantomJS takes longer on the first execution after startup
         'page_load': 5,  # Max time given for PhantomJS to load the page before 'stop' and render
         'render_response': 5,  # Additional time after page load for PhantomJS to formulate and return response
         'process_startup': 10, # Max time for PhantomJS process to start before giving up
+        'process_exit': 1,  # Max time for PhantomJS to exit when shutdown, before it is killed
         'resource_wait_ms': 300 # Max time to wait for final resources to load, in ms
+    },
+    'warmup': {
+        'html': None,  # HTML rendered by warmup(), None builds a page from the stylesheets and fonts below
+        'stylesheets': [],  # Stylesheet URLs to load into the cache during warmup
+        'fonts': [],  # Font families to render during warmup
+        'urls': []  # Additional URLs rendered during warmup
     }
 }
 
 # Defaults for the Lambda Renderer
 LAMBDA = {
     'url': 'http://localhost',
+    'pool_connections': 10,  # Number of hosts to keep a pool of connections for
+    'pool_maxsize': 10,  # Max keep-alive connections per host, size this to the number of concurrent renders
+    'max_retries': 0,  # Retries of connections which fail before the request reaches the endpoint
+    'compress_requests': False,  # gzip request bodies of at least compress_min_bytes, e.g. large html payloads
+    'compress_min_bytes': 16384,
+    'binary_responses': False,  # Ask for the raw image as the response body, returned under 'image', instead of base64
+    'batch_url': None,  # Endpoint of the render_batch handler, None uses url + '/batch'
+    'max_batch_size': 5,  # Max requests packed into one render_batch call
+    'max_batch_bytes': 1024 * 1024,  # Max encoded size of the requests packed into one render_batch call
     'timeouts': {
         'request_timeout': 120,  # Max time for the endpoint to finish the page render and return the results
+    },
+    'fan_out': {  # render_many() concurrency, adapted to the endpoint's latency and throttling
+        'initial_concurrency': 4,
+        'min_concurrency': 1,
+        'max_concurrency': 10,  # Also the thread pool size, raise pool_maxsize with it
+        'increase': 1,  # Added to the limit per round trip of successful requests
+        'decrease_factor': 0.5,  # Multiplies the limit on throttling, 5xx overload or timeouts
+        'latency_target_sec': None,  # Requests slower than this also decrease the limit, None disables
+        'deadline_sec': None,  # Default time allowed for each request, None for no deadline
+        'throttle_retries': 2,  # Retries of a 429 or 503, or of a timeout before the request's deadline
+        'retry_backoff_sec': 0.5  # Doubled on every retry
     }
 }
 
 # Defaults for the Lifetime decorator
 LIFETIME = {
     'idle_shutdown_sec': 1800,  # 30 minutes, Shutdown PhantomJS if it's been idle this long
-    'max_lifetime_sec': 86400  # 24 hours, Restart PhantomJS every 24 hours
+    'max_lifetime_sec': 86400,  # 24 hours, Restart PhantomJS every 24 hours
+    'max_renders': None,  # Restart PhantomJS after this many renders, None disables
+    'max_rss_mb': None,  # Restart PhantomJS once its resident memory exceeds this many MB, None disables
+    'max_disk_cache_mb': None,  # Restart PhantomJS once its --disk-cache-path exceeds this many MB, None disables
+    'clear_disk_cache': False,  # Delete the contents of --disk-cache-path when restarting for its size
+    'resource_check_sec': 10  # Min time between checks of the memory and disk cache size
+}
+
+# Defaults for the RendererPool
+POOL = {
+    'pool_size': os.cpu_count() or 1,  # Number of worker renderers (PhantomJS processes) to run
+    'worker_concurrency': 1,  # Max renders dispatched to a single worker at the same time
+    'max_queue_size': 100,  # Max renders waiting for a free worker before new renders are rejected
+    'queue_timeout': None  # Max time in seconds a render waits for a free worker, None waits forever
+}
+
+# Defaults for server.RenderServer
+SERVER = {
+    'host': '0.0.0.0',
+    'port': 8080,
+    'api_key': None,  # When set, requests must send it as the x-api-key header, as with API Gateway
+    'max_pending': 100,  # Max renders admitted at once, beyond which requests are rejected with 429
+    'batch_concurrency': os.cpu_count() or 1,  # Max renders of a batch in flight, size this to the renderer
+    'compress_min_bytes': 1024,  # JSON responses at least this large are gzipped for clients which accept it
+    'schema_version': '1.0',  # lambda_schema version of the requests
+    'access_log': True  # Log every request
+}
+
+# Defaults for scheduler.RenderScheduler
+SCHEDULER = {
+    'max_concurrency': None,  # Renders dispatched at once, None uses the capacity of the RendererPool or max_pages
+    'max_queue_size': None,  # Max renders waiting to be dispatched before new renders are rejected, None is unbounded
+    'trim_page_load': True,  # Cut the page load timeout of a render to the time left before its deadline
+    'tenants': {},  # Tenant name -> {'weight': .., 'max_concurrency': ..}, overriding the defaults below
+    'default_tenant': 'default',  # Tenant of renders which don't name one
+    'default_weight': 1,  # Share of the renderer given to a tenant, relative to the other tenants' weights
+    'default_max_concurrency': None,  # Max renders of one tenant in flight at once, None is only limited by capacity
+    'quantum': 1,  # Renders a tenant of weight 1 is dispatched on each round-robin turn
+    'hosts': {},  # Registered domain -> {'max_concurrency': .., 'min_interval_sec': ..}, overriding the defaults below
+    'host_max_concurrency': None,  # Max renders of one registered domain in flight at once per process, None is unlimited
+    'host_min_interval_sec': 0  # Min seconds between the starts of renders of one registered domain, per process
+}
+
+# Defaults for the CachingRenderer decorator
+CACHE = {
+    'cache_max_bytes': 256 * 1024 * 1024,  # 256 MB, Memory budget for cached responses
+    'cache_ttl_sec': 3600,  # 1 hour, How long a cached response is served
+    'cache_dir': None,  # Directory for the optional on-disk tier, which survives restarts
+    'cache_disk_max_bytes': 1024 * 1024 * 1024,  # 1 GB, Disk budget for the on-disk tier
+    'cache_failures': False  # Also cache responses with a 'fail' status
+}
+
+# Defaults for the HedgingRenderer decorator
+HEDGE = {
+    'hedge_percentile': 95,  # Hedge renders which haven't answered within this percentile of recent latencies
+    'hedge_min_delay_sec': 1,  # Never hedge a render sooner than this
+    'hedge_min_samples': 20,  # Successful renders to measure before hedging starts
+    'hedge_window': 1000,  # Number of recent render latencies the percentile is taken over
+    'hedge_max_rate': 0.05,  # Max fraction of renders which are hedged
+    'hedge_burst': 10,  # Hedges which can be sent at once before hedge_max_rate applies
+    'hedge_max_workers': 32  # Green threads running renders and their hedges, bounding the renders hedged at once
+}
+
+# Defaults for imagetools.ImageWriter
+IMAGE_WRITER = {
+    'writer_threads': 4,  # Number of images decoded and written at the same time
+    'max_queue_size': 100,  # Max images waiting to be written before write() blocks
+    'dedupe': None,  # None, 'hardlink' or 'symlink', Store each distinct image once under store_dir
+    'store_dir': None,  # Directory for the content-addressed images, required when dedupe is set
+    'fsync_batch': 0  # fsync written files in batches of this many, 0 leaves flushing to the OS
+}
+
+# Defaults for imagetools.DerivativePipeline
+DERIVATIVES = {
+    'processes': None,  # Number of worker processes, None runs one per CPU
+    'derivatives': [
+        # Each derivative is named, fits within width x height (None leaves that side unbounded) and is
+        # re-encoded to format, e.g. {'name': 'thumb', 'width': 320, 'height': 320, 'format': 'WEBP', 'quality': 80}
+    ]
+}
+
+# Defaults for imagetools.ChangeDetector
+CHANGE_DETECTION = {
+    'hash': 'dhash',  # Perceptual hash, 'dhash' (difference hash) or 'phash' (DCT hash)
+    'hash_size': 8,  # Hashes are hash_size x hash_size bits
+    'threshold': 4,  # Max Hamming distance from the last stored image for a render to count as unchanged
+    'max_urls': 100000  # Max URLs remembered by the in-memory index, least recently seen are forgotten first
 }
 
 
@@ -0,0 +1,177 @@
+# coding=utf-8
+
+import asyncio
+import os
+import sys
+import tempfile
+
+from unittest import TestCase
+
+from phantom_snap.async_phantom import AsyncPhantomJSRenderer
+
+# Answers each request line like render-ipc.js, hangs on URLs containing "hang" and exits part way through the
+# image on URLs containing "truncated". An array is answered in reverse order, leaving hung pages unanswered, and the
+# next line is asked for.
+FAKE_SCRIPT = u"""
+import json, os, sys, time
+def answer(request):
+    response = {'url': request['url'], 'status': 'success', 'loadTime': 1, 'paintTime': 2, 'base64': 'aW1hZ2U=',
+                'format': request['format'], 'id': request['id']}
+    return json.dumps(response) + '\\n'
+for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    if isinstance(request, list):
+        if not request:
+            time.sleep(0.02)
+        answers = [answer(r) for r in reversed(request) if 'hang' not in r['url']]
+        sys.stdout.write(''.join(answers) + '{"ready": true}\\n')
+        sys.stdout.flush()
+        continue
+    if 'hang' in request['url']:
+        time.sleep(60)
+    if 'truncated' in request['url']:
+        sys.stdout.write(json.dumps({'url': request['url'], 'status': 'success', 'length': 1000}) + '\\nshort')
+        sys.stdout.flush()
+        os._exit(0)
+    sys.stderr.write('rendering ' + request['url'] + '\\n')
+    sys.stderr.flush()
+    sys.stdout.write(json.dumps({'url': request['url'], 'status': 'success', 'loadTime': 1,
+                                 'paintTime': 2, 'base64': 'aW1hZ2U=', 'format': request['format']}) + '\\n')
+    sys.stdout.flush()
+"""
+
+
+class TestAsyncPhantomJS(TestCase):
+
+    def setUp(self):
+
+        fd, self.script = tempfile.mkstemp(suffix='.py')
+        with os.fdopen(fd, 'w') as script_file:
+            script_file.write(FAKE_SCRIPT)
+
+        self.renderer = AsyncPhantomJSRenderer({
+            'executable': sys.executable,
+            'script': self.script,
+            'timeouts': {
+                'initial_page_load': 3,
+                'page_load': 1,
+                'render_response': 0.5
+            }
+        })
+
+    def tearDown(self):
+        os.remove(self.script)
+
+    def _run(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_render(self):
+
+        async def run():
+            try:
+                first = await self.renderer.render(u'http://test/1')
+                second = await self.renderer.render(u'http://test/2', img_format=u'JPEG')
+                return first, second
+            finally:
+                await self.renderer.shutdown()
+
+        first, second = self._run(run())
+
+        self.assertEqual(first[u'status'], u'success')
+        self.assertEqual(first[u'base64'], u'aW1hZ2U=')
+        self.assertEqual(first[u'load_time'], 1)
+        self.assertEqual(first[u'paint_time'], 2)
+        self.assertEqual(second[u'format'], u'JPEG')
+
+    def test_render_timeout(self):
+
+        async def run():
+            try:
+                hung = await self.renderer.render(u'http://test/hang')
+                after = await self.renderer.render(u'http://test/after')
+                return hung, after
+            finally:
+                await self.renderer.shutdown()
+
+        hung, after = self._run(run())
+
+        self.assertEqual(hung[u'status'], u'fail')
+        self.assertEqual(hung[u'error'], u'Render request has timed out.')
+        self.assertEqual(after[u'status'], u'success')
+
+    def test_truncated_image(self):
+
+        self.renderer.config[u'binary_images'] = True
+
+        async def run():
+            try:
+                truncated = await self.renderer.render(u'http://test/truncated')
+                after = await self.renderer.render(u'http://test/after')
+                return truncated, after
+            finally:
+                await self.renderer.shutdown()
+
+        truncated, after = self._run(run())
+
+        self.assertEqual(truncated[u'status'], u'fail')
+        self.assertEqual(after[u'status'], u'success')
+
+    def test_concurrent_renders(self):
+
+        async def run():
+            try:
+                return await asyncio.gather(*[self.renderer.render(u'http://test/{}'.format(i)) for i in range(5)])
+            finally:
+                await self.renderer.shutdown()
+
+        results = self._run(run())
+
+        self.assertEqual([r[u'url'] for r in results], [u'http://test/{}'.format(i) for i in range(5)])
+
+    def test_multiplexed(self):
+
+        self.renderer.config[u'max_pages'] = 2
+
+        async def run():
+            try:
+                hung = asyncio.ensure_future(self.renderer.render(u'http://test/hang'))
+                await asyncio.sleep(0)
+
+                results = await asyncio.gather(*[self.renderer.render(u'http://test/{}'.format(i)) for i in range(5)])
+                proc = self.renderer._proc
+
+                return results, await hung, proc is self.renderer._proc
+            finally:
+                await self.renderer.shutdown()
+
+        results, hung, same_process = self._run(run())
+
+        # The other page kept rendering, and only the hung render failed
+        self.assertEqual([r[u'url'] for r in results], [u'http://test/{}'.format(i) for i in range(5)])
+        self.assertTrue(all(r[u'status'] == u'success' for r in results))
+        self.assertEqual(hung[u'error'], u'Render request has timed out.')
+        self.assertTrue(same_process)
+
+    def test_render_many(self):
+
+        async def requests():
+            for i in range(4):
+                yield {u'id': u'r{}'.format(i), u'url': u'http://test/{}'.format(i)}
+
+        async def run():
+            try:
+                results = [r async for r in self.renderer.render_many(requests(), concurrency=2)]
+                results += [r async for r in self.renderer.render_many([{u'url': u'http://test/plain'}])]
+                return results
+            finally:
+                await self.renderer.shutdown()
+
+        results = self._run(run())
+
+        self.assertEqual(sorted(r[u'id'] for r in results[:4]), [u'r0', u'r1', u'r2', u'r3'])
+        self.assertEqual(results[4][u'id'], 0)
+        self.assertEqual(results[4][u'url'], u'http://test/plain')
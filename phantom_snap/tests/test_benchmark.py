@@ -0,0 +1,67 @@
+# coding=utf-8
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+
+from unittest import TestCase, skipIf
+
+try:
+    # Only importable from a source checkout, the harness isn't part of the installed package
+    from benchmarks import run
+except ImportError:
+    run = None
+
+
+@skipIf(run is None, u'The benchmarks directory is not importable')
+class TestBenchmark(TestCase):
+
+    def test_run(self):
+
+        fd, output = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                status = run.main(['--modes', 'lifetime', 'pool', '--payloads', '1024', '--renders', '20',
+                                   '--crash-every', '7', '--stderr-lines', '2', '--output', output])
+
+            self.assertEqual(status, 0)
+
+            with open(output) as output_file:
+                results = json.load(output_file)[u'results']
+
+            self.assertEqual([result[u'mode'] for result in results], [u'lifetime', u'pool'])
+
+            for result in results:
+                self.assertEqual(result[u'renders'], 20)
+                self.assertGreater(result[u'failures'], 0)
+                self.assertLess(result[u'failures'], 20)
+                self.assertGreater(result[u'throughput_rps'], 0)
+                self.assertLessEqual(result[u'latency_ms'][u'p50'], result[u'latency_ms'][u'p99'])
+
+            self.assertIn(u'lifetime', stdout.getvalue())
+
+            # Compared with itself nothing has regressed
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(run.main(['--modes', 'lifetime', '--payloads', '1024', '--renders', '20',
+                                           '--compare', output, '--tolerance', '100']), 0)
+        finally:
+            os.remove(output)
+
+    def test_compare(self):
+
+        result = {u'mode': u'pool', u'payload_bytes': 1024, u'binary_images': False, u'concurrency': 4,
+                  u'throughput_rps': 10.0, u'latency_ms': {u'p50': 1.0, u'p99': 2.0}, u'cpu_ms_per_render': 1.0}
+
+        # A baseline with zero or missing figures can't be compared, rather than dividing by them
+        baseline = dict(result, throughput_rps=0, latency_ms={u'p50': 1.0, u'p99': None})
+        del baseline[u'cpu_ms_per_render']
+
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            self.assertFalse(run.compare([result], {u'results': [baseline]}, 0.1))
+            self.assertTrue(run.compare([dict(result, cpu_ms_per_render=2.0)], {u'results': [result]}, 0.1))
+
+        self.assertIn(u'n/a', stdout.getvalue())
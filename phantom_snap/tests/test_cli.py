@@ -0,0 +1,25 @@
+# coding=utf-8
+
+import contextlib
+import io
+import sys
+
+from unittest import TestCase
+from mock import patch
+
+from phantom_snap import cli
+
+
+class TestCli(TestCase):
+
+    def test_missing_dependency(self):
+
+        # None in sys.modules makes the import raise ImportError, as when the server extra isn't installed
+        with patch.dict(sys.modules, {'phantom_snap.server': None}), \
+                contextlib.redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit) as raised:
+                cli.main(['serve'])
+
+        self.assertEqual(raised.exception.code, 2)
+        self.assertIn(u'phantom-snap serve: error:', stderr.getvalue())
+        self.assertIn(u'pip install phantom-snap[server]', stderr.getvalue())
@@ -1,14 +1,20 @@
 # coding=utf-8
 
 import eventlet
+import base64
 import copy
+import os
+import shutil
+import tempfile
+import time
 
 from unittest import TestCase
 from mock import MagicMock
 
 from phantom_snap.settings import PHANTOMJS
 from phantom_snap.renderer import Renderer
-from phantom_snap.decorators import Lifetime
+from phantom_snap.decorators import Lifetime, CachingRenderer, CoalescingRenderer, HedgingRenderer
+from phantom_snap import decorators
 
 
 class MockRenderer(Renderer):
@@ -141,4 +147,437 @@ class TestPhantomJS(TestCase):
         r.shutdown()
 
         self.assertEqual(mock_r.render.call_count, 3)
-        self.assertEqual(mock_r.shutdown.call_count, 3)
\ No newline at end of file
+        self.assertEqual(mock_r.shutdown.call_count, 3)
+
+    def test_lifetime_concurrent(self):
+
+        mock_r = MockRenderer({
+            'idle_shutdown_sec': 60,
+            'max_lifetime_sec': 0.1
+        })
+
+        active = []
+
+        def render(*args):
+            active.append(args[0])
+            eventlet.sleep(0.3)
+            active.remove(args[0])
+            return len(active)
+
+        mock_r.render = MagicMock(side_effect=render)
+        mock_r.shutdown = MagicMock(side_effect=lambda *args: self.assertEqual(active, []))
+
+        r = Lifetime(mock_r)
+
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(r.render, [u'http://test/1', u'http://test/2']))
+
+        # Both renders overlapped, and the expired renderer was only shutdown once they completed
+        self.assertEqual(sorted(results), [0, 1])
+        eventlet.sleep(0.05)
+        self.assertEqual(mock_r.shutdown.call_count, 1)
+
+        r.shutdown()
+
+    def test_lifetime_max_renders(self):
+
+        mock_r = MockRenderer({'max_renders': 2})
+        mock_r.render = MagicMock()
+        mock_r.shutdown = MagicMock()
+
+        r = Lifetime(mock_r)
+
+        r.render(u'http://test')
+        self.assertEqual(mock_r.shutdown.call_count, 0)
+
+        with self.assertLogs(u'LifetimeDecorator', level=u'INFO') as logs:
+            r.render(u'http://test')
+
+            # The render waits for the monitor to recycle the renderer
+            r.render(u'http://test')
+            self.assertEqual(mock_r.shutdown.call_count, 1)
+
+        self.assertIn(u'max_renders 2', logs.output[0])
+        self.assertEqual(r.metrics.counter(u'restarts_total', {u'trigger': u'max_renders'}), 1)
+
+        # Warmups don't count toward max_renders
+        r.warmup()
+        r.warmup()
+        eventlet.sleep(0.05)
+        self.assertEqual(mock_r.shutdown.call_count, 1)
+
+        r.shutdown()
+
+    def test_lifetime_drain(self):
+
+        mock_r = MockRenderer({'max_renders': 1})
+        mock_r.render = MagicMock(side_effect=lambda *args: eventlet.sleep(0.2))
+        mock_r.shutdown = MagicMock()
+
+        r = Lifetime(mock_r)
+
+        # Continually busy, the renderer is still recycled once max_renders trips
+        pool = eventlet.GreenPool()
+        pool.spawn(r.render, u'http://test/1')
+        eventlet.sleep(0.05)
+        pool.spawn(r.render, u'http://test/2')
+        eventlet.sleep(0.05)
+        pool.spawn(r.render, u'http://test/3')
+        eventlet.sleep(0.12)
+
+        # test/1 finished, so test/4 is not admitted until test/2 and test/3 drain and the renderer recycles
+        self.assertEqual(mock_r.render.call_count, 3)
+        pool.spawn(r.render, u'http://test/4')
+        eventlet.sleep(0.02)
+        self.assertEqual(mock_r.render.call_count, 3)
+        self.assertEqual(mock_r.shutdown.call_count, 0)
+
+        eventlet.sleep(0.1)
+        self.assertEqual(mock_r.render.call_count, 4)
+        self.assertEqual(mock_r.shutdown.call_count, 1)
+
+        pool.waitall()
+
+        r.shutdown()
+
+    def test_lifetime_max_rss(self):
+
+        mock_r = MockRenderer({'max_rss_mb': 100, 'resource_check_sec': 0})
+        mock_r.render = MagicMock()
+        mock_r.shutdown = MagicMock()
+        mock_r.pid = 1234
+
+        r = Lifetime(mock_r)
+        original = decorators._process_rss_mb
+
+        try:
+            decorators._process_rss_mb = MagicMock(return_value=50.0)
+            r.render(u'http://test')
+            self.assertEqual(mock_r.shutdown.call_count, 0)
+
+            decorators._process_rss_mb = MagicMock(return_value=150.0)
+            with self.assertLogs(u'LifetimeDecorator', level=u'INFO') as logs:
+                r.render(u'http://test')
+                eventlet.sleep(0.05)
+
+            decorators._process_rss_mb.assert_called_with(1234)
+        finally:
+            decorators._process_rss_mb = original
+
+        self.assertEqual(mock_r.shutdown.call_count, 1)
+        self.assertIn(u'max_rss_mb 100', logs.output[0])
+
+        r.shutdown()
+
+    def test_lifetime_max_disk_cache(self):
+
+        cache_dir = tempfile.mkdtemp()
+
+        try:
+            mock_r = MockRenderer({
+                'args': PHANTOMJS['args'] + ['--disk-cache=true', '--disk-cache-path=' + cache_dir],
+                'max_disk_cache_mb': 1,
+                'clear_disk_cache': True,
+                'resource_check_sec': 0
+            })
+            mock_r.render = MagicMock()
+            mock_r.shutdown = MagicMock()
+
+            r = Lifetime(mock_r)
+
+            r.render(u'http://test')
+            self.assertEqual(mock_r.shutdown.call_count, 0)
+
+            os.mkdir(os.path.join(cache_dir, u'data8'))
+            with open(os.path.join(cache_dir, u'data8', u'entry'), 'wb') as entry:
+                entry.write(b'x' * (2 * 1024 * 1024))
+
+            with self.assertLogs(u'LifetimeDecorator', level=u'INFO') as logs:
+                r.render(u'http://test')
+                eventlet.sleep(0.05)
+
+            self.assertEqual(mock_r.shutdown.call_count, 1)
+            self.assertIn(u'max_disk_cache_mb 1', logs.output[0])
+            self.assertTrue(os.path.isdir(cache_dir))
+            self.assertEqual(os.listdir(cache_dir), [])
+
+            r.shutdown()
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_lifetime_recycle_waits_for_in_flight(self):
+
+        mock_r = MockRenderer({'max_renders': 1})
+        mock_r.render = MagicMock(side_effect=lambda *args: eventlet.sleep(0.1))
+        mock_r.shutdown = MagicMock()
+
+        r = Lifetime(mock_r)
+
+        slow = eventlet.spawn(r.render, u'http://test/1')
+        eventlet.sleep(0.05)
+        mock_r.render.side_effect = None
+        r.render(u'http://test/2')
+
+        self.assertEqual(mock_r.shutdown.call_count, 0)
+
+        slow.wait()
+        self.assertEqual(mock_r.shutdown.call_count, 1)
+
+        r.shutdown()
+
+
+class TestCachingRenderer(TestCase):
+
+    @staticmethod
+    def _response(url, status=u'success'):
+        return {u'url': url, u'status': status, u'base64': u'aW1hZ2U=', u'format': u'PNG', u'error': None}
+
+    def test_cache_hits(self):
+
+        mock_r = MockRenderer({})
+        mock_r.render = MagicMock(side_effect=lambda url, *args: self._response(url))
+
+        r = CachingRenderer(mock_r)
+
+        first = r.render(u'http://test', html=u'<b>hi</b>')
+        first[u'mutated'] = True
+        second = r.render(u'http://test', html=u'<b>hi</b>')
+        other = r.render(u'http://test', html=u'<b>bye</b>')
+
+        self.assertEqual(mock_r.render.call_count, 2)
+        self.assertEqual(second, self._response(u'http://test'))
+        self.assertEqual(other, self._response(u'http://test'))
+
+        # Timeouts don't change the key, the viewport does
+        r.render(u'http://test', html=u'<b>hi</b>', page_load_timeout=30)
+        r.render(u'http://test', html=u'<b>hi</b>', width=640)
+
+        self.assertEqual(mock_r.render.call_count, 3)
+        self.assertEqual(r.stats[u'hits'], 2)
+        self.assertEqual(r.stats[u'misses'], 3)
+
+    def test_failures_not_cached(self):
+
+        mock_r = MockRenderer({})
+        mock_r.render = MagicMock(side_effect=lambda url, *args: self._response(url, u'fail'))
+
+        r = CachingRenderer(mock_r)
+        r.render(u'http://test')
+        r.render(u'http://test')
+
+        self.assertEqual(mock_r.render.call_count, 2)
+
+        r = CachingRenderer(MockRenderer({'cache_failures': True}))
+        r._delegate.render = mock_r.render
+        r.render(u'http://test')
+        r.render(u'http://test')
+
+        self.assertEqual(mock_r.render.call_count, 3)
+
+    def test_lru_and_ttl(self):
+
+        mock_r = MockRenderer({'cache_max_bytes': 2 * (CachingRenderer._ENTRY_OVERHEAD + 8), 'cache_ttl_sec': 0.2})
+        mock_r.render = MagicMock(side_effect=lambda url, *args: self._response(url))
+
+        r = CachingRenderer(mock_r)
+
+        r.render(u'http://test/1')
+        r.render(u'http://test/2')
+        r.render(u'http://test/1')
+        r.render(u'http://test/3')
+
+        self.assertEqual(r.stats[u'evictions'], 1)
+        self.assertEqual(r.stats[u'entries'], 2)
+
+        # test/2 was least recently used
+        r.render(u'http://test/1')
+        r.render(u'http://test/2')
+        self.assertEqual(mock_r.render.call_count, 4)
+
+        eventlet.sleep(0.25)
+        r.render(u'http://test/1')
+        self.assertEqual(mock_r.render.call_count, 5)
+
+    def test_disk_tier(self):
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            mock_r = MockRenderer({'cache_dir': cache_dir})
+            mock_r.render = MagicMock(side_effect=lambda url, *args: self._response(url))
+
+            CachingRenderer(mock_r).render(u'http://test/1')
+            CachingRenderer(mock_r).render(u'http://test/2')
+
+            # A new instance, as after a restart, is served from disk
+            r = CachingRenderer(mock_r)
+
+            self.assertEqual(r.render(u'http://test/1'), self._response(u'http://test/1'))
+            self.assertEqual(mock_r.render.call_count, 2)
+            self.assertEqual(r.stats[u'disk_hits'], 1)
+
+            # Both renders produced the same image, which is stored once
+            images = [f for _, _, files in os.walk(os.path.join(cache_dir, u'images')) for f in files]
+            self.assertEqual(len(images), 1)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_disk_budget(self):
+
+        def render(url, *args):
+            return dict(self._response(url), base64=base64.b64encode(url.encode('ascii') * 100).decode('ascii'))
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            mock_r = MockRenderer({'cache_dir': cache_dir, 'cache_disk_max_bytes': 5000, 'cache_ttl_sec': 0.5})
+            mock_r.render = MagicMock(side_effect=render)
+
+            r = CachingRenderer(mock_r)
+            r._IMAGE_GRACE_SEC = 0
+
+            def files(kind):
+                return sorted(f for _, _, names in os.walk(os.path.join(cache_dir, kind)) for f in names)
+
+            for i in range(6):
+                r.render(u'http://test/{}'.format(i))
+
+            # Each image is 1300 bytes, so the oldest responses and their images were pruned to stay under budget
+            self.assertEqual(len(files(u'responses')), 3)
+            self.assertEqual(len(files(u'images')), 3)
+            self.assertEqual(r.stats[u'disk_evictions'], 3)
+
+            r.clear()
+            r.render(u'http://test/5')
+            r.render(u'http://test/0')
+            self.assertEqual(r.stats[u'disk_hits'], 1)
+
+            eventlet.sleep(0.6)
+            self.assertGreater(r.prune_disk(), 0)
+            self.assertEqual(files(u'responses'), [])
+            self.assertEqual(files(u'images'), [])
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class TestCoalescingRenderer(TestCase):
+
+    def test_coalesce(self):
+
+        def render(url, *args):
+            eventlet.sleep(0.1)
+            if url == u'http://error':
+                raise ValueError(url)
+            return {u'url': url, u'status': u'success'}
+
+        mock_r = MockRenderer({})
+        mock_r.render = MagicMock(side_effect=render)
+
+        r = CoalescingRenderer(mock_r)
+
+        pool = eventlet.GreenPool()
+        urls = [u'http://test/1'] * 5 + [u'http://test/2'] * 3
+        results = list(pool.imap(r.render, urls))
+
+        self.assertEqual([result[u'url'] for result in results], urls)
+        self.assertEqual(mock_r.render.call_count, 2)
+        self.assertEqual(r.stats, {u'renders': 2, u'coalesced': 6, u'in_flight': 0})
+
+        # Every caller has its own copy of the response
+        results[0][u'mutated'] = True
+        self.assertNotIn(u'mutated', results[1])
+
+        # Once complete, the same request renders again
+        r.render(u'http://test/1')
+        self.assertEqual(mock_r.render.call_count, 3)
+
+        # Errors reach every waiting caller
+        errors = [eventlet.spawn(r.render, u'http://error') for _ in range(3)]
+        for thread in errors:
+            self.assertRaises(ValueError, thread.wait)
+
+        self.assertEqual(mock_r.render.call_count, 4)
+
+
+class TestHedgingRenderer(TestCase):
+
+    config = {'hedge_min_samples': 5, 'hedge_min_delay_sec': 0.05, 'hedge_percentile': 50}
+
+    def test_hedge_slow_render(self):
+
+        def render(url, *args):
+            eventlet.sleep(1 if url == u'http://slow' and mock_r.render.call_count == 6 else 0.01)
+            return {u'url': url, u'status': u'success'}
+
+        mock_r = MockRenderer(self.config)
+        mock_r.render = MagicMock(side_effect=render)
+
+        mock_hedge = MockRenderer(self.config)
+        mock_hedge.render = MagicMock(return_value={u'url': u'http://slow', u'status': u'success'})
+
+        r = HedgingRenderer(mock_r, hedge_renderer=mock_hedge)
+
+        # No hedging until enough latencies have been measured
+        self.assertIsNone(r.hedge_delay())
+
+        for _ in range(5):
+            r.render(u'http://fast')
+
+        self.assertEqual(r.hedge_delay(), 0.05)
+
+        # The first attempt hangs, the hedge answers
+        start = time.time()
+        self.assertEqual(r.render(u'http://slow')[u'status'], u'success')
+        self.assertLess(time.time() - start, 0.5)
+
+        self.assertEqual(mock_r.render.call_count, 6)
+        self.assertEqual(mock_hedge.render.call_count, 1)
+        self.assertEqual(r.stats[u'hedged'], 1)
+        self.assertEqual(r.stats[u'hedge_wins'], 1)
+        self.assertEqual(r.metrics.counter(u'hedges_total'), 1)
+
+    def test_hedge_renderer_and_failures(self):
+
+        mock_r = MockRenderer(self.config)
+        mock_r.render = MagicMock(side_effect=lambda url, *args: eventlet.sleep(0.2) or {u'status': u'fail'})
+
+        mock_hedge = MockRenderer(self.config)
+        mock_hedge.render = MagicMock(return_value={u'status': u'fail'})
+
+        r = HedgingRenderer(mock_r, hedge_renderer=mock_hedge)
+        r._latencies.extend([0.01] * 5)
+
+        # Both fail, so a failure is returned
+        self.assertEqual(r.render(u'http://test')[u'status'], u'fail')
+        self.assertEqual(mock_hedge.render.call_count, 1)
+        self.assertEqual(r.stats[u'hedge_wins'], 0)
+
+        # A render failing before the delay isn't hedged
+        mock_r.render = MagicMock(side_effect=ValueError(u'bad'))
+        self.assertRaises(ValueError, r.render, u'http://test')
+        self.assertEqual(mock_hedge.render.call_count, 1)
+
+    def test_hedge_rate(self):
+
+        mock_r = MockRenderer(dict(self.config, hedge_max_rate=0.25, hedge_burst=2))
+        mock_r.render = MagicMock(side_effect=lambda url, *args: eventlet.sleep(0.1) or {u'status': u'success'})
+
+        r = HedgingRenderer(mock_r, hedge_renderer=MockRenderer(self.config))
+        r._latencies.extend([0.01] * 1000)
+
+        for _ in range(10):
+            r.render(u'http://test')
+
+        # The burst of two, then one for every four renders
+        self.assertEqual(r.stats[u'hedged'], 4)
+        self.assertEqual(r.metrics.counter(u'hedges_skipped_total'), 6)
+
+    def test_same_renderer_not_hedged(self):
+
+        mock_r = MockRenderer(self.config)
+        mock_r.render = MagicMock(side_effect=lambda url, *args: eventlet.sleep(0.2) or {u'status': u'success'})
+
+        r = HedgingRenderer(mock_r, hedge_renderer=mock_r)
+        r._latencies.extend([0.01] * 5)
+
+        self.assertEqual(r.render(u'http://test')[u'status'], u'success')
+        self.assertEqual(mock_r.render.call_count, 1)
+        self.assertEqual(r.stats[u'hedged'], 0)
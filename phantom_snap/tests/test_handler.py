@@ -0,0 +1,78 @@
+# coding=utf-8
+
+import json
+import os
+
+from unittest import TestCase, skipIf
+from mock import MagicMock, patch
+
+try:
+    # Only importable from a source checkout with the function's requirements, it isn't part of the package.
+    # The module scope renderer is replaced in the tests, so PhantomJS isn't needed to build it.
+    with patch.dict(os.environ, {'PHANTOMJS_PREWARM': 'false'}), \
+            patch('phantom_snap.phantom.PhantomJSRenderer._which', return_value=True):
+        from serverless import handler
+except ImportError:
+    handler = None
+
+
+class _Context(object):
+    """Stands in for the Lambda context, with a fixed amount of time left."""
+
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def _render_many(requests, concurrency=1):
+    for request in requests:
+        yield {u'id': request[u'id'], u'status': u'success'}
+
+
+@skipIf(handler is None, u'The serverless handler is not importable')
+class TestHandler(TestCase):
+
+    def _renderer(self, ready):
+        renderer = MagicMock()
+        renderer.ready = ready
+        renderer.get_config.return_value = {
+            u'max_pages': 1,
+            u'timeouts': {u'initial_page_load': 20, u'page_load': 15, u'render_response': 10},
+        }
+        renderer.render_many.side_effect = _render_many
+        return renderer
+
+    def _requests(self, count, page_load_timeout=None):
+        return [{u'id': i, u'page_load_timeout': page_load_timeout} for i in range(count)]
+
+    def test_in_time_reserves_render_response(self):
+        with patch.object(handler, 'renderer', self._renderer(True)):
+            needed_ms = (15 + 10) * 1000 + handler.BATCH_MARGIN_MS
+
+            self.assertEqual(len(list(handler._in_time(self._requests(2), _Context(needed_ms)))), 2)
+            self.assertEqual(list(handler._in_time(self._requests(2), _Context(needed_ms - 1))), [])
+
+            # A request's own page load timeout replaces the configured one
+            needed_ms = (30 + 10) * 1000 + handler.BATCH_MARGIN_MS
+            self.assertEqual(list(handler._in_time(self._requests(2, 30), _Context(needed_ms - 1))), [])
+
+    def test_in_time_cold_process(self):
+        with patch.object(handler, 'renderer', self._renderer(False)):
+            needed_ms = (20 + 10) * 1000 + handler.BATCH_MARGIN_MS
+
+            self.assertEqual(len(list(handler._in_time(self._requests(1), _Context(needed_ms)))), 1)
+            self.assertEqual(list(handler._in_time(self._requests(1), _Context(needed_ms - 1))), [])
+
+    def test_render_batch_out_of_time(self):
+        event = {'body': json.dumps({'requests': [{'url': 'http://a'}, {'url': 'http://b'}]})}
+        remaining_ms = (15 + 10) * 1000 + handler.BATCH_MARGIN_MS - 1
+
+        with patch.object(handler, 'renderer', self._renderer(True)):
+            response = handler.render_batch(event, _Context(remaining_ms))
+
+        results = json.loads(response['body'])['results']
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual([result[u'status'] for result in results], [u'fail', u'fail'])
+        self.assertIn(u'ran out of time', results[0][u'error'])
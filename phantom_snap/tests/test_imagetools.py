@@ -0,0 +1,259 @@
+# coding=utf-8
+
+import eventlet
+import io
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase, skipIf
+from mock import patch
+
+from phantom_snap import imagetools
+from phantom_snap.imagetools import ImageWriter, DerivativePipeline, ChangeDetector, save_image, Image, numpy
+from phantom_snap.protocol import empty_response
+
+
+def _response(url, image):
+
+    response = empty_response(url, u'PNG')
+    response[u'status'] = u'success'
+    response[u'image'] = memoryview(image)
+    return response
+
+
+class TestImageWriter(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def test_write(self):
+
+        with ImageWriter({'writer_threads': 2}) as writer:
+            self.assertTrue(writer.write(self._path(u'renders', u'a'), {u'format': u'PNG', u'base64': u'aW1hZ2U='}))
+            self.assertTrue(writer.write(self._path(u'renders', u'b'), _response(u'http://b', b'binary')))
+            self.assertFalse(writer.write(self._path(u'renders', u'c'), empty_response(u'http://c', u'PNG')))
+
+        with open(self._path(u'renders', u'a.png'), 'rb') as image_file:
+            self.assertEqual(image_file.read(), b'image')
+
+        with open(self._path(u'renders', u'b.png'), 'rb') as image_file:
+            self.assertEqual(image_file.read(), b'binary')
+
+        self.assertEqual(sorted(os.listdir(self._path(u'renders'))), [u'a.png', u'b.png'])
+        self.assertEqual(writer.stats[u'files'], 2)
+        self.assertEqual(writer.stats[u'bytes_written'], 11)
+        self.assertEqual(writer.stats[u'queue_depth'], 0)
+        self.assertRaises(ValueError, writer.write, self._path(u'd'), _response(u'http://d', b'late'))
+
+    def test_dedupe(self):
+
+        for dedupe in (u'hardlink', u'symlink'):
+            store = self._path(dedupe, u'store')
+
+            with ImageWriter({'dedupe': dedupe, 'store_dir': store}) as writer:
+                for name in (u'a', u'b', u'c'):
+                    writer.write(self._path(dedupe, name), _response(name, b'same image'))
+
+                writer.write(self._path(dedupe, u'd'), _response(u'd', b'other image'))
+
+            self.assertEqual(writer.stats[u'files'], 4)
+            self.assertEqual(writer.stats[u'deduplicated'], 2)
+            self.assertEqual(writer.stats[u'dedupe_ratio'], 0.5)
+            self.assertEqual(writer.stats[u'bytes_written'], len(b'same image') + len(b'other image'))
+
+            shards = os.listdir(store)
+            self.assertEqual(len(os.listdir(os.path.join(store, shards[0]))), 1)
+
+            with open(self._path(dedupe, u'c.png'), 'rb') as image_file:
+                self.assertEqual(image_file.read(), b'same image')
+
+            if dedupe == u'hardlink':
+                self.assertEqual(os.stat(self._path(dedupe, u'a.png')).st_ino,
+                                 os.stat(self._path(dedupe, u'b.png')).st_ino)
+            else:
+                self.assertTrue(os.path.islink(self._path(dedupe, u'a.png')))
+
+        self.assertRaises(ValueError, ImageWriter, {'dedupe': u'hardlink'})
+
+    def test_fsync_batch(self):
+
+        with patch.object(imagetools, '_fsync_paths') as fsync_paths:
+            writer = ImageWriter({'fsync_batch': 2, 'writer_threads': 1})
+
+            for name in (u'a', u'b', u'c'):
+                writer.write(self._path(name), _response(name, b'image'))
+
+            eventlet.sleep(0.1)
+            self.assertEqual(fsync_paths.call_count, 1)
+            self.assertEqual(len(fsync_paths.call_args[0][0]), 2)
+
+            # The rest are synced by flush() without waiting for a full batch
+            writer.flush()
+            self.assertEqual(fsync_paths.call_count, 2)
+            self.assertEqual(fsync_paths.call_args[0][0], [self._path(u'c.png')])
+
+            writer.close()
+            self.assertEqual(fsync_paths.call_count, 2)
+
+        imagetools._fsync_paths([self._path(u'a.png')])
+
+    def test_write_errors(self):
+
+        with ImageWriter() as writer:
+            writer.write(self._path(u'a'), {u'format': None, u'base64': u'aW1hZ2U='})
+
+        self.assertEqual(writer.stats[u'errors'], 1)
+        self.assertEqual(writer.stats[u'files'], 0)
+
+    def test_save_image(self):
+
+        self.assertTrue(save_image(self._path(u'saved'), _response(u'http://a', b'image')))
+        self.assertFalse(save_image(self._path(u'missing'), empty_response(u'http://b', u'PNG')))
+
+        with open(self._path(u'saved.png'), 'rb') as image_file:
+            self.assertEqual(image_file.read(), b'image')
+
+        unchanged = _response(u'http://a', b'image')
+        unchanged[u'unchanged'] = True
+
+        self.assertFalse(save_image(self._path(u'unchanged'), unchanged))
+        self.assertFalse(os.path.exists(self._path(u'unchanged.png')))
+
+        with ImageWriter() as writer:
+            self.assertFalse(writer.write(self._path(u'unchanged'), unchanged))
+
+
+@skipIf(Image is None, u'Pillow is not installed')
+class TestDerivativePipeline(TestCase):
+
+    DERIVATIVES = [
+        {u'name': u'thumb', u'width': 100, u'height': 100, u'format': u'WEBP', u'quality': 70},
+        {u'name': u'small', u'width': 400, u'height': None, u'format': u'jpeg'}
+    ]
+
+    def setUp(self):
+
+        buffer = io.BytesIO()
+        Image.new(u'RGBA', (800, 600), (255, 0, 0, 128)).save(buffer, format=u'PNG')
+
+        self.response = _response(u'http://test', buffer.getvalue())
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_process(self):
+
+        with DerivativePipeline({u'processes': 2, u'derivatives': self.DERIVATIVES}) as pipeline:
+            response = pipeline.process(self.response)
+
+            self.assertIsNone(pipeline.submit(empty_response(u'http://empty', u'PNG')))
+
+        thumb = response[u'derivatives'][u'thumb']
+        small = response[u'derivatives'][u'small']
+
+        self.assertEqual((thumb[u'format'], thumb[u'width'], thumb[u'height']), (u'WEBP', 100, 75))
+        self.assertEqual((small[u'format'], small[u'width'], small[u'height']), (u'JPEG', 400, 300))
+        self.assertEqual(Image.open(io.BytesIO(thumb[u'image'])).format, u'WEBP')
+        self.assertEqual(small[u'size'], len(small[u'image']))
+
+    def test_write(self):
+
+        filename = os.path.join(self.directory, u'renders', u'page')
+
+        with DerivativePipeline({u'derivatives': self.DERIVATIVES}) as pipeline:
+            derivatives = pipeline.submit(self.response, filename).result()
+
+        self.assertEqual(derivatives[u'thumb'][u'path'], filename + u'.thumb.webp')
+        self.assertNotIn(u'image', derivatives[u'thumb'])
+        self.assertEqual(Image.open(filename + u'.small.jpeg').size, (400, 300))
+
+    def test_invalid_config(self):
+        self.assertRaises(ValueError, DerivativePipeline, {u'derivatives': [{u'width': 10}]})
+
+
+def _png(draw):
+    """PNG of a gradient page, with draw(pixels) applied to its pixel access object."""
+
+    image = Image.new(u'RGB', (320, 240))
+    pixels = image.load()
+
+    for x in range(320):
+        for y in range(240):
+            pixels[x, y] = (x * 255 // 320, y * 255 // 240, 128)
+
+    draw(pixels)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=u'PNG')
+    return buffer.getvalue()
+
+
+@skipIf(Image is None or numpy is None, u'Pillow and NumPy are not installed')
+class TestChangeDetector(TestCase):
+
+    def setUp(self):
+
+        def nothing(pixels):
+            pass
+
+        def speck(pixels):
+            pixels[10, 10] = (255, 255, 255)
+
+        def block(pixels):
+            for x in range(160):
+                for y in range(120):
+                    pixels[x, y] = (255, 255, 255)
+
+        self.original = _png(nothing)
+        self.similar = _png(speck)
+        self.different = _png(block)
+
+    def test_check(self):
+
+        for method in (u'dhash', u'phash'):
+            detector = ChangeDetector({u'hash': method})
+
+            first = detector.check(_response(u'http://a', self.original))
+            similar = detector.check(_response(u'http://a', self.similar))
+            different = detector.check(_response(u'http://a', self.different))
+            other_url = detector.check(_response(u'http://b', self.original))
+
+            self.assertFalse(first[u'unchanged'], method)
+            self.assertTrue(similar[u'unchanged'], method)
+            self.assertFalse(different[u'unchanged'], method)
+            self.assertFalse(other_url[u'unchanged'], method)
+            self.assertEqual(len(first[u'perceptual_hash']), 16)
+
+            # The stored image is now the different one
+            self.assertTrue(detector.check(_response(u'http://a', self.different))[u'unchanged'], method)
+
+            self.assertEqual(detector.stats, {u'checked': 5, u'unchanged': 2, u'urls': 2})
+
+        no_image = detector.check(empty_response(u'http://c', u'PNG'))
+        self.assertNotIn(u'unchanged', no_image)
+
+    def test_index(self):
+
+        detector = ChangeDetector({u'max_urls': 1})
+        detector.check(_response(u'http://a', self.original))
+        detector.check(_response(u'http://b', self.original))
+
+        self.assertFalse(detector.check(_response(u'http://a', self.original))[u'unchanged'])
+
+        index = {}
+        detector = ChangeDetector(index=index)
+        detector.check(_response(u'http://a', self.original))
+
+        self.assertEqual(list(index), [u'http://a'])
+        self.assertTrue(ChangeDetector(index=index).check(_response(u'http://a', self.similar))[u'unchanged'])
+
+        detector.forget(u'http://a')
+        self.assertEqual(index, {})
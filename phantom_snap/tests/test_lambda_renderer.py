@@ -1,8 +1,13 @@
 from unittest import TestCase
-from phantom_snap.lambda_renderer import LambdaRenderer
-from mock import patch
-from requests.exceptions import ConnectionError
+from phantom_snap.lambda_renderer import LambdaRenderer, AdaptiveLimit
+from phantom_snap.settings import LAMBDA
+from mock import MagicMock, patch
+from requests.exceptions import ConnectionError, Timeout
 import copy
+import gzip
+import json
+import threading
+import time
 
 
 class TestLambda(TestCase):
@@ -127,11 +132,13 @@ class TestLambda(TestCase):
             def __init__(self, o, s):
                 self.o = o
                 self.status_code = s
+                self.content = json.dumps(o).encode('utf-8')
+                self.headers = {}
 
             def json(self):
                 return self.o
 
-        with patch('requests.post') as r:
+        with patch('requests.Session.post') as r:
             # perfect result
             res = {
                 u'status': u'success',
@@ -145,6 +152,8 @@ class TestLambda(TestCase):
             r.return_value = ReqRes(res, 200)
             self.assertEqual(lr.render(url='http://www.urlhere.com'),
                              res)
+            self.assertEqual(lr.metrics.histogram(u'request_seconds').count, 1)
+            self.assertEqual(lr.metrics.counter(u'renders_total', {u'status': u'success'}), 1)
 
             # requests execption
             with patch('traceback.format_exc') as t:
@@ -231,3 +240,269 @@ class TestLambda(TestCase):
             self.assertEqual(lr.render(url='http://www.urlhere.com'),
                              expected)
 
+
+    def test_session(self):
+        lr = LambdaRenderer({'url': 'https://my-url', 'pool_maxsize': 32})
+
+        adapter = lr._session.get_adapter('https://my-url')
+        self.assertEqual(adapter._pool_maxsize, 32)
+        self.assertIn('gzip', lr._session.headers['accept-encoding'])
+
+        with patch('requests.Session.post') as r:
+            r.return_value.status_code = 200
+            r.return_value.content = b'{}'
+            r.return_value.headers = {}
+            r.return_value.json.return_value = {u'status': u'success', u'base64': None}
+
+            lr.render(url='http://www.urlhere.com')
+            lr.render(url='http://www.urlhere.com')
+
+            self.assertEqual(r.call_count, 2)
+            self.assertEqual(r.call_args[1]['url'], 'https://my-url')
+            self.assertEqual(json.loads(r.call_args[1]['data'].decode('utf-8'))['url'], 'http://www.urlhere.com')
+            self.assertNotIn('content-encoding', r.call_args[1]['headers'])
+
+        lr.shutdown()
+
+    def test_compress_requests(self):
+        lr = LambdaRenderer({'url': 'my-url', 'compress_requests': True, 'compress_min_bytes': 1024})
+
+        headers = {}
+        body = lr._prep_body({'url': 'http://small'}, headers)
+        self.assertEqual(json.loads(body.decode('utf-8')), {'url': 'http://small'})
+        self.assertEqual(headers, {})
+
+        json_dict = lr._prep_json(url='myurl', html='<p>hello</p>' * 1000, img_format='png', width=5, height=6,
+                                  page_load_timeout=None, user_agent=None, headers=None, cookies=None,
+                                  html_encoding=u'utf-8', http_proxy=None)
+        body = lr._prep_body(json_dict, headers)
+
+        self.assertEqual(headers, {'content-encoding': 'gzip'})
+        self.assertEqual(json.loads(gzip.decompress(body).decode('utf-8')), json_dict)
+
+    def test_binary_responses(self):
+        lr = LambdaRenderer({'url': 'my-url', 'binary_responses': True})
+        self.assertIn('application/octet-stream', lr._prep_headers()['accept'])
+
+        image = b'\x89PNG\x00\xff' * 100
+        metadata = {u'url': u'http://test', u'status': u'success', u'format': u'PNG', u'load_time': 3,
+                    u'paint_time': 4, u'error': None}
+
+        with patch('requests.Session.post') as r:
+            r.return_value.status_code = 200
+            r.return_value.content = image
+            r.return_value.headers = {'X-Render-Result': json.dumps(metadata)}
+
+            response = lr.render(url='http://test')
+
+        self.assertEqual(response[u'status'], u'success')
+        self.assertEqual(response[u'load_time'], 3)
+        self.assertEqual(response[u'image'], image)
+        self.assertIsNone(response[u'base64'])
+        self.assertEqual(lr.metrics.histogram(u'image_bytes').sum, len(image))
+
+    def test_non_object_response(self):
+        lr = LambdaRenderer({'url': 'my-url'})
+
+        with patch('requests.Session.post') as r:
+            r.return_value.status_code = 200
+            r.return_value.content = b'[1, 2]'
+            r.return_value.headers = {}
+            r.return_value.json.return_value = [1, 2]
+
+            response = lr.render(url='http://test')
+            batch = list(lr.render_batches([{u'url': u'http://test'}]))
+
+        self.assertEqual(response[u'status'], u'fail')
+        self.assertIn(u'JSON object', response[u'error'])
+        self.assertEqual(batch[0][u'status'], u'fail')
+
+    def test_render_many(self):
+        lr = LambdaRenderer({'url': 'my-url', 'fan_out': {'initial_concurrency': 2, 'max_concurrency': 8}})
+
+        lock = threading.Lock()
+        in_flight = [0, 0]  # current, max
+
+        def post(url, data, headers, allow_redirects, timeout):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+
+            time.sleep(0.01)
+
+            with lock:
+                in_flight[0] -= 1
+
+            request = json.loads(data.decode('utf-8'))
+            response = MagicMock(status_code=200, content=b'{}', headers={})
+            response.json.return_value = {u'url': request['url'], u'status': u'success', u'base64': None}
+            return response
+
+        with patch('requests.Session.post', side_effect=post):
+            requests = ({u'id': i, u'url': u'http://test/{}'.format(i)} for i in range(40))
+            results = list(lr.render_many(requests))
+
+        self.assertEqual(sorted(r[u'id'] for r in results), list(range(40)))
+        self.assertTrue(all(r[u'url'] == u'http://test/{}'.format(r[u'id']) for r in results))
+
+        # The limit grew from 2 as requests succeeded, but never past the max
+        self.assertGreater(lr.limit.value, 2)
+        self.assertGreater(in_flight[1], 2)
+        self.assertLessEqual(in_flight[1], 8)
+
+    def test_render_many_throttled(self):
+        lr = LambdaRenderer({'url': 'my-url', 'fan_out': {'initial_concurrency': 8, 'throttle_retries': 1,
+                                                          'retry_backoff_sec': 0}})
+
+        throttled = MagicMock(status_code=429, content=b'{}', headers={})
+        throttled.json.return_value = {u'message': u'Too Many Requests'}
+        success = MagicMock(status_code=200, content=b'{}', headers={})
+        success.json.return_value = {u'status': u'success', u'base64': None}
+
+        with patch('requests.Session.post', side_effect=[throttled, success]):
+            results = list(lr.render_many([{u'url': u'http://test'}], concurrency=1))
+
+        self.assertEqual(results[0][u'status'], u'success')
+        self.assertEqual(lr.limit.value, 4)
+        self.assertEqual(lr.metrics.counter(u'throttled_total'), 1)
+
+    def test_render_many_timeout(self):
+        lr = LambdaRenderer({'url': 'my-url', 'fan_out': {'initial_concurrency': 8, 'throttle_retries': 1,
+                                                          'retry_backoff_sec': 0}})
+
+        success = MagicMock(status_code=200, content=b'{}', headers={})
+        success.json.return_value = {u'status': u'success', u'base64': None}
+
+        # Without a deadline a timeout lowers the limit, but isn't retried
+        with patch('requests.Session.post', side_effect=[Timeout('slow'), success]) as r:
+            results = list(lr.render_many([{u'url': u'http://test'}], concurrency=1))
+            self.assertEqual(r.call_count, 1)
+
+        self.assertEqual(results[0][u'status'], u'fail')
+        self.assertEqual(lr.limit.value, 4)
+        self.assertEqual(lr.metrics.counter(u'throttled_total'), 0)
+
+        # Nor is a connection error or a gateway error
+        bad_gateway = MagicMock(status_code=502, content=b'{}', headers={})
+        bad_gateway.json.return_value = {u'message': u'Bad Gateway'}
+
+        for error in (ConnectionError('bad'), bad_gateway):
+            with patch('requests.Session.post', side_effect=[error, success]) as r:
+                results = list(lr.render_many([{u'url': u'http://test'}], concurrency=1))
+                self.assertEqual(r.call_count, 1)
+
+            self.assertEqual(results[0][u'status'], u'fail')
+
+        # A request with a deadline still ahead is retried
+        with patch('requests.Session.post', side_effect=[Timeout('slow'), success]) as r:
+            results = list(lr.render_many([{u'url': u'http://test', u'deadline': time.time() + 5}], concurrency=1))
+            self.assertEqual(r.call_count, 2)
+
+        self.assertEqual(results[0][u'status'], u'success')
+
+    def test_render_many_deadline(self):
+        lr = LambdaRenderer({'url': 'my-url', 'timeouts': {'request_timeout': 60}})
+
+        with patch('requests.Session.post') as r:
+            r.return_value.status_code = 200
+            r.return_value.content = b'{}'
+            r.return_value.headers = {}
+            r.return_value.json.return_value = {u'status': u'success', u'base64': None}
+
+            results = list(lr.render_many([{u'id': u'late', u'url': u'http://test', u'deadline': time.time() - 1},
+                                           {u'id': u'soon', u'url': u'http://test', u'deadline': time.time() + 5}]))
+
+            self.assertEqual(r.call_count, 1)
+            self.assertLessEqual(r.call_args[1]['timeout'], 5)
+
+        results = dict((result[u'id'], result) for result in results)
+        self.assertEqual(results[u'late'][u'status'], u'fail')
+        self.assertIn(u'Deadline', results[u'late'][u'error'])
+        self.assertEqual(results[u'soon'][u'status'], u'success')
+        self.assertEqual(lr.metrics.counter(u'deadlines_exceeded_total'), 1)
+
+    def test_render_batches(self):
+        lr = LambdaRenderer({'url': 'https://my-url/render', 'max_batch_size': 3, 'max_batch_bytes': 4096})
+
+        def post(url, data, headers, allow_redirects, timeout):
+            requests = json.loads(data.decode('utf-8'))['requests']
+            response = MagicMock(status_code=200, content=b'{}', headers={})
+            # Answered out of order, and missing the last request of a full batch
+            results = [{u'id': r['id'], u'url': r['url'], u'status': u'success', u'base64': None}
+                       for r in reversed(requests[:2] if len(requests) == 3 else requests)]
+            response.json.return_value = {u'results': results}
+            return response
+
+        requests = [{u'id': u'big', u'url': u'http://test/big', u'html': u'<p>big</p>' * 500}] + \
+                   [{u'url': u'http://test/{}'.format(i)} for i in range(1, 5)]
+
+        with patch('requests.Session.post', side_effect=post) as r:
+            results = list(lr.render_batches(requests, concurrency=1))
+
+            # The large html fills a batch of its own, the rest are packed by count
+            sizes = [len(json.loads(call[1]['data'].decode('utf-8'))['requests']) for call in r.call_args_list]
+            self.assertEqual(sizes, [1, 3, 1])
+            self.assertEqual(r.call_args[1]['url'], 'https://my-url/render/batch')
+
+        results = dict((result[u'id'], result) for result in results)
+        self.assertEqual(sorted(results, key=str), [1, 2, 3, 4, u'big'])
+        self.assertEqual(results[u'big'][u'url'], u'http://test/big')
+        self.assertEqual(results[2][u'url'], u'http://test/2')
+        self.assertEqual(results[3][u'status'], u'fail')
+        self.assertIn(u'No result', results[3][u'error'])
+        self.assertEqual(lr.metrics.counter(u'renders_total', {u'status': u'success'}), 4)
+
+    def test_render_batches_failed(self):
+        lr = LambdaRenderer({'url': 'my-url', 'batch_url': 'my-batch-url'})
+
+        with patch('requests.Session.post') as r:
+            r.return_value.status_code = 500
+            r.return_value.content = b'{}'
+            r.return_value.headers = {}
+            r.return_value.json.return_value = {u'message': u'Uncaught Exception', u'ex': u'traceback_here'}
+
+            results = list(lr.render_batches([{u'url': u'http://test/1'}, {u'url': u'http://test/2'}]))
+            self.assertEqual(r.call_args[1]['url'], 'my-batch-url')
+
+        self.assertEqual([result[u'status'] for result in results], [u'fail', u'fail'])
+        self.assertEqual([result[u'error'] for result in results], [u'traceback_here', u'traceback_here'])
+        self.assertEqual([result[u'id'] for result in results], [0, 1])
+
+
+class TestAdaptiveLimit(TestCase):
+
+    def setUp(self):
+        self.config = copy.deepcopy(LAMBDA['fan_out'])
+        self.config.update({'initial_concurrency': 4, 'max_concurrency': 6, 'latency_target_sec': 1})
+
+    def test_increase(self):
+        limit = AdaptiveLimit(self.config)
+
+        # About one more per round trip of successes
+        for _ in range(5):
+            limit.success(time.time(), 0.1)
+
+        self.assertEqual(limit.value, 5)
+
+        for _ in range(100):
+            limit.success(time.time(), 0.1)
+
+        self.assertEqual(limit.value, 6)
+
+    def test_decrease(self):
+        limit = AdaptiveLimit(self.config)
+        start_time = time.time()
+
+        limit.overload(start_time)
+        self.assertEqual(limit.value, 2)
+
+        # Requests sent before the decrease don't decrease it again
+        limit.overload(start_time)
+        self.assertEqual(limit.value, 2)
+
+        # Slow requests are overload
+        limit.success(time.time(), 2)
+        self.assertEqual(limit.value, 1)
+
+        limit.overload(time.time())
+        self.assertEqual(limit.value, 1)
@@ -0,0 +1,81 @@
+# coding=utf-8
+
+from unittest import TestCase
+from mock import MagicMock
+
+from phantom_snap.metrics import Metrics
+
+
+class TestMetrics(TestCase):
+
+    def test_histogram(self):
+
+        metrics = Metrics()
+        metrics.observe(u'response_seconds', 0.002)
+        metrics.observe(u'response_seconds', 0.2)
+        metrics.observe(u'response_seconds', 120)
+
+        histogram = metrics.histogram(u'response_seconds')
+
+        self.assertEqual(histogram.count, 3)
+        self.assertAlmostEqual(histogram.sum, 120.202)
+        self.assertEqual(dict(histogram.cumulative())[0.0025], 1)
+        self.assertEqual(dict(histogram.cumulative())[0.25], 2)
+        self.assertEqual(histogram.cumulative()[-1], (float('inf'), 3))
+        self.assertIsNone(metrics.histogram(u'decode_seconds'))
+
+    def test_counters_and_callback(self):
+
+        callback = MagicMock()
+        metrics = Metrics(callback=callback)
+
+        metrics.increment(u'restarts_total', labels={u'trigger': u'max_renders'})
+        metrics.increment(u'restarts_total', labels={u'trigger': u'max_renders'})
+        metrics.observe(u'image_bytes', 2048)
+
+        self.assertEqual(metrics.counter(u'restarts_total', {u'trigger': u'max_renders'}), 2)
+        self.assertEqual(metrics.counter(u'restarts_total'), 0)
+        callback.assert_called_with(u'histogram', u'image_bytes', 2048, None)
+        self.assertEqual(callback.call_count, 3)
+
+    def test_broken_callback(self):
+
+        metrics = Metrics(callback=MagicMock(side_effect=RuntimeError))
+        metrics.increment(u'timeouts_total')
+
+        self.assertEqual(metrics.counter(u'timeouts_total'), 1)
+
+    def test_prometheus(self):
+
+        metrics = Metrics()
+        metrics.increment(u'renders_total', labels={u'status': u'success'})
+        metrics.increment(u'renders_total', labels={u'status': u'fail'})
+        metrics.observe(u'image_bytes', 2048)
+
+        text = metrics.prometheus()
+
+        self.assertIn(u'# TYPE phantom_snap_renders_total counter\n', text)
+        self.assertEqual(text.count(u'# TYPE phantom_snap_renders_total'), 1)
+        self.assertIn(u'phantom_snap_renders_total{status="fail"} 1\n', text)
+        self.assertIn(u'# TYPE phantom_snap_image_bytes histogram\n', text)
+        self.assertIn(u'phantom_snap_image_bytes_bucket{le="1024"} 0\n', text)
+        self.assertIn(u'phantom_snap_image_bytes_bucket{le="4096"} 1\n', text)
+        self.assertIn(u'phantom_snap_image_bytes_bucket{le="+Inf"} 1\n', text)
+        self.assertIn(u'phantom_snap_image_bytes_sum 2048.0\n', text)
+        self.assertIn(u'phantom_snap_image_bytes_count 1\n', text)
+
+    def test_gauges(self):
+
+        callback = MagicMock()
+        metrics = Metrics(callback=callback)
+        self.assertIsNone(metrics.gauge(u'queue_depth'))
+
+        metrics.set(u'queue_depth', 3, labels={u'tenant': u'a'})
+        metrics.set(u'queue_depth', 1, labels={u'tenant': u'a'})
+
+        self.assertEqual(metrics.gauge(u'queue_depth', {u'tenant': u'a'}), 1)
+        callback.assert_called_with(u'gauge', u'queue_depth', 1, {u'tenant': u'a'})
+
+        text = metrics.prometheus()
+        self.assertIn(u'# TYPE phantom_snap_queue_depth gauge\n', text)
+        self.assertIn(u'phantom_snap_queue_depth{tenant="a"} 1\n', text)
@@ -1,19 +1,276 @@
 # coding=utf-8
+import eventlet
+import os
 import random
 import string
+import sys
+import tempfile
+import time
 
 from unittest import TestCase
 
 from phantom_snap.settings import PHANTOMJS
 from phantom_snap.phantom import PhantomJSRenderer
-from phantom_snap.decorators import Lifetime
+from phantom_snap.decorators import Lifetime, HedgingRenderer
 
 from phantom_snap.imagetools import save_image
 
 
-# class TestPhantomJS(TestCase):
-#
-#     pass
+# Answers requests like render-ipc.js. An array is answered in reverse order, to check responses are matched by id,
+# then the next line is asked for. Pages of URLs starting "http://hang" never complete, unless FAKE_HANG is 0,
+# "http://truncated" exits part way through its image, and "http://stderr" writes to stderr first.
+FAKE_SCRIPT = u"""
+import json, os, sys, time
+def hangs(request):
+    return request['url'].startswith('http://hang') and os.environ.get('FAKE_HANG') != '0'
+def answer(request):
+    response = {'url': request['url'], 'status': 'success', 'loadTime': 1, 'paintTime': 2,
+                'format': request['format'], 'timeout': request['timeout']}
+    image = b''
+    if 'id' in request:
+        response['id'] = request['id']
+    if request['url'] == 'http://stderr':
+        sys.stderr.write('console noise\\n')
+        sys.stderr.flush()
+        time.sleep(0.1)
+    if request['url'] == 'http://truncated':
+        sys.stdout.buffer.write(json.dumps(dict(response, length=1000)).encode('ascii') + b'\\nshort')
+        sys.stdout.flush()
+        os._exit(0)
+    if request.get('binary'):
+        image = b'image\\x00\\xff' * 10000
+        response['length'] = len(image)
+    else:
+        response['base64'] = 'aW1hZ2U='
+    return json.dumps(response).encode('ascii') + b'\\n' + image
+for line in iter(sys.stdin.readline, ''):
+    if line.strip() == 'exit':
+        break
+    request = json.loads(line)
+    if isinstance(request, list):
+        if not request:
+            time.sleep(0.02)
+        answers = [answer(r) for r in reversed(request) if not hangs(r)]
+        sys.stdout.buffer.write(b''.join(answers) + b'{"ready": true}\\n')
+    else:
+        if hangs(request):
+            time.sleep(60)
+        sys.stdout.buffer.write(answer(request))
+    sys.stdout.flush()
+"""
+
+
+class TestPhantomJS(TestCase):
+
+    def setUp(self):
+
+        fd, self.script = tempfile.mkstemp(suffix='.py')
+        with os.fdopen(fd, 'w') as script_file:
+            script_file.write(FAKE_SCRIPT)
+
+    def tearDown(self):
+        os.remove(self.script)
+
+    def _renderer(self, config, prewarm=False):
+
+        config.update({
+            'executable': sys.executable,
+            'script': self.script,
+            'timeouts': {
+                'initial_page_load': 3,
+                'page_load': 1
+            }
+        })
+        return PhantomJSRenderer(config, prewarm=prewarm)
+
+    def test_render(self):
+
+        r = self._renderer({})
+        try:
+            first = r.render(u'http://test/1')
+            second = r.render(u'http://test/2', img_format=u'JPEG')
+        finally:
+            r.shutdown()
+
+        self.assertEqual(first[u'status'], u'success')
+        self.assertEqual(first[u'base64'], u'aW1hZ2U=')
+        self.assertEqual(second[u'format'], u'JPEG')
+
+        self.assertEqual(r.metrics.counter(u'renders_total', {u'status': u'success'}), 2)
+        self.assertEqual(r.metrics.counter(u'process_starts_total'), 1)
+
+        # Asked to exit, so not killed
+        self.assertEqual(r.metrics.counter(u'process_kills_total'), 0)
+
+        for name in (u'lock_wait_seconds', u'spawn_seconds', u'stdin_write_seconds', u'response_seconds',
+                     u'decode_seconds', u'image_bytes'):
+            self.assertGreater(r.metrics.histogram(name).count, 0, name)
+
+    def test_render_timeout(self):
+
+        r = self._renderer({})
+        r.config[u'timeouts'][u'render_response'] = 0.5
+
+        try:
+            self.assertEqual(r.render(u'http://hang')[u'error'], u'Render request has timed out.')
+            self.assertIsNone(r.pid)
+            self.assertEqual(r.metrics.counter(u'process_kills_total'), 1)
+
+            # Busy with a render, so killed when it doesn't exit in time
+            hung = eventlet.spawn(r.render, u'http://hang')
+            eventlet.sleep(0.2)
+            r.shutdown(timeout=0.2)
+            self.assertEqual(r.metrics.counter(u'process_kills_total'), 2)
+            hung.wait()
+        finally:
+            r.shutdown()
+
+    def test_render_multiplexed(self):
+
+        r = self._renderer({'max_pages': 4})
+        urls = [u'http://test/{}'.format(i) for i in range(10)]
+        try:
+            results = list(eventlet.GreenPool().imap(r.render, urls))
+            cookies = r.render(u'http://test/cookies', cookies=[{u'name': u'a', u'value': u'b'}])
+        finally:
+            r.shutdown()
+
+        self.assertEqual([result[u'url'] for result in results], urls)
+        self.assertTrue(all(result[u'status'] == u'success' for result in results))
+        self.assertNotIn(u'id', results[0])
+        self.assertEqual(cookies[u'status'], u'success')
+
+        self.assertEqual(r.metrics.histogram(u'queue_wait_seconds').count, 11)
+        self.assertEqual(r.metrics.histogram(u'response_seconds').count, 11)
+
+    def test_render_multiplexed_hung_page(self):
+
+        r = self._renderer({'max_pages': 2})
+        r.config[u'timeouts'][u'render_response'] = 0.5
+
+        try:
+            hung = eventlet.spawn(r.render, u'http://hang')
+            eventlet.sleep(0)
+
+            # The other page keeps rendering while one hangs
+            start = eventlet.hubs.get_hub().clock()
+            results = list(eventlet.GreenPool().imap(r.render, [u'http://test/{}'.format(i) for i in range(5)]))
+            self.assertLess(eventlet.hubs.get_hub().clock() - start, 1)
+            self.assertTrue(all(result[u'status'] == u'success' for result in results))
+
+            pid = r.pid
+            self.assertEqual(hung.wait()[u'error'], u'Render request has timed out.')
+
+            # Only the hung render failed, the process carries on with its page still held
+            self.assertEqual(r.pid, pid)
+            self.assertEqual(r.render(u'http://test/after')[u'status'], u'success')
+            self.assertEqual(r.render(u'http://stderr')[u'error'].strip(), u'console noise')
+        finally:
+            r.shutdown()
+
+    def test_hedged_multiplexed(self):
+
+        hedging = {'hedge_min_samples': 2, 'hedge_min_delay_sec': 0.1, 'hedge_percentile': 50}
+
+        # Prewarmed, so the processes and their response readers belong to this thread's hub
+        r = self._renderer(dict(hedging, max_pages=4), prewarm=True)
+        r.config[u'timeouts'][u'render_response'] = 0.5
+        hedge = self._renderer({'max_pages': 4, 'env': {'FAKE_HANG': '0'}}, prewarm=True)
+        h = HedgingRenderer(r, hedge_renderer=hedge)
+
+        try:
+            # Concurrent renders reach the multiplexed renderer, whose response reader keeps running
+            start = time.time()
+            results = list(eventlet.GreenPool().imap(h.render, [u'http://test/{}'.format(i) for i in range(5)]))
+            self.assertTrue(all(result[u'status'] == u'success' for result in results))
+            self.assertLess(time.time() - start, 1)
+
+            # The hung render is answered by the hedge
+            start = time.time()
+            self.assertEqual(h.render(u'http://hang')[u'status'], u'success')
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(h.stats[u'hedge_wins'], 1)
+        finally:
+            h.shutdown()
+
+    def test_truncated_image(self):
+
+        for max_pages in (1, 4):
+            r = self._renderer({'max_pages': max_pages, 'binary_images': True})
+            try:
+                response = r.render(u'http://truncated')
+                self.assertEqual(response[u'status'], u'fail')
+                self.assertIsNone(r.pid)
+
+                self.assertEqual(r.render(u'http://test/1')[u'status'], u'success')
+            finally:
+                r.shutdown()
+
+    def test_render_binary(self):
+
+        for max_pages in (1, 4):
+            r = self._renderer({'max_pages': max_pages, 'binary_images': True, 'read_chunk_size': 4096})
+            try:
+                results = list(eventlet.GreenPool().imap(r.render, [u'http://test/1', u'http://test/2']))
+            finally:
+                r.shutdown()
+
+            for result in results:
+                self.assertEqual(result[u'status'], u'success')
+                self.assertIsNone(result[u'base64'])
+                self.assertEqual(bytes(result[u'image']), b'image\x00\xff' * 10000)
+
+    def test_warmup(self):
+
+        r = self._renderer({'warmup': {'stylesheets': [u'http://test/style.css'], 'fonts': [u'Arial']}})
+
+        try:
+            self.assertFalse(r.ready)
+
+            with self.assertLogs(u'PhantomJSRenderer', level=u'DEBUG') as logs:
+                self.assertTrue(r.warmup())
+                self.assertTrue(r.ready)
+                r.render(u'http://test/1')
+        finally:
+            r.shutdown()
+
+        self.assertFalse(r.ready)
+
+        requests = [line for line in logs.output if u'Sending request' in line]
+
+        # The warmup takes the initial page load timeout, the real render the fast one
+        self.assertIn(u'"timeout": 3000', requests[0])
+        self.assertIn(u'href="http://test/style.css"', r._warmup_html())
+        self.assertIn(u"font-family: 'Arial'", r._warmup_html())
+        self.assertIn(u'"timeout": 1000', requests[1])
+
+    def test_restart_exited_process(self):
+
+        r = self._renderer({})
+
+        try:
+            self.assertTrue(r.warmup())
+            self.assertTrue(r.ready)
+
+            r._proc.kill()
+            r._proc.wait()
+            self.assertFalse(r.ready)
+
+            self.assertEqual(r.render(u'http://test/1')[u'status'], u'success')
+        finally:
+            r.shutdown()
+
+        self.assertEqual(r.metrics.counter(u'process_starts_total'), 2)
+
+    def test_prewarm(self):
+
+        config = {'executable': sys.executable, 'script': self.script}
+        r = PhantomJSRenderer(config, prewarm=True)
+
+        try:
+            self.assertTrue(r.ready)
+        finally:
+            r.shutdown()
 
 
 if __name__ == '__main__':
@@ -69,4 +326,4 @@ if __name__ == '__main__':
                 else:
                     print(''.join([page['url'], ' ', str(page['status']), ' ', page['error']]))
     finally:
-        r.shutdown(10)
\ No newline at end of file
+        r.shutdown(10)
@@ -0,0 +1,108 @@
+# coding=utf-8
+
+import eventlet
+import copy
+
+from unittest import TestCase
+from mock import MagicMock
+
+from phantom_snap.settings import PHANTOMJS
+from phantom_snap.renderer import Renderer, RenderError
+from phantom_snap.decorators import Lifetime
+from phantom_snap.pool import RendererPool
+
+
+class SleepyRenderer(Renderer):
+
+    def __init__(self, config, delay=0.1):
+
+        self.config = copy.deepcopy(PHANTOMJS)
+        self.config.update(config)
+        self.delay = delay
+        self.calls = 0
+
+    def get_config(self):
+        return self.config
+
+    def render(self, url, html=None, img_format='PNG', width=1280, height=1024, page_load_timeout=None, user_agent=None,
+               headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None):
+        self.calls += 1
+        eventlet.sleep(self.delay)
+        return {u'url': url, u'status': u'success'}
+
+    def shutdown(self, timeout=None):
+        pass
+
+
+class TestRendererPool(TestCase):
+
+    def test_dispatch_across_workers(self):
+
+        pool = RendererPool(lambda: SleepyRenderer({}), {'pool_size': 3})
+
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(pool.queue_depth, 0)
+
+        green_pool = eventlet.GreenPool()
+        results = list(green_pool.imap(pool.render, [u'http://test/{}'.format(i) for i in range(6)]))
+
+        self.assertEqual(len(results), 6)
+        self.assertEqual([w.calls for w in pool.workers], [2, 2, 2])
+        self.assertEqual(pool.in_flight, 0)
+
+    def test_queue_depth_and_limit(self):
+
+        pool = RendererPool(lambda: SleepyRenderer({}, delay=0.2), {'pool_size': 1, 'max_queue_size': 1})
+
+        first = eventlet.spawn(pool.render, u'http://test/1')
+        second = eventlet.spawn(pool.render, u'http://test/2')
+        eventlet.sleep(0.05)
+
+        self.assertEqual(pool.in_flight, 1)
+        self.assertEqual(pool.queue_depth, 1)
+        self.assertRaises(RenderError, pool.render, u'http://test/3')
+
+        first.wait()
+        second.wait()
+        self.assertEqual(pool.queue_depth, 0)
+
+    def test_queue_timeout(self):
+
+        pool = RendererPool(lambda: SleepyRenderer({}, delay=0.3), {'pool_size': 1, 'queue_timeout': 0.05})
+
+        busy = eventlet.spawn(pool.render, u'http://test/1')
+        eventlet.sleep(0)
+
+        self.assertRaises(RenderError, pool.render, u'http://test/2')
+        busy.wait()
+
+    def test_lifetime_workers(self):
+
+        workers = []
+
+        def factory():
+            mock_r = SleepyRenderer({}, delay=0)
+            mock_r.shutdown = MagicMock()
+            workers.append(mock_r)
+            return Lifetime(mock_r)
+
+        pool = RendererPool(factory, {'pool_size': 2})
+        pool.render(u'http://test')
+        pool.shutdown()
+
+        for worker in workers:
+            self.assertEqual(worker.shutdown.call_count, 1)
+
+    def test_warmup(self):
+
+        def factory():
+            worker = SleepyRenderer({}, delay=0)
+            worker.warmup = MagicMock(return_value=True)
+            return worker
+
+        pool = RendererPool(factory, {'pool_size': 3})
+
+        self.assertTrue(pool.warmup())
+
+        for worker in pool.workers:
+            self.assertEqual(worker.warmup.call_count, 1)
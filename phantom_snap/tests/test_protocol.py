@@ -0,0 +1,41 @@
+# coding=utf-8
+import io
+
+from unittest import TestCase
+
+from phantom_snap.protocol import build_request, frame_length, read_image, redact
+
+
+class TestProtocol(TestCase):
+
+    def test_build_request(self):
+
+        request = build_request(u'http://test', html=u'<b>é</b>', user_agent=u'agent', cookies=[])
+
+        self.assertEqual(request, {u'url': u'http://test', u'width': 1280, u'height': 1024, u'format': u'PNG',
+                                   u'html64': u'PGI+w6k8L2I+', u'userAgent': u'agent', u'cookies': []})
+
+    def test_frame_length(self):
+
+        self.assertEqual(frame_length({u'status': u'success', u'length': 42}), 42)
+        self.assertEqual(frame_length({u'status': u'fail'}), 0)
+        self.assertEqual(frame_length({u'length': u'bad'}), 0)
+
+    def test_read_image(self):
+
+        body = bytes(range(256)) * 10
+        stream = io.BufferedReader(io.BytesIO(body + b'{"next": 1}\n'), buffer_size=100)
+
+        image = read_image(stream, len(body), 7)
+
+        self.assertEqual(bytes(image), body)
+        self.assertEqual(stream.readline(), b'{"next": 1}\n')
+
+        self.assertRaises(ValueError, read_image, io.BytesIO(b'short'), 10, 4)
+
+    def test_redact(self):
+
+        response = {u'status': u'success', u'base64': u'aW1hZ2U=', u'image': b'image'}
+
+        self.assertEqual(redact(response), {u'status': u'success', u'base64': u'<omitted>', u'image': u'<omitted>'})
+        self.assertEqual(response[u'base64'], u'aW1hZ2U=')
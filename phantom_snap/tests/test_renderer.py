@@ -0,0 +1,96 @@
+# coding=utf-8
+
+import eventlet
+
+from unittest import TestCase
+
+from phantom_snap.renderer import Renderer
+from phantom_snap.decorators import Lifetime
+
+
+class DelayRenderer(Renderer):
+    """Sleeps for the number of seconds given as the page_load_timeout."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get_config(self):
+        return {}
+
+    def render(self, url, html=None, img_format='PNG', width=1280, height=1024, page_load_timeout=None, user_agent=None,
+               headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None):
+
+        if url == u'http://error':
+            raise ValueError(u'bad url')
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            eventlet.sleep(page_load_timeout or 0)
+        finally:
+            self.in_flight -= 1
+
+        return {u'url': url, u'status': u'success', u'format': img_format}
+
+    def shutdown(self, timeout=None):
+        pass
+
+
+class TestRenderMany(TestCase):
+
+    def test_completion_order(self):
+
+        r = DelayRenderer()
+        requests = [
+            {u'id': u'slow', u'url': u'http://slow', u'page_load_timeout': 0.3},
+            {u'id': u'fast', u'url': u'http://fast', u'page_load_timeout': 0.05},
+            {u'url': u'http://medium', u'page_load_timeout': 0.1, u'img_format': u'JPEG'},
+        ]
+
+        results = list(r.render_many(requests, concurrency=3))
+
+        self.assertEqual([result[u'id'] for result in results], [u'fast', 2, u'slow'])
+        self.assertEqual(results[1][u'format'], u'JPEG')
+        self.assertEqual(r.max_in_flight, 3)
+
+    def test_bounded_and_lazy(self):
+
+        r = DelayRenderer()
+        pulled = []
+
+        def requests():
+            for i in range(10):
+                pulled.append(i)
+                yield {u'url': u'http://test/{}'.format(i), u'page_load_timeout': 0.01}
+
+        results = r.render_many(requests(), concurrency=2)
+        next(results)
+
+        self.assertEqual(len(pulled), 2)
+
+        remaining = list(results)
+
+        self.assertEqual(len(remaining), 9)
+        self.assertEqual(r.max_in_flight, 2)
+
+    def test_errors(self):
+
+        r = DelayRenderer()
+        results = list(r.render_many([{u'id': 1, u'url': u'http://error'},
+                                      {u'id': 2, u'url': u'http://test', u'bogus': True}]))
+
+        self.assertEqual([result[u'status'] for result in results], [u'fail', u'fail'])
+        self.assertIn(u'bad url', results[0][u'error'])
+        self.assertIn(u'bogus', results[1][u'error'])
+
+    def test_lifetime(self):
+
+        r = Lifetime(DelayRenderer())
+        try:
+            results = list(r.render_many([{u'url': u'http://test'}]))
+        finally:
+            r.shutdown()
+
+        self.assertEqual(results[0][u'id'], 0)
+        self.assertEqual(results[0][u'status'], u'success')
@@ -0,0 +1,101 @@
+# coding=utf-8
+
+import copy
+import json
+import pickle
+
+from unittest import TestCase
+
+from phantom_snap.result import RenderResult
+from phantom_snap.protocol import empty_response, failed_response
+
+
+class TestRenderResult(TestCase):
+
+    def _result(self):
+
+        result = empty_response(u'http://test', u'PNG')
+        result[u'status'] = u'success'
+        result[u'base64'] = u'aW1hZ2U='
+        return result
+
+    def test_dict_compatible(self):
+
+        result = self._result()
+
+        self.assertEqual(list(result), [u'url', u'status', u'load_time', u'paint_time', u'base64', u'format', u'error'])
+        self.assertEqual(result, {u'url': u'http://test', u'status': u'success', u'load_time': None,
+                                  u'paint_time': None, u'base64': u'aW1hZ2U=', u'format': u'PNG', u'error': None})
+        self.assertNotIn(u'image', result)
+        self.assertIsNone(result.get(u'image'))
+
+        result[u'id'] = 7
+        self.assertEqual(result[u'id'], 7)
+        self.assertEqual(len(result), 8)
+
+        del result[u'base64']
+        self.assertNotIn(u'base64', result)
+        self.assertRaises(KeyError, result.__getitem__, u'base64')
+        self.assertRaises(KeyError, result.__delitem__, u'missing')
+
+        self.assertIsInstance(result, dict)
+        self.assertEqual(json.loads(json.dumps(result))[u'id'], 7)
+
+    def test_lazy_image(self):
+
+        result = self._result()
+
+        self.assertEqual(bytes(result.image), b'image')
+
+        # Decoded once, and decoded again only when base64 changes
+        self.assertIs(result.image.obj, result.image.obj)
+        self.assertEqual(result[u'base64'], u'aW1hZ2U=')
+
+        result[u'base64'] = u'b3RoZXI='
+        self.assertEqual(bytes(result.image), b'other')
+
+        self.assertIsNone(failed_response(u'http://test', u'PNG', u'error').image)
+
+    def test_binary_image(self):
+
+        result = empty_response(u'http://test', u'PNG')
+        result[u'image'] = memoryview(bytearray(b'image'))
+
+        self.assertIn(u'image', result)
+        self.assertIsNone(result[u'base64'])
+        self.assertEqual(bytes(result.image), b'image')
+
+    def test_copies_share_image(self):
+
+        result = self._result()
+        result[u'tags'] = [u'a']
+
+        shallow = result.copy()
+        deep = copy.deepcopy(result)
+
+        self.assertIs(shallow[u'base64'], result[u'base64'])
+        self.assertIs(deep[u'base64'], result[u'base64'])
+        self.assertIsNot(deep[u'tags'], result[u'tags'])
+
+        shallow[u'status'] = u'fail'
+        self.assertEqual(result[u'status'], u'success')
+
+        self.assertEqual(pickle.loads(pickle.dumps(result)), result)
+
+    def test_redacted(self):
+
+        result = self._result()
+        redacted = result.redacted()
+
+        self.assertEqual(redacted[u'base64'], u'<omitted>')
+        self.assertEqual(redacted[u'url'], u'http://test')
+        self.assertNotIn(u'aW1hZ2U=', repr(result))
+
+    def test_from_dict(self):
+
+        result = RenderResult.from_dict({u'message': u'Internal server error'})
+
+        self.assertEqual(result, {u'message': u'Internal server error'})
+        self.assertIsNone(result.get(u'base64'))
+
+        self.assertRaises(ValueError, RenderResult.from_dict, [u'not', u'an', u'object'])
@@ -0,0 +1,263 @@
+import eventlet
+from eventlet.event import Event
+
+import copy
+import time
+
+from unittest import TestCase
+from mock import MagicMock
+
+from phantom_snap.renderer import Renderer, RenderError
+from phantom_snap.scheduler import RenderScheduler, _registered_domain
+from phantom_snap.settings import PHANTOMJS
+
+
+class MockRenderer(Renderer):
+
+    def __init__(self, config=None):
+        self.config = copy.deepcopy(PHANTOMJS)
+        self.config.update(config or {})
+
+    def get_config(self):
+        return self.config
+
+    def render(self, url, html=None, img_format='PNG', width=1280, height=1024, page_load_timeout=None, user_agent=None,
+               headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None):
+        pass
+
+    def shutdown(self, timeout=None):
+        pass
+
+
+class TestRenderScheduler(TestCase):
+
+    def setUp(self):
+
+        self.order = []
+        self.release = Event()
+
+        def render(url, *args):
+            self.order.append(url)
+
+            # The first render holds the renderer until released, so the rest queue up
+            if url == u'http://first':
+                self.release.wait()
+
+            eventlet.sleep(0.01)
+            return {u'url': url, u'status': u'success'}
+
+        self.renderer = MockRenderer()
+        self.renderer.render = MagicMock(side_effect=render)
+
+    def test_priority_order(self):
+
+        r = RenderScheduler(self.renderer)
+
+        threads = [eventlet.spawn(r.render, u'http://first')]
+        eventlet.sleep(0)
+
+        now = time.time()
+        requests = [(u'http://low', 0, None),
+                    (u'http://high-late', 5, now + 60),
+                    (u'http://low-soon', 0, now + 30),
+                    (u'http://high-soon', 5, now + 30),
+                    (u'http://highest', 10, None)]
+
+        for url, priority, deadline in requests:
+            threads.append(eventlet.spawn(r.render, url, priority=priority, deadline=deadline))
+
+        eventlet.sleep(0)
+        self.assertEqual(r.queue_depth, 5)
+        self.assertEqual(r.in_flight, 1)
+
+        self.release.send()
+
+        for thread in threads:
+            self.assertEqual(thread.wait()[u'status'], u'success')
+
+        self.assertEqual(self.order, [u'http://first', u'http://highest', u'http://high-soon', u'http://high-late',
+                                      u'http://low-soon', u'http://low'])
+        self.assertEqual(r.stats, {u'queue_depth': 0, u'in_flight': 0, u'dispatched': 6, u'expired': 0})
+
+    def test_expired(self):
+
+        r = RenderScheduler(self.renderer)
+
+        # Expired on arrival
+        response = r.render(u'http://late', deadline=time.time() - 1)
+        self.assertEqual(response[u'status'], u'fail')
+        self.assertIn(u'Deadline', response[u'error'])
+        self.assertEqual(self.renderer.render.call_count, 0)
+
+        # Expires while waiting behind a long render
+        first = eventlet.spawn(r.render, u'http://first')
+        eventlet.sleep(0)
+
+        start = time.time()
+        response = r.render(u'http://waiting', priority=10, deadline=time.time() + 0.1)
+        self.assertEqual(response[u'status'], u'fail')
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(r.queue_depth, 0)
+
+        self.release.send()
+        first.wait()
+
+        self.assertEqual(self.order, [u'http://first'])
+        self.assertEqual(r.metrics.counter(u'deadlines_exceeded_total', {u'stage': u'arrival'}), 1)
+        self.assertEqual(r.metrics.counter(u'deadlines_exceeded_total', {u'stage': u'queued'}), 1)
+
+    def test_trim_page_load(self):
+
+        self.renderer.config[u'timeouts'][u'page_load'] = 15
+        r = RenderScheduler(self.renderer)
+
+        r.render(u'http://test', deadline=time.time() + 5.5)
+        self.assertEqual(self.renderer.render.call_args[0][5], 5)
+
+        r.render(u'http://test', deadline=time.time() + 60)
+        self.assertEqual(self.renderer.render.call_args[0][5], 15)
+
+        r.render(u'http://test')
+        self.assertIsNone(self.renderer.render.call_args[0][5])
+
+    def test_capacity(self):
+
+        self.assertEqual(RenderScheduler(MockRenderer({u'max_pages': 4}))._capacity, 4)
+        self.assertEqual(RenderScheduler(MockRenderer({u'pool_size': 3, u'worker_concurrency': 2}))._capacity, 6)
+        self.assertEqual(RenderScheduler(MockRenderer(), {u'max_concurrency': 8})._capacity, 8)
+
+        r = RenderScheduler(self.renderer, {u'max_queue_size': 1})
+        first = eventlet.spawn(r.render, u'http://first')
+        second = eventlet.spawn(r.render, u'http://second')
+        eventlet.sleep(0)
+
+        self.assertRaises(RenderError, r.render, u'http://third')
+
+        self.release.send()
+        first.wait()
+        second.wait()
+
+    def test_tenants(self):
+
+        r = RenderScheduler(self.renderer, {u'tenants': {u'interactive': {u'weight': 2}}})
+
+        threads = [eventlet.spawn(r.render, u'http://first')]
+        eventlet.sleep(0)
+
+        # The backfill queues up first, and still only gets its share
+        for i in range(6):
+            threads.append(eventlet.spawn(r.render, u'http://backfill/{}'.format(i), tenant=u'backfill'))
+
+        for i in range(4):
+            threads.append(eventlet.spawn(r.render, u'http://interactive/{}'.format(i), tenant=u'interactive'))
+
+        eventlet.sleep(0)
+        self.assertEqual(r.tenants[u'backfill'][u'queue_depth'], 6)
+        self.assertEqual(r.metrics.gauge(u'tenant_queue_depth', {u'tenant': u'interactive'}), 4)
+
+        self.release.send()
+
+        for thread in threads:
+            thread.wait()
+
+        self.assertEqual([url.split(u'/')[2] for url in self.order],
+                         [u'first', u'backfill', u'interactive', u'interactive', u'backfill', u'interactive',
+                          u'interactive', u'backfill', u'backfill', u'backfill', u'backfill'])
+        self.assertEqual(r.tenants[u'interactive'], {u'queue_depth': 0, u'in_flight': 0, u'dispatched': 4,
+                                                     u'weight': 2})
+        self.assertEqual(r.metrics.counter(u'tenant_renders_total', {u'tenant': u'backfill'}), 6)
+        self.assertEqual(r.metrics.gauge(u'tenant_queue_depth', {u'tenant': u'backfill'}), 0)
+
+    def test_tenant_weights(self):
+
+        self.assertRaises(RenderError, RenderScheduler, self.renderer, {u'tenants': {u'x': {u'weight': 0}}})
+        self.assertRaises(RenderError, RenderScheduler, self.renderer, {u'tenants': {u'x': {u'weight': -1}}})
+        self.assertRaises(RenderError, RenderScheduler, self.renderer, {u'default_weight': 0})
+        self.assertRaises(RenderError, RenderScheduler, self.renderer, {u'quantum': 0})
+
+        # A fractional weight earns its render over several turns
+        r = RenderScheduler(self.renderer, {u'max_concurrency': 1, u'tenants': {u'x': {u'weight': 0.25}}})
+        self.assertEqual(r.render(u'http://a.com', tenant=u'x')[u'status'], u'success')
+
+    def test_tenant_max_concurrency(self):
+
+        r = RenderScheduler(self.renderer, {u'max_concurrency': 3,
+                                            u'tenants': {u'backfill': {u'max_concurrency': 1}}})
+
+        threads = [eventlet.spawn(r.render, u'http://first', tenant=u'backfill')]
+        eventlet.sleep(0)
+
+        # The backfill has its one render in flight, the rest of the capacity goes to the others
+        threads.append(eventlet.spawn(r.render, u'http://backfill', tenant=u'backfill'))
+        threads.append(eventlet.spawn(r.render, u'http://a'))
+        threads.append(eventlet.spawn(r.render, u'http://b'))
+        eventlet.sleep(0)
+
+        self.assertEqual(r.in_flight, 3)
+        self.assertEqual(r.tenants[u'backfill'][u'queue_depth'], 1)
+        self.assertEqual(r.tenants[u'default'][u'in_flight'], 2)
+
+        self.release.send()
+
+        for thread in threads:
+            thread.wait()
+
+        self.assertEqual(self.order[-1], u'http://backfill')
+
+    def test_host_max_concurrency(self):
+
+        r = RenderScheduler(self.renderer, {u'max_concurrency': 3, u'host_max_concurrency': 1})
+
+        threads = [eventlet.spawn(r.render, u'http://first')]
+        eventlet.sleep(0)
+
+        # The burst from one site waits its turn, without holding up the other site
+        for i in range(3):
+            threads.append(eventlet.spawn(r.render, u'http://www.busy.com/{}'.format(i)))
+
+        threads.append(eventlet.spawn(r.render, u'http://other.org/'))
+        eventlet.sleep(0)
+
+        self.assertEqual(self.order, [u'http://first', u'http://www.busy.com/0', u'http://other.org/'])
+        self.assertEqual(r.hosts[u'busy.com'], {u'in_flight': 1, u'parked': 2})
+
+        self.release.send()
+
+        for thread in threads:
+            thread.wait()
+
+        self.assertEqual(self.order[-1], u'http://www.busy.com/2')
+        self.assertEqual(r.hosts[u'busy.com'], {u'in_flight': 0, u'parked': 0})
+        self.assertGreater(r.metrics.counter(u'host_deferrals_total'), 0)
+
+    def test_host_min_interval(self):
+
+        r = RenderScheduler(self.renderer, {u'max_concurrency': 4,
+                                            u'hosts': {u'slow.com': {u'min_interval_sec': 0.1}}})
+
+        starts = {}
+
+        def render(url, *args):
+            starts[url] = time.time()
+            return {u'url': url, u'status': u'success'}
+
+        self.renderer.render.side_effect = render
+
+        threads = [eventlet.spawn(r.render, u'http://slow.com/{}'.format(i)) for i in range(3)]
+        threads.append(eventlet.spawn(r.render, u'http://fast.com/'))
+
+        for thread in threads:
+            thread.wait()
+
+        self.assertLess(starts[u'http://fast.com/'], starts[u'http://slow.com/1'])
+        self.assertGreaterEqual(starts[u'http://slow.com/1'] - starts[u'http://slow.com/0'], 0.09)
+        self.assertGreaterEqual(starts[u'http://slow.com/2'] - starts[u'http://slow.com/1'], 0.09)
+        self.assertEqual(r.hosts, {u'slow.com': {u'in_flight': 0, u'parked': 0}})
+
+    def test_registered_domain(self):
+
+        self.assertEqual(_registered_domain(u'http://www.example.com/page'), u'example.com')
+        self.assertEqual(_registered_domain(u'https://news.bbc.co.uk:443/'), u'bbc.co.uk')
+        self.assertEqual(_registered_domain(u'http://10.0.0.1:8080/'), u'10.0.0.1')
+        self.assertEqual(_registered_domain(u'http://localhost/'), u'localhost')
+        self.assertIsNone(_registered_domain(u'about:blank'))
@@ -0,0 +1,203 @@
+import eventlet
+from eventlet import tpool, wsgi
+from eventlet.event import Event
+
+import base64
+import copy
+import gzip
+import io
+import json
+
+from unittest import TestCase
+from mock import MagicMock
+
+from phantom_snap.lambda_renderer import LambdaRenderer
+from phantom_snap.renderer import Renderer
+from phantom_snap.result import RenderResult
+from phantom_snap.server import RenderServer
+from phantom_snap.settings import PHANTOMJS
+
+IMAGE = b'\x89PNG\x00\xff' * 100
+
+
+class MockRenderer(Renderer):
+
+    def __init__(self):
+        self.config = copy.deepcopy(PHANTOMJS)
+
+    def get_config(self):
+        return self.config
+
+    def render(self, url, html=None, img_format='PNG', width=1280, height=1024, page_load_timeout=None, user_agent=None,
+               headers=None, cookies=None, html_encoding=u'utf-8', http_proxy=None):
+
+        if url == u'http://fail':
+            return RenderResult(url=url, status=u'fail', format=img_format, error=u'bad')
+
+        return RenderResult(url=url, status=u'success', load_time=1, paint_time=2, format=img_format,
+                            base64=base64.b64encode(IMAGE).decode('ascii'))
+
+    def shutdown(self, timeout=None):
+        pass
+
+
+def call(app, path, payload=None, method='POST', headers=None, body=None):
+    """Call the WSGI app, returning (status code, headers dict, body)"""
+
+    if body is None:
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'CONTENT_LENGTH': str(len(body)),
+               'wsgi.input': io.BytesIO(body)}
+    environ.update(headers or {})
+
+    response = {}
+
+    def start_response(status, response_headers):
+        response['status'] = int(status.split(' ')[0])
+        response['headers'] = dict(response_headers)
+
+    response_body = b''.join(app(environ, start_response))
+
+    return response['status'], response['headers'], response_body
+
+
+class TestRenderServer(TestCase):
+
+    def test_render(self):
+
+        app = RenderServer(MockRenderer())
+
+        status, headers, body = call(app, '/render', {u'url': u'http://test', u'img_format': u'JPEG'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'application/json')
+        result = json.loads(body.decode('utf-8'))
+        self.assertEqual(result[u'format'], u'JPEG')
+        self.assertEqual(base64.b64decode(result[u'base64']), IMAGE)
+
+        status, headers, body = call(app, '/render', {u'url': u'http://fail'})
+        self.assertEqual(status, 500)
+        self.assertEqual(json.loads(body.decode('utf-8'))[u'error'], u'bad')
+
+        status, headers, body = call(app, '/render', {u'url': u'http://test', u'unknown': 1})
+        self.assertEqual(status, 400)
+
+        self.assertEqual(call(app, '/render', method='GET')[0], 405)
+        self.assertEqual(call(app, '/nothing')[0], 404)
+        self.assertEqual(call(app, '/render', body=b'not json')[0], 400)
+
+        self.assertEqual(app.metrics.counter(u'http_requests_total', {u'path': u'/render', u'code': u'200'}), 1)
+
+    def test_binary_and_gzip(self):
+
+        app = RenderServer(MockRenderer(), {u'compress_min_bytes': 100})
+
+        request = gzip.compress(json.dumps({u'url': u'http://test'}).encode('utf-8'))
+        status, headers, body = call(app, '/render', body=request,
+                                     headers={'HTTP_CONTENT_ENCODING': 'gzip',
+                                              'HTTP_ACCEPT': 'application/octet-stream, application/json'})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'image/png')
+        self.assertEqual(body, IMAGE)
+        self.assertEqual(json.loads(headers['X-Render-Result'])[u'load_time'], 1)
+
+        status, headers, body = call(app, '/render', {u'url': u'http://test'}, headers={'HTTP_ACCEPT_ENCODING': 'gzip'})
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(body).decode('utf-8'))[u'url'], u'http://test')
+
+    def test_binary_images(self):
+
+        renderer = MockRenderer()
+        page = RenderResult(url=u'http://test', status=u'success', format=u'PNG')
+        page[u'image'] = IMAGE
+        renderer.render = MagicMock(return_value=page)
+
+        app = RenderServer(renderer)
+
+        status, headers, body = call(app, '/render', {u'url': u'http://test'})
+        self.assertEqual(base64.b64decode(json.loads(body.decode('utf-8'))[u'base64']), IMAGE)
+
+        status, headers, body = call(app, '/render', {u'url': u'http://test'},
+                                     headers={'HTTP_ACCEPT': 'application/octet-stream'})
+        self.assertEqual(body, IMAGE)
+
+    def test_batch(self):
+
+        app = RenderServer(MockRenderer(), {u'batch_concurrency': 2})
+
+        status, headers, body = call(app, '/render/batch', {u'requests': [{u'url': u'http://test', u'id': u'a'},
+                                                                          {u'url': u'http://fail'}]})
+        self.assertEqual(status, 200)
+
+        results = json.loads(body.decode('utf-8'))[u'results']
+        self.assertEqual([(r[u'id'], r[u'status']) for r in results], [(u'a', u'success'), (1, u'fail')])
+
+    def test_admission(self):
+
+        started = Event()
+        release = Event()
+        renderer = MockRenderer()
+
+        def render(url, **kwargs):
+            started.send()
+            release.wait()
+            return RenderResult(url=url, status=u'success', format=u'PNG')
+
+        renderer.render = MagicMock(side_effect=render)
+        app = RenderServer(renderer, {u'max_pending': 1, u'batch_concurrency': 1})
+
+        first = eventlet.spawn(call, app, '/render', {u'url': u'http://test/1'})
+        started.wait()
+
+        status, headers, body = call(app, '/render', {u'url': u'http://test/2'})
+        self.assertEqual(status, 429)
+        self.assertGreaterEqual(int(headers['Retry-After']), 1)
+
+        status, headers, body = call(app, '/health', method='GET')
+        self.assertEqual(json.loads(body.decode('utf-8'))[u'pending'], 1)
+
+        release.send()
+        self.assertEqual(first.wait()[0], 200)
+        self.assertEqual(app.pending, 0)
+        self.assertEqual(app.metrics.counter(u'rejected_total'), 1)
+
+        status, headers, body = call(app, '/metrics', method='GET')
+        self.assertEqual(status, 200)
+        self.assertIn(b'phantom_snap_rejected_total 1', body)
+
+        # A batch which could never be admitted is a bad request, even when nothing is pending
+        status, headers, body = call(app, '/render/batch', {u'requests': [{u'url': u'http://test/3'},
+                                                                          {u'url': u'http://test/4'}]})
+        self.assertEqual(status, 400)
+        self.assertEqual(renderer.render.call_count, 1)
+
+    def test_api_key(self):
+
+        app = RenderServer(MockRenderer(), {u'api_key': u'secret'})
+
+        self.assertEqual(call(app, '/render', {u'url': u'http://test'})[0], 403)
+        self.assertEqual(call(app, '/render', {u'url': u'http://test'}, headers={'HTTP_X_API_KEY': u'wrong'})[0], 403)
+        self.assertEqual(call(app, '/render', {u'url': u'http://test'}, headers={'HTTP_X_API_KEY': u'secret'})[0], 200)
+
+    def test_lambda_renderer(self):
+
+        app = RenderServer(MockRenderer())
+        sock = eventlet.listen(('127.0.0.1', 0))
+        server = eventlet.spawn(wsgi.server, sock, app, log_output=False)
+
+        lr = LambdaRenderer({'url': 'http://127.0.0.1:{}/render'.format(sock.getsockname()[1]),
+                             'binary_responses': True})
+
+        try:
+            # requests blocks the hub unless monkey patched, so run it on an OS thread
+            response = tpool.execute(lr.render, u'http://test')
+            batch = tpool.execute(lambda: list(lr.render_batches([{u'url': u'http://test'}] * 3)))
+        finally:
+            lr.shutdown()
+            server.kill()
+            sock.close()
+
+        self.assertEqual(response[u'status'], u'success')
+        self.assertEqual(bytes(response[u'image']), IMAGE)
+        self.assertEqual([r[u'status'] for r in batch], [u'success'] * 3)
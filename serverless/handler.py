@@ -1,122 +1,253 @@
+from phantom_snap.decorators import Lifetime
 from phantom_snap.phantom import PhantomJSRenderer
-from phantom_snap.lambda_schema import SCHEMA
+from phantom_snap.lambda_schema import SCHEMA, RESULT_HEADER, BINARY_MEDIA_TYPE, CONTENT_TYPES, render_kwargs
+from phantom_snap.protocol import failed_response
 import base64
 import ujson
 import os
-from jsonschema import validate
 from jsonschema.exceptions import ValidationError
+from jsonschema.validators import validator_for
 import traceback
 import logging
-import copy
 import sys
+import zlib
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logger = logging.getLogger('PhantomJSRenderer')
 logger.setLevel(logging.DEBUG)
 
+# Responses at least this large are gzipped for clients which accept it
+COMPRESS_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESS_MIN_BYTES', 1024))
 
-def render(event, context):
-    request_data = ujson.loads(event['body'])
-    logger.info("Received request {}".format(request_data))
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Time kept back from a batch render for returning the results, beyond the page load and render response timeouts
+BATCH_MARGIN_MS = int(os.getenv('BATCH_MARGIN_MS', 5000))
+
+# Checked once here rather than on every invocation
+SCHEMA_VERSION = os.getenv('SCHEMA_VERSION', '1.0')
+VALIDATORS = {}
+
+for schema_key, schema in SCHEMA[SCHEMA_VERSION].items():
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+    VALIDATORS[schema_key] = validator_class(schema)
+
+
+def _env_int(name, default=None):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+# The renderer lives at module scope, so warm invocations of the container reuse the running PhantomJS
+# process and only pay for the page load. Lifetime recycles it on the configured limits.
+renderer = Lifetime(PhantomJSRenderer({
+    u'executable': './bin/phantomjs-2.1.1',
+    u'args': [
+        '--disk-cache=true',
+        '--max-disk-cache-size=50000',
+        '--disk-cache-path=/tmp/',
+        '--load-images=true',
+        '--ignore-ssl-errors=true',
+        '--ssl-protocol=any',
+    ],
+    u'env': {u'TZ': os.getenv('PHANTOMJS_TIME_ZONE', 'UTC')},
+    u'max_pages': _env_int('PHANTOMJS_MAX_PAGES', 1),  # Pages of a batch rendered in parallel by the process
+    u'timeouts': {
+        u'initial_page_load': int(os.getenv('PHANTOMJS_TIMEOUT_INITIAL', 20)),
+        u'page_load': int(os.getenv('PHANTONJS_TIMEOUT_PAGE_LOAD', 15)),
+        u'render_response': int(os.getenv('PHANTOMJS_TIMEOUT_RENDER_RESPONSE', 15)),
+        u'process_startup': int(os.getenv('PHANTOMJS_TIMEOUT_STARTUP', 20)),
+        u'resource_wait_ms': int(os.getenv('PHANTOMJS_RESOURCE_WAIT_MS', 300)),
+    },
+    u'max_lifetime_sec': _env_int('PHANTOMJS_MAX_LIFETIME_SEC', 3600),
+    u'max_renders': _env_int('PHANTOMJS_MAX_RENDERS', 500),
+    u'max_rss_mb': _env_int('PHANTOMJS_MAX_RSS_MB', 300),  # Within the function's memorySize
+    u'max_disk_cache_mb': _env_int('PHANTOMJS_MAX_DISK_CACHE_MB'),
+    u'clear_disk_cache': True,
+}))
+
+# Start PhantomJS during the init phase, so the first invocation doesn't pay for the process startup either
+if os.getenv('PHANTOMJS_PREWARM', 'true').lower() == 'true':
+    try:
+        renderer.warmup()
+    except Exception:
+        logger.error("Failed to prewarm the renderer {}".format(traceback.format_exc()))
+
+
+def _header(event, name):
+    """Case insensitive lookup of a request header"""
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _request_body(event):
+    """The request body, decoded from base64 and gunzipped as required"""
+    body = event['body']
+
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+
+    if (_header(event, 'content-encoding') or '').lower() == 'gzip':
+        body = zlib.decompress(body, GZIP_WBITS)
 
-    schema_version = os.getenv('SCHEMA_VERSION', '1.0')
-    schema_key = os.getenv('SCHEMA_KEY', 'render')
+    return body
 
+
+def _response(event, status_code, payload):
+    """An API Gateway response with a JSON body, gzipped when the client accepts it"""
+    body = ujson.dumps(payload)
+    headers = {'Content-Type': 'application/json'}
+
+    if 'gzip' in (_header(event, 'accept-encoding') or '') and len(body) >= COMPRESS_MIN_BYTES:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+        compressed = compressor.compress(body.encode('utf-8')) + compressor.flush()
+        headers['Content-Encoding'] = 'gzip'
+
+        return {
+            'isBase64Encoded': True,
+            'statusCode': status_code,
+            'body': base64.b64encode(compressed).decode('ascii'),
+            'headers': headers
+        }
+
+    return {
+        'isBase64Encoded': False,
+        'statusCode': status_code,
+        'body': body,
+        'headers': headers
+    }
+
+
+def _validate(event, request_data, schema_key):
+    """An error response when the request fails schema validation, otherwise None"""
     try:
-        validate(request_data,
-                 SCHEMA[schema_version][schema_key])
+        VALIDATORS[schema_key].validate(request_data)
     except ValidationError as e:
         logger.warning("Failed schema validation {}".format(traceback.format_exc()))
-        return {
-            'isBase64Encoded': False,
-            'statusCode': 400,
-            'body': ujson.dumps({
-                'message': 'Failed Schema Validation',
-                'ex': traceback.format_exc(),
-             }),
-            'headers': {'Content-Type': 'application/json'}
+        return _response(event, 400, {
+            'message': 'Failed Schema Validation',
+            'ex': traceback.format_exc(),
+        })
+
+    return None
+
+
+def _uncaught(event):
+    logger.error("Uncaught exception {}".format(traceback.format_exc()))
+
+    # Don't trust the process with the next invocation, it is restarted on demand
+    renderer.shutdown()
+
+    return _response(event, 500, {
+        'message': 'Uncaught Exception',
+        'ex': traceback.format_exc(),
+    })
+
+
+def _binary_response(page):
+    """
+    An API Gateway response with the image as the body and the rest of the result in a header.
+    The base64 text from PhantomJS is passed through as is, API Gateway decodes it.
+    """
+    metadata = dict((key, page[key]) for key in page if key not in ('base64', 'image'))
+
+    return {
+        'isBase64Encoded': True,
+        'statusCode': 200,
+        'body': page['base64'],
+        'headers': {
+            'Content-Type': CONTENT_TYPES.get(page['format'], BINARY_MEDIA_TYPE),
+            RESULT_HEADER: ujson.dumps(metadata)
         }
+    }
+
+
+def render(event, context):
+    request_data = ujson.loads(_request_body(event))
+    logger.info("Received request for %s", request_data.get('url'))
 
-    # load data from schema with defaults
-    url = request_data['url']
-    html = request_data.get('html', None)
-    img_format = request_data.get('img_format', 'PNG')
-    width = request_data.get('width', 1280)
-    height = request_data.get('height', 1024)
-    page_load_timeout = request_data.get('page_load_timeout', None)
-    user_agent = request_data.get('user_agent', None)
-    http_proxy = request_data.get('http_proxy', None)
-    headers = request_data.get('headers', None)
-    cookies = request_data.get('cookies', None)
-    html_encoding = request_data.get('html_encoding', 'utf-8')
-
-    if html is not None:
-        html = base64.b64decode(html)
+    error = _validate(event, request_data, os.getenv('SCHEMA_KEY', 'render'))
+    if error is not None:
+        return error
 
     # render page
     try:
-        renderer = PhantomJSRenderer({
-            u'executable': './bin/phantomjs-2.1.1',
-            u'args': [
-                '--disk-cache=true',
-                '--max-disk-cache-size=50000',
-                '--disk-cache-path=/tmp/',
-                '--load-images=true',
-                '--ignore-ssl-errors=true',
-                '--ssl-protocol=any',
-            ],
-            u'env': {u'TZ': os.getenv('PHANTOMJS_TIME_ZONE', 'UTC')},
-            u'timeouts': {
-                u'initial_page_load': int(os.getenv('PHANTOMJS_TIMEOUT_INITIAL', 20)),
-                u'page_load': int(os.getenv('PHANTONJS_TIMEOUT_PAGE_LOAD', 15)),
-                u'render_response': int(os.getenv('PHANTOMJS_TIMEOUT_RENDER_RESPONSE', 15)),
-                u'process_startup': int(os.getenv('PHANTOMJS_TIMEOUT_STARTUP', 20)),
-                u'resource_wait_ms': int(os.getenv('PHANTOMJS_RESOURCE_WAIT_MS', 300)),
-            },
-        })
-        page = renderer.render(url=url,
-                               html=html,
-                               img_format=img_format,
-                               width=width,
-                               height=height,
-                               page_load_timeout=page_load_timeout,
-                               user_agent=user_agent,
-                               headers=headers,
-                               cookies=cookies,
-                               html_encoding=html_encoding,
-                               http_proxy=http_proxy)
-        renderer.shutdown()
-        del renderer
+        page = renderer.render(**render_kwargs(request_data))
     except Exception as e:
-        logger.error("Uncaught exception {}".format(traceback.format_exc()))
-        return {
-            'isBase64Encoded': False,
-            'statusCode': 500,
-            'body': ujson.dumps({
-                'message': 'Uncaught Exception',
-                'ex': traceback.format_exc(),
-             }),
-            'headers': {'Content-Type': 'application/json'}
-        }
+        return _uncaught(event)
 
-    log_page = copy.deepcopy(page)
-    if log_page['base64'] is not None:
-        log_page['base64'] = '<omitted>'
-    logger.info("Render response {}".format(log_page))
+    # Formatted only when logged, and the RenderResult repr leaves out the image
+    logger.info("Render response %r", page)
 
     if page['status'] == 'fail':
         logger.warning("Failed to render page")
-        return {
-            'isBase64Encoded': False,
-            'statusCode': 500,
-            'body': ujson.dumps(page),
-            'headers': {'Content-Type': 'application/json'}
-        }
+        return _response(event, 500, page.to_dict())
+    elif BINARY_MEDIA_TYPE in (_header(event, 'accept') or '') and page.get('base64') is not None:
+        logger.debug("Successful render")
+        return _binary_response(page)
     else:
         logger.debug("Successful render")
-        return {
-            'isBase64Encoded': False,
-            'statusCode': 200,
-            'body': ujson.dumps(page),
-            'headers': {'Content-Type': 'application/json'}
-        }
+        return _response(event, 200, page.to_dict())
+
+
+def _in_time(requests, context):
+    """
+    Yield the requests as render_many() takes them, stopping once the invocation has too little time left to
+    load another page and wait for its render response, so the results rendered so far are returned rather than
+    lost to the function timeout.
+    """
+    timeouts = renderer.get_config()['timeouts']
+
+    for request in requests:
+        # A cold process loads its first page under the initial_page_load timeout
+        page_load = timeouts['page_load'] if renderer.ready else timeouts['initial_page_load']
+        needed_ms = ((request['page_load_timeout'] or page_load) + timeouts['render_response']) * 1000 + BATCH_MARGIN_MS
+
+        if context is not None and context.get_remaining_time_in_millis() < needed_ms:
+            return
+
+        yield request
+
+
+def render_batch(event, context):
+    request_data = ujson.loads(_request_body(event))
+    logger.info("Received batch of {} requests".format(len(request_data.get('requests') or [])))
+
+    error = _validate(event, request_data, 'render_batch')
+    if error is not None:
+        return error
+
+    items = request_data['requests']
+
+    # render pages, as many at once as the process renders in parallel
+    try:
+        requests = [dict(render_kwargs(item), id=index) for index, item in enumerate(items)]
+        pages = [None] * len(items)
+
+        for page in renderer.render_many(_in_time(requests, context), concurrency=renderer.get_config()['max_pages']):
+            pages[page['id']] = page
+    except Exception as e:
+        return _uncaught(event)
+
+    not_started = pages.count(None)
+    if not_started:
+        logger.warning("Ran out of time before starting {} of {} renders".format(not_started, len(items)))
+
+    results = []
+
+    for item, request, page in zip(items, requests, pages):
+        if page is None:
+            page = failed_response(request['url'], request['img_format'],
+                                   'Not started, the batch ran out of time before the function timeout.')
+            page['id'] = request['id']
+
+        logger.info("Render response %r", page)
+        result = page.to_dict()
+        result['id'] = item.get('id', page['id'])
+        results.append(result)
+
+    # The status of each render is on its result
+    return _response(event, 200, {'results': results})
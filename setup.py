@@ -30,6 +30,7 @@ setup(name='phantom-snap',
     package_data={
         'phantom_snap': ['*.js']
     },
+    python_requires='>=3.7',
     setup_requires=[
         'nose>=1.3.7'
     ],
@@ -37,6 +38,16 @@ setup(name='phantom-snap',
         'eventlet>=0.23.0',
         'requests>=2.19.1'
     ],
+    extras_require={
+        'derivatives': ['Pillow>=6.0.0'],
+        'change_detection': ['Pillow>=6.0.0', 'numpy>=1.16.0'],
+        'server': ['jsonschema>=2.6.0']
+    },
+    entry_points={
+        'console_scripts': [
+            'phantom-snap = phantom_snap.cli:main'
+        ]
+    },
     tests_require=[
         'nose',
         'coverage>=4.0.3',
@@ -46,6 +57,10 @@ setup(name='phantom-snap',
     test_suite='nose.collector',
     classifiers=[
         "Intended Audience :: Developers",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
         "Topic :: System",
         "Topic :: System :: Distributed Computing",
         "Topic :: Utilities"